@@ -0,0 +1,98 @@
+"""Замер времени бэкапа на синтетическом вальте: заметки + медиа.
+
+Сравнивает прежнюю запись через pyzipper (deflate 9 для всех файлов, одно ядро)
+с create_zip_with_password, параллельным writer'ом при разном числе процессов,
+потоковым tar.zst и первым снимком в хранилище кусков.
+
+    python -m bench.bench_backup --notes 2000 --media 40 --media-mb 2 --docs 5
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import pyzipper
+
+from bench.common import add_common_args, case, emit, report
+from bench.vault_gen import make_vault
+from utils.backup_utils import create_zip_with_password
+from utils.chunk_store import ChunkStore, backup_to_store
+from utils.tar_stream import write_tar_zst
+from utils.zip_writer import write_aes_zip
+
+
+def legacy_zip(input_dir: Path, output_zip: Path, files, password: str):
+    with pyzipper.AESZipFile(output_zip, 'w', compression=pyzipper.ZIP_DEFLATED,
+                             encryption=pyzipper.WZ_AES, compresslevel=9) as zipf:
+        zipf.setpassword(password.encode('utf-8'))
+        for arcname in files:
+            zipf.write(input_dir / arcname, arcname=arcname)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--notes', type=int, default=2000)
+    parser.add_argument('--media', type=int, default=40)
+    parser.add_argument('--media-mb', type=float, default=2)
+    parser.add_argument('--docs', type=int, default=5,
+                        help="PDF по --media-mb МБ: их хранилище кусков режет по содержимому")
+    parser.add_argument('--level', type=int, default=9)
+    parser.add_argument('--no-legacy', action='store_true', help="не замерять прежний pyzipper (он медленный)")
+    add_common_args(parser)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        vault = Path(tmp) / 'vault'
+        vault.mkdir()
+        make_vault(vault, args.notes, 0, args.media, args.media_mb, seed=args.seed, folders=20, lines=80)
+        docs = vault / 'files'
+        docs.mkdir()
+        for i in range(args.docs):
+            (docs / f"doc_{i}.pdf").write_bytes(os.urandom(int(args.media_mb * 1024 * 1024)))
+        files = sorted(p.relative_to(vault).as_posix() for p in vault.rglob('*') if p.is_file())
+        total = sum((vault / f).stat().st_size for f in files)
+        if not args.json:
+            print(f"Вальт: {len(files)} файлов, {total / 1024 / 1024:.1f} МБ")
+
+        runs = [] if args.no_legacy else [('pyzipper (как раньше)', lambda out: legacy_zip(vault, out, files, 'pw'))]
+        # Так архив пишет бот (BACKUP_WORKERS=0 - по числу ядер)
+        runs.append(('create_zip_with_password', lambda out: create_zip_with_password(
+            vault, out, 'pw', files, level=args.level)))
+        cpus = os.cpu_count() or 1
+        for workers in sorted({1, 2, cpus}):
+            runs.append((f"параллельно, процессов: {workers}",
+                         lambda out, w=workers: write_aes_zip(vault, out, 'pw', files,
+                                                              workers=w, level=args.level)))
+        runs.append(('tar.zst', lambda out: write_tar_zst(vault, out, 'pw', files)))
+        for title, run in runs:
+            out = Path(tmp) / 'out.bin'
+            started = time.perf_counter()
+            run(out)
+            elapsed = time.perf_counter() - started
+            size = out.stat().st_size
+            # Скорость - в файлах в секунду
+            result = case('backup', title, len(files), elapsed, mb_in=total / 1024 / 1024,
+                          mb_out=size / 1024 / 1024, ratio=size / total)
+            emit(result, args)
+            results.append(result)
+            out.unlink()
+
+        # Первый снимок: все файлы режутся на куски заново
+        store_dir = Path(tmp) / 'store'
+        started = time.perf_counter()
+        backup_to_store(ChunkStore(store_dir, 'pw'), vault, files, 'bench')
+        elapsed = time.perf_counter() - started
+        size = sum(p.stat().st_size for p in store_dir.rglob('*') if p.is_file())
+        result = case('backup', 'хранилище кусков', len(files), elapsed, mb_in=total / 1024 / 1024,
+                      mb_out=size / 1024 / 1024, ratio=size / total)
+        emit(result, args)
+        results.append(result)
+        shutil.rmtree(store_dir)
+    report(results, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Замер сохранения файлов через свой сервер Bot API.
+
+Поднимает заменитель сервера (bench/fake_bot_api.py) и сохраняет одни и те же
+файлы обычным скачиванием по HTTP и в режиме --local, где файл переносится
+с диска сервера ссылкой без копирования. --vault на другой ФС покажет
+запасной вариант с копированием.
+
+    python -m bench.bench_local_api --files 20 --mb 20
+"""
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import config
+from bench.common import add_common_args, case, emit, report
+from bench.fake_bot_api import FakeBotAPI
+from utils.media_utils import download_file
+
+
+async def run_mode(local: bool, api_dir: Path, vault: Path, files: int, size: int, args) -> dict:
+    server = FakeBotAPI(api_dir / ('local' if local else 'http'), local=local)
+    file_ids = [server.add_file(os.urandom(size), f"documents/file_{i}.bin") for i in range(files)]
+    url = await server.start()
+    session = AiohttpSession(api=TelegramAPIServer.from_base(url, is_local=local))
+    bot = Bot(token=server.token, session=session)
+    target = vault / ('local' if local else 'http')
+    try:
+        started = time.perf_counter()
+        results = await asyncio.gather(*(download_file(bot, file_id, target / f"{file_id}.bin")
+                                         for file_id in file_ids))
+        elapsed = time.perf_counter() - started
+    finally:
+        await session.close()
+        await server.stop()
+    title = "--local" if local else "HTTP"
+    saved_files = sum(results)
+    if saved_files < files:
+        if not args.json:
+            print(f"{title:8} сохранено {saved_files} из {files} (больше 50 МБ по HTTP не скачать)")
+        return case('local_api', title, saved_files, elapsed, saved=saved_files)
+    source = server.files_dir / server.token / "documents" / "file_0.bin"
+    saved = target / f"{file_ids[0]}.bin"
+    if source.exists():
+        assert saved.read_bytes() == source.read_bytes()
+        shared = os.path.samestat(saved.stat(), source.stat())
+    else:
+        shared = True  # файл забран из папки сервера переносом
+    result = case('local_api', title, files, elapsed, saved=files,
+                  mb_per_s=files * size / 1024 / 1024 / elapsed, shared_inode=shared)
+    emit(result, args)
+    return result
+
+
+async def run(args):
+    logging.basicConfig(level=logging.WARNING)
+    size = int(args.mb * 1024 * 1024)
+    with tempfile.TemporaryDirectory() as api_tmp, tempfile.TemporaryDirectory(dir=args.vault) as vault_tmp:
+        config.OBSIDIAN_PATH = vault_tmp
+        return [await run_mode(local, Path(api_tmp), Path(vault_tmp), args.files, size, args)
+                for local in (False, True)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=20, help="сколько файлов")
+    parser.add_argument('--mb', type=float, default=20, help="размер файла, МБ")
+    parser.add_argument('--vault', default=None, help="где создать вальт (другая ФС - проверка копирования)")
+    add_common_args(parser)
+    args = parser.parse_args()
+    report(asyncio.run(run(args)), args)
+
+
+if __name__ == '__main__':
+    main()
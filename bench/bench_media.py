@@ -0,0 +1,85 @@
+"""Замер сохранения альбома на поддельном боте с задержкой сети.
+
+Сравнивает прежнее последовательное скачивание (get_file + download по
+очереди) с одновременным в process_media_group. Скорость - в файлах в
+секунду, задержка - на сохранение одного альбома.
+
+    python -m bench.bench_media --items 10 --latency 0.15 --mb 1.5 --mbps 40
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from aiogram import types
+
+import config
+import utils.media_utils as media_utils
+from bench.common import add_common_args, case, emit, report
+from bench.fake_bot import FakeBot
+from bench.replay import make_album
+from utils.media_utils import download_file, process_media_group
+
+
+def albums(bot: FakeBot, count: int, items: int, size: int):
+    return [[types.Message.model_validate(payload).as_(bot)
+             for payload in make_album(album, 1, items, bot, size)]
+            for album in range(count)]
+
+
+async def sequential(bot, messages, media_dir: Path):
+    for msg in messages:
+        await download_file(bot, msg.photo[-1].file_id, media_dir / 'photos' / f"{msg.photo[-1].file_id}.jpg")
+
+
+async def concurrent(bot, messages, media_dir: Path):
+    info = await process_media_group(messages, media_dir, bot)
+    assert len(info['photos']) == len(messages), info
+
+
+async def run(args):
+    size = int(args.mb * 1024 * 1024)
+    results = []
+    for title, func in (("по очереди (как раньше)", sequential), ("одновременно", concurrent)):
+        with tempfile.TemporaryDirectory() as tmp:
+            # Индекс медиа - во временном вальте
+            config.OBSIDIAN_PATH = tmp
+            media_utils._media_store = None
+            media_dir = Path(tmp) / 'media-tg'
+            (media_dir / 'photos').mkdir(parents=True)
+            bot = FakeBot(args.latency, args.mbps, args.link_mbps)
+            latencies = []
+
+            async def timed(messages):
+                started = time.perf_counter()
+                await func(bot, messages, media_dir)
+                latencies.append(time.perf_counter() - started)
+
+            batch = albums(bot, args.albums, args.items, size)
+            started = time.perf_counter()
+            await asyncio.gather(*(timed(messages) for messages in batch))
+            elapsed = time.perf_counter() - started
+            # Скорость - в файлах, задержка - на альбом
+            result = case('media', title, args.albums * args.items, elapsed, latencies,
+                          mb_per_s=bot.stats['bytes'] / 1024 / 1024 / elapsed)
+            emit(result, args)
+            results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', type=int, default=10, help="файлов в альбоме")
+    parser.add_argument('--albums', type=int, default=1, help="альбомов одновременно")
+    parser.add_argument('--latency', type=float, default=0.15, help="задержка запроса, с")
+    parser.add_argument('--mb', type=float, default=1.5, help="размер файла, МБ")
+    parser.add_argument('--mbps', type=float, default=40, help="скорость на один файл, МБ/с")
+    parser.add_argument('--link-mbps', type=float, default=0, help="общий канал, МБ/с (0 - без предела)")
+    add_common_args(parser)
+    args = parser.parse_args()
+    report(asyncio.run(run(args)), args)
+
+
+if __name__ == '__main__':
+    main()
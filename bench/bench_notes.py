@@ -0,0 +1,79 @@
+"""Замер записи пачки пересланных сообщений в одну заметку (OBSIDIAN_NAME_MD).
+
+Сравнивает прежнюю запись (open/write/close на каждое сообщение прямо в цикле
+событий) с NoteWriter: сколько раз файл менялся на диске и через сколько
+обработчик получал подтверждение записи (задержка p50/p99).
+
+    python -m bench.bench_notes --messages 500 --burst 50
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from bench.common import add_common_args, case, emit, report
+from utils.note_writer import NoteWriter
+
+
+def legacy_append(note_path: Path, content: str):
+    with open(note_path, 'a', encoding='utf-8') as f:
+        f.write(content)
+
+
+async def run_case(title: str, append, messages: int, burst: int, pause: float, writes, args) -> dict:
+    delays = []
+
+    async def timed(content):
+        started = time.perf_counter()
+        await append(content)
+        delays.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for first in range(0, messages, burst):
+        await asyncio.gather(*(timed(f"\n## сообщение {i}\nтекст пересланного сообщения\n\n---\n")
+                               for i in range(first, min(first + burst, messages))))
+        await asyncio.sleep(pause)
+    elapsed = time.perf_counter() - started
+    result = case('notes', title, messages, elapsed, delays, disk_writes=writes())
+    emit(result, args)
+    return result
+
+
+async def run(args):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        note = Path(tmp) / "legacy.md"
+        count = [0]
+
+        async def legacy(content):
+            count[0] += 1
+            legacy_append(note, content)
+
+        results.append(await run_case("по одной (как раньше)", legacy, args.messages, args.burst,
+                                      args.pause, lambda: count[0], args))
+        for fsync in ('off', 'batch'):
+            writer = NoteWriter(window=args.window, fsync=fsync)
+            note = Path(tmp) / f"writer_{fsync}.md"
+            results.append(await run_case(f"NoteWriter (fsync={fsync})",
+                                          lambda content: writer.append(note, content), args.messages,
+                                          args.burst, args.pause, lambda: writer.stats['batches'], args))
+        texts = [(Path(tmp) / name).read_text(encoding='utf-8')
+                 for name in ("legacy.md", "writer_off.md", "writer_batch.md")]
+        assert texts[0] == texts[1] == texts[2], "порядок записей различается"
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=500, help="сообщений всего")
+    parser.add_argument('--burst', type=int, default=50, help="сообщений одновременно (пересылка пачкой)")
+    parser.add_argument('--pause', type=float, default=0.05, help="пауза между пачками, с")
+    parser.add_argument('--window', type=float, default=0.3, help="окно объединения NoteWriter, с")
+    add_common_args(parser)
+    args = parser.parse_args()
+    report(asyncio.run(run(args)), args)
+
+
+if __name__ == '__main__':
+    main()
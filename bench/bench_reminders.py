@@ -0,0 +1,66 @@
+"""Замер поиска напоминаний по всему вальту (REMINDER_FILES = ["*.md"]).
+
+Холодная проверка читает все заметки, повторная - только stat (кэш по mtime
+и размеру), после правки части файлов перечитываются только они. Всё должно
+укладываться с запасом в интервал проверки REMINDER_RESCAN.
+
+    python -m bench.bench_reminders --notes 50000 --workers 1 8 32
+"""
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import config
+from bench.common import add_common_args, case, emit, report
+from bench.vault_gen import make_vault
+from utils.reminder_utils import ReminderParser
+
+
+def timed(func) -> float:
+    started = time.perf_counter()
+    func()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--notes', type=int, default=50000)
+    parser.add_argument('--reminders', type=float, default=0.02, help="доля заметок с напоминаниями")
+    parser.add_argument('--touch', type=int, default=50, help="сколько заметок изменить")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8, 32])
+    add_common_args(parser)
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        vault = Path(tmp)
+        started = time.perf_counter()
+        stats = make_vault(vault, args.notes, args.reminders, seed=args.seed)
+        if not args.json:
+            print(f"Вальт: {args.notes} заметок, создан за {time.perf_counter() - started:.1f} c")
+            print(f"Интервал проверки REMINDER_RESCAN: {config.REMINDER_RESCAN} c")
+
+        notes = sorted(vault.rglob('note_*.md'))
+        rnd = random.Random(args.seed)
+        for workers in args.workers:
+            reminder_parser = ReminderParser(vault, ["*.md"], workers=workers)
+            cold = timed(reminder_parser.refresh)
+            lines = reminder_parser.stats['lines_parsed']
+            warm = timed(reminder_parser.refresh)
+            for path in rnd.sample(notes, min(args.touch, len(notes))):
+                with open(path, 'a', encoding='utf-8') as f:
+                    f.write("\n- [ ] новая |- 12:00")
+            touched = timed(reminder_parser.refresh)
+            found = sum(len(cached['items']) for cached in reminder_parser._cache.values())
+            # Скорость - заметок в секунду на холодной проверке
+            result = case('reminders', f"потоков {workers}", stats['notes'], cold,
+                          warm_s=warm, touched_s=touched, lines_parsed=lines, reminders=found)
+            emit(result, args)
+            results.append(result)
+    report(results, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""Замер приёма сообщений: webhook против опроса getUpdates.
+
+Бот работает против заменителя Bot API (bench/fake_bot_api.py). Обновления
+(сгенерированные или записанные, по одному JSON на строку) подаются
+с заданной частотой: в режиме webhook клиент шлёт их POST-запросами
+как Telegram, при опросе они отдаются через getUpdates. Задержка - от
+отправки обновления до ответа "✅" (он уходит после записи заметки;
+несколько ответов подряд склеиваются в один "✅ ... (×n)").
+
+    python -m bench.bench_webhook --updates 500 --rate 200
+    python -m bench.bench_webhook --replay updates.jsonl
+"""
+import argparse
+import asyncio
+import json
+import logging
+import socket
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List
+
+import aiohttp
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import config
+import handlers.media_handler as media_handler
+from bench.common import add_common_args, case, emit, report, saved_count
+from bench.fake_bot_api import FakeBotAPI
+from utils.note_utils import note_writer
+from utils.webhook_server import SECRET_HEADER, run_webhook
+
+SECRET = "bench-secret"
+WEBHOOK_PATH = "/telegram"
+
+
+def make_updates(count: int, chats: int) -> List[dict]:
+    now = int(time.time())
+    return [{
+        'message': {
+            'message_id': i + 1, 'date': now,
+            'chat': {'id': 1000 + i % chats, 'type': 'private'},
+            'from': {'id': 1000 + i % chats, 'is_bot': False, 'first_name': 'bench'},
+            'text': f"пересланное сообщение {i}",
+        }
+    } for i in range(count)]
+
+
+def load_updates(path: Path) -> List[dict]:
+    with open(path, encoding='utf-8') as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+    for update in updates:
+        update.pop('update_id', None)
+    return updates
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def chat_of(update: dict) -> int:
+    return update['message']['chat']['id']
+
+
+async def feed(updates: List[dict], rate: float, send) -> Dict[int, List[float]]:
+    """Подаёт обновления с частотой rate в секунду (0 - сразу все). Возвращает время отправки по чатам"""
+    sent_at = defaultdict(list)
+    tasks = []
+    started = time.perf_counter()
+    for i, update in enumerate(updates):
+        if rate:
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        sent_at[chat_of(update)].append(time.perf_counter())
+        tasks.append(asyncio.create_task(send(update)))
+    await asyncio.gather(*tasks)
+    return sent_at
+
+
+async def wait_replies(server: FakeBotAPI, count: int, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while sum(saved_count(text) for _, text, _ in server.sent) < count:
+        if time.perf_counter() > deadline:
+            raise TimeoutError("не все сообщения сохранены")
+        await asyncio.sleep(0.01)
+
+
+def summarize(title: str, server: FakeBotAPI, sent_at: Dict[int, List[float]], started: float, args) -> dict:
+    # Сообщения одного чата сохраняются по порядку: i-й ответ чату - на его i-е обновление
+    replies = defaultdict(list)
+    for chat_id, text, at in server.sent:
+        replies[chat_id].extend([at] * saved_count(text))
+    latencies = [reply - sent for chat_id, times in sent_at.items()
+                 for sent, reply in zip(times, replies[chat_id])]
+    elapsed = max(at for times in replies.values() for at in times) - started
+    result = case('webhook', title, len(latencies), elapsed, latencies, replies=len(server.sent))
+    emit(result, args)
+    return result
+
+
+def setup(tmp: Path, mode: str):
+    config.OBSIDIAN_PATH = str(tmp / mode)
+    config.STATE_DIR = str(tmp / mode / "state")
+    media_handler.OBSIDIAN_PATH = config.OBSIDIAN_PATH
+    media_handler.OBSIDIAN_NAME_MD = "inbox.md"
+    dp = Dispatcher()
+    media_handler.register_media_handlers(dp)
+    return dp
+
+
+async def run_webhook_mode(updates: List[dict], args, tmp: Path) -> dict:
+    dp = setup(tmp, 'webhook')
+    server = FakeBotAPI(tmp / 'api-webhook', local=False)
+    url = await server.start()
+    bot = Bot(server.token, session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    port = free_port()
+    stop = asyncio.Event()
+    serving = asyncio.create_task(run_webhook(dp, bot, '127.0.0.1', port, WEBHOOK_PATH, SECRET,
+                                              drain_timeout=30, stop=stop))
+    endpoint = f"http://127.0.0.1:{port}{WEBHOOK_PATH}"
+    async with aiohttp.ClientSession() as client:
+        for _ in range(100):
+            try:
+                async with client.post(endpoint, json={'update_id': 0}, headers={SECRET_HEADER: "wrong"}) as resp:
+                    assert resp.status == 401, "запрос с неверным секретом принят"
+                break
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.05)
+        update_id = iter(range(1, len(updates) + 1))
+
+        async def send(update):
+            async with client.post(endpoint, json=dict(update, update_id=next(update_id)),
+                                   headers={SECRET_HEADER: SECRET}) as resp:
+                assert resp.status == 200
+
+        started = time.perf_counter()
+        sent_at = await feed(updates, args.rate, send)
+        await wait_replies(server, len(updates), args.timeout)
+    stop.set()
+    await serving
+    await note_writer.drain()
+    await server.stop()
+    return summarize("webhook", server, sent_at, started, args)
+
+
+async def run_polling_mode(updates: List[dict], args, tmp: Path) -> dict:
+    dp = setup(tmp, 'polling')
+    server = FakeBotAPI(tmp / 'api-polling', local=False)
+    url = await server.start()
+    bot = Bot(server.token, session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    polling = asyncio.create_task(dp.start_polling(bot, handle_signals=False, polling_timeout=10))
+
+    async def send(update):
+        server.push_update(update)
+
+    started = time.perf_counter()
+    sent_at = await feed(updates, args.rate, send)
+    await wait_replies(server, len(updates), args.timeout)
+    await dp.stop_polling()
+    await polling
+    await note_writer.drain()
+    await server.stop()
+    return summarize("polling", server, sent_at, started, args)
+
+
+async def run(args):
+    logging.basicConfig(level=logging.WARNING)
+    updates = load_updates(Path(args.replay)) if args.replay else make_updates(args.updates, args.chats)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in args.modes.split(','):
+            func = run_webhook_mode if mode == 'webhook' else run_polling_mode
+            results.append(await func(updates, args, Path(tmp)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=500, help="сколько сообщений сгенерировать")
+    parser.add_argument('--chats', type=int, default=5, help="из скольких чатов")
+    parser.add_argument('--replay', default=None, help="файл с записанными обновлениями (JSON на строку)")
+    parser.add_argument('--rate', type=float, default=200, help="обновлений в секунду (0 - сразу все)")
+    parser.add_argument('--modes', default='webhook,polling', help="режимы через запятую")
+    parser.add_argument('--timeout', type=float, default=120, help="сколько ждать сохранения всех, с")
+    add_common_args(parser)
+    args = parser.parse_args()
+    report(asyncio.run(run(args)), args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Общее для замеров: перцентили, пиковая память и единый формат результатов.
+
+Каждый замер возвращает список случаев - словарей с полями:
+bench, case, count (сколько операций), seconds, throughput (операций в
+секунду), p50_ms/p99_ms (задержка одной операции, если мерилась),
+peak_rss_mb (пик памяти процесса к концу случая) и своими полями.
+С --json замер печатает только этот список - его собирает bench.suite.
+"""
+import json
+import platform
+import re
+import sys
+from typing import Any, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def percentile(values: List[float], share: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def saved_count(text: str) -> int:
+    """Сколько сообщений подтверждает ответ бота ("✅ ... (×n)" - n сообщений)"""
+    if not text.startswith("✅"):
+        return 0
+    match = re.match(r"✅[^\n]*\(×(\d+)\)", text)
+    return int(match.group(1)) if match else 1
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Пиковая память процесса, МБ (None там, где её не узнать)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт КБ, macOS - байты
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+COMMON_FIELDS = ('bench', 'case', 'count', 'seconds', 'throughput', 'p50_ms', 'p99_ms', 'peak_rss_mb')
+
+
+def case(bench: str, name: str, count: int, seconds: float,
+         latencies: Optional[List[float]] = None, **extra) -> Dict[str, Any]:
+    result = {
+        'bench': bench, 'case': name, 'count': count, 'seconds': seconds,
+        'throughput': count / seconds if seconds else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    result.update(extra)
+    return result
+
+
+def format_case(result: Dict[str, Any]) -> str:
+    line = f"{result['case']:32} {result['seconds']:7.2f} c  {result['throughput']:9.1f} в секунду"
+    if result['p50_ms'] is not None:
+        line += f"  p50 {result['p50_ms']:7.1f} мс, p99 {result['p99_ms']:7.1f} мс"
+    if result['peak_rss_mb'] is not None:
+        line += f"  память {result['peak_rss_mb']:6.0f} МБ"
+    for key, value in result.items():
+        if key not in COMMON_FIELDS:
+            line += f"  {key}={value:.3f}".rstrip('0').rstrip('.') if isinstance(value, float) else f"  {key}={value}"
+    return line
+
+
+def emit(result: Dict[str, Any], args):
+    """Печатает случай сразу (без --json) - длинный замер видно по ходу"""
+    if not getattr(args, 'json', False):
+        print(format_case(result), flush=True)
+
+
+def report(results: List[Dict[str, Any]], args):
+    if getattr(args, 'json', False):
+        print(json.dumps(results, ensure_ascii=False))
+
+
+def add_common_args(parser):
+    parser.add_argument('--json', action='store_true', help="вывести результаты в JSON (для bench.suite)")
+    parser.add_argument('--seed', type=int, default=42, help="зерно генератора данных")
+
+
+def environment() -> Dict[str, Any]:
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'machine': platform.machine()}
@@ -0,0 +1,78 @@
+"""Поддельный Bot в том же процессе: get_file, download_file и send_message без сети.
+
+Каждый запрос ждёт latency секунд, файл передаётся со скоростью mbps МБ/с,
+а все одновременные скачивания делят канал link_mbps МБ/с (0 - не ограничен).
+Для замеров через настоящий HTTP есть bench/fake_bot_api.py.
+
+    bot = FakeBot(latency=0.15, mbps=40, link_mbps=100)
+    bot.add_file("file_id", 1024 * 1024)
+    message = types.Message.model_validate(payload).as_(bot)
+"""
+import asyncio
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+
+CHUNK = 256 * 1024
+
+
+class FakeBot:
+    # Без aiohttp-сессии download_file качает через bot.download_file
+    session = None
+    id = 42
+
+    def __init__(self, latency: float = 0.1, mbps: float = 40, link_mbps: float = 0,
+                 default_size: int = 1024 * 1024, send_latency: float = 0.0):
+        self.latency = latency
+        self.mbps = mbps
+        self.link_mbps = link_mbps
+        self.default_size = default_size
+        self.send_latency = send_latency
+        # (chat_id, текст, time.perf_counter()) отправленных сообщений, как у FakeBotAPI
+        self.sent: List[Tuple[int, str, float]] = []
+        self.stats = {'get_file': 0, 'downloads': 0, 'bytes': 0}
+        self._sizes: Dict[str, int] = {}
+        self._active = 0
+
+    def add_file(self, file_id: str, size: int):
+        self._sizes[file_id] = size
+
+    async def get_file(self, file_id: str):
+        self.stats['get_file'] += 1
+        await asyncio.sleep(self.latency)
+        return SimpleNamespace(file_id=file_id, file_unique_id=f"u_{file_id}",
+                               file_path=f"files/{file_id}", file_size=self._sizes.get(file_id, self.default_size))
+
+    def _rate(self) -> float:
+        """Скорость одного скачивания сейчас, байт/с"""
+        rate = self.mbps * 1024 * 1024
+        if self.link_mbps:
+            rate = min(rate, self.link_mbps * 1024 * 1024 / max(1, self._active))
+        return rate
+
+    async def download_file(self, file_path: str, destination: Path, timeout: int = 30):
+        file_id = file_path.rsplit('/', 1)[-1]
+        size = self._sizes.get(file_id, self.default_size)
+        # Разное содержимое у разных файлов: одинаковые сохранились бы один раз
+        pattern = file_path.encode()
+        self.stats['downloads'] += 1
+        await asyncio.sleep(self.latency)
+        self._active += 1
+        try:
+            with open(destination, 'wb') as f:
+                left = size
+                while left:
+                    chunk = min(CHUNK, left)
+                    await asyncio.sleep(chunk / self._rate())
+                    f.write((pattern * (chunk // len(pattern) + 1))[:chunk])
+                    left -= chunk
+        finally:
+            self._active -= 1
+        self.stats['bytes'] += size
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        self.sent.append((chat_id, text, time.perf_counter()))
+        return SimpleNamespace(message_id=len(self.sent), chat=SimpleNamespace(id=chat_id), text=text)
@@ -0,0 +1,133 @@
+"""Заменитель сервера Bot API для замеров: getUpdates, getFile, sendMessage и раздача файлов.
+
+В режиме local отвечает как telegram-bot-api с --local: file_path - абсолютный
+путь к файлу на диске, а HTTP-раздачи файлов нет. Иначе отдаёт относительный
+путь и файл по /file/bot<token>/<path> (с поддержкой Range, как api.telegram.org).
+
+    server = FakeBotAPI(Path("/tmp/api"), local=True)
+    file_id = server.add_file(b"...", "photos/1.jpg")
+    url = await server.start()
+    ...
+    await server.stop()
+"""
+import asyncio
+import os
+import time
+from contextlib import suppress
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+TOKEN = "123456:local-bench"
+
+
+class FakeBotAPI:
+    def __init__(self, files_dir: Path, local: bool, token: str = TOKEN):
+        self.files_dir = files_dir
+        self.local = local
+        self.token = token
+        self.requests = 0
+        # (chat_id, текст, time.perf_counter()) отправленных ботом сообщений
+        self.sent: List[Tuple[int, str, float]] = []
+        # Каждый flood_every-й sendMessage получает 429 с retry_after=flood_wait (0 - никогда)
+        self.flood_every = 0
+        self.flood_wait = 1
+        self.flooded = 0
+        self._send_calls = 0
+        self._files: Dict[str, str] = {}
+        self._updates: List[dict] = []
+        self._next_update_id = 1
+        self._new_updates: Optional[asyncio.Event] = None
+        self._runner = None
+
+    def push_update(self, update: dict):
+        """Ставит обновление в очередь для getUpdates (update_id назначается здесь)"""
+        update = dict(update, update_id=self._next_update_id)
+        self._next_update_id += 1
+        self._updates.append(update)
+        if self._new_updates is not None:
+            self._new_updates.set()
+
+    def add_file(self, data: bytes, rel_path: str) -> str:
+        """Кладёт файл в папку сервера и возвращает его file_id"""
+        path = self.files_dir / self.token / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        file_id = f"f{len(self._files)}_{os.urandom(4).hex()}"
+        self._files[file_id] = rel_path
+        return file_id
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        self._new_updates = asyncio.Event()
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self._method)
+        if not self.local:
+            app.router.add_get('/file/bot{token}/{path:.+}', self._file)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def _check_token(self, request: web.Request):
+        if request.match_info['token'] != self.token:
+            raise web.HTTPUnauthorized()
+
+    async def _method(self, request: web.Request) -> web.Response:
+        self._check_token(request)
+        self.requests += 1
+        method = request.match_info['method'].lower()
+        params = dict(await request.post()) if request.can_read_body else dict(request.query)
+        if method == 'getme':
+            result = {'id': int(self.token.split(':')[0]), 'is_bot': True, 'first_name': 'bench'}
+        elif method == 'getfile':
+            rel_path = self._files.get(params.get('file_id'))
+            if rel_path is None:
+                return web.json_response({'ok': False, 'error_code': 400,
+                                          'description': 'Bad Request: invalid file_id'}, status=400)
+            path = self.files_dir / self.token / rel_path
+            result = {
+                'file_id': params['file_id'],
+                'file_unique_id': 'u' + params['file_id'],
+                'file_size': path.stat().st_size,
+                'file_path': str(path) if self.local else rel_path,
+            }
+        elif method == 'getupdates':
+            result = await self._get_updates(int(params.get('offset', 0)), float(params.get('timeout', 0)))
+        elif method == 'sendmessage':
+            self._send_calls += 1
+            if self.flood_every and self._send_calls % self.flood_every == 0:
+                self.flooded += 1
+                return web.json_response({
+                    'ok': False, 'error_code': 429,
+                    'description': f'Too Many Requests: retry after {self.flood_wait}',
+                    'parameters': {'retry_after': self.flood_wait},
+                }, status=429)
+            chat_id = int(params['chat_id'])
+            self.sent.append((chat_id, params.get('text', ''), time.perf_counter()))
+            result = {'message_id': len(self.sent), 'date': int(time.time()),
+                      'chat': {'id': chat_id, 'type': 'private'}, 'text': params.get('text', '')}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def _get_updates(self, offset: int, timeout: float) -> List[dict]:
+        """Как getUpdates: подтверждает всё до offset, при пустой очереди ждёт до timeout секунд"""
+        self._updates = [update for update in self._updates if update['update_id'] >= offset]
+        if not self._updates and timeout:
+            self._new_updates.clear()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+        return self._updates[:100]
+
+    async def _file(self, request: web.Request) -> web.StreamResponse:
+        self._check_token(request)
+        path = (self.files_dir / self.token / request.match_info['path']).resolve()
+        if not path.is_file() or self.files_dir.resolve() not in path.parents:
+            raise web.HTTPNotFound()
+        return web.FileResponse(path)
@@ -0,0 +1,229 @@
+"""Прогон пачек пересланных сообщений и альбомов через настоящий приём бота.
+
+Сообщения (сгенерированные или записанные, одно обновление JSON на строку)
+подаются в handlers.media_handler.handle_message так же, как их отдаёт
+диспетчер: с журналом, конвейером, сборкой альбомов, записью заметок и
+очередью ответов. Файлы отдаёт FakeBot с заданной задержкой и скоростью.
+Задержка - от подачи сообщения (первого файла альбома) до ответа "✅".
+
+    python -m bench.replay --bursts 5 --burst 50 --albums 10 --album-items 5
+    python -m bench.replay --updates recorded.jsonl
+"""
+import argparse
+import asyncio
+import json
+import logging
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List
+
+from aiogram import types
+
+import config
+from bench.common import add_common_args, case, emit, report, saved_count
+from bench.fake_bot import FakeBot
+
+WORDS = "заметка задача идея проект встреча список купить прочитать обсудить".split()
+
+
+def _message(chat_id: int, message_id: int, **fields) -> dict:
+    return dict({
+        'message_id': message_id, 'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'is_bot': False, 'first_name': 'bench'},
+    }, **fields)
+
+
+def make_burst(chat_id: int, first_id: int, count: int, photo_share: float, bot: FakeBot,
+               file_size: int) -> List[dict]:
+    """Пачка пересланных из канала сообщений, часть - с фото"""
+    messages = []
+    for i in range(count):
+        fields = {'forward_from_chat': {'id': -100, 'type': 'channel', 'title': 'Канал'},
+                  'forward_date': int(time.time())}
+        text = " ".join(WORDS[(first_id + i + k) % len(WORDS)] for k in range(12))
+        if photo_share and i % max(1, round(1 / photo_share)) == 0:
+            file_id = f"p{chat_id}_{first_id + i}"
+            bot.add_file(file_id, file_size)
+            fields['photo'] = [{'file_id': file_id, 'file_unique_id': f"u{file_id}", 'width': 1280, 'height': 960}]
+            fields['caption'] = text
+        else:
+            fields['text'] = text
+        messages.append(_message(chat_id, first_id + i, **fields))
+    return messages
+
+
+def make_album(chat_id: int, first_id: int, items: int, bot: FakeBot, file_size: int) -> List[dict]:
+    group_id = f"g{chat_id}_{first_id}"
+    messages = []
+    for i in range(items):
+        file_id = f"a{chat_id}_{first_id + i}"
+        bot.add_file(file_id, file_size)
+        fields = {'media_group_id': group_id,
+                  'photo': [{'file_id': file_id, 'file_unique_id': f"u{file_id}", 'width': 1280, 'height': 960}]}
+        if i == 0:
+            fields['caption'] = "альбом"
+        messages.append(_message(chat_id, first_id + i, **fields))
+    return messages
+
+
+def make_workload(args, bot: FakeBot) -> List[List[dict]]:
+    """Единицы подачи: пачка сообщений или альбом (каждая - один или несколько ответов "✅")"""
+    size = int(args.file_mb * 1024 * 1024)
+    units = []
+    next_id: Dict[int, int] = defaultdict(lambda: 1)
+    for i in range(max(args.bursts, args.albums)):
+        chat_id = 1000 + i % args.chats
+        if i < args.bursts:
+            units.append(make_burst(chat_id, next_id[chat_id], args.burst, args.photos, bot, size))
+            next_id[chat_id] += args.burst
+        if i < args.albums:
+            units.append(make_album(chat_id, next_id[chat_id], args.album_items, bot, size))
+            next_id[chat_id] += args.album_items
+    return units
+
+
+def load_workload(path: Path) -> List[List[dict]]:
+    """Записанные обновления: альбомы - одной единицей, остальное - по одному"""
+    units, albums = [], {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            message = json.loads(line)
+            message = message.get('message', message)
+            group = message.get('media_group_id')
+            if group is None:
+                units.append([message])
+            elif group in albums:
+                albums[group].append(message)
+            else:
+                albums[group] = [message]
+                units.append(albums[group])
+    return units
+
+
+def expected_replies(units: List[List[dict]]) -> int:
+    """Альбом подтверждается одним ответом, остальные сообщения - каждое своим"""
+    return sum(1 if unit[0].get('media_group_id') else len(unit) for unit in units)
+
+
+async def replay(units: List[List[dict]], bot: FakeBot, gap: float, timeout: float):
+    """Подаёт единицы с паузой gap. Возвращает задержки до "✅" и время от первой подачи до последнего ответа"""
+    import handlers.media_handler as media_handler
+
+    # Время подачи по чатам в порядке ожидаемых ответов: ответы чату приходят по порядку
+    submitted = defaultdict(list)
+    started = time.perf_counter()
+    for unit in units:
+        chat_id = unit[0]['chat']['id']
+        now = time.perf_counter()
+        if unit[0].get('media_group_id'):
+            submitted[chat_id].append(now)
+        else:
+            submitted[chat_id].extend([now] * len(unit))
+        for payload in unit:
+            await media_handler.handle_message(types.Message.model_validate(payload).as_(bot), bot)
+        if gap:
+            await asyncio.sleep(gap)
+
+    total = expected_replies(units)
+    deadline = time.perf_counter() + timeout
+    while sum(saved_count(text) for _, text, _ in bot.sent) < total:
+        if time.perf_counter() > deadline:
+            raise TimeoutError(f"сохранено {sum(saved_count(t) for _, t, _ in bot.sent)} из {total}")
+        await asyncio.sleep(0.01)
+
+    replies = defaultdict(list)
+    for chat_id, text, at in bot.sent:
+        replies[chat_id].extend([at] * saved_count(text))
+    latencies = [reply - sent for chat_id, times in submitted.items()
+                 for sent, reply in zip(times, replies[chat_id])]
+    finished = max(at for _, _, at in bot.sent)
+    return latencies, finished - started
+
+
+async def run_case(title: str, units_factory, args, tmp: Path, journal: bool) -> dict:
+    import handlers.media_handler as media_handler
+    import utils.media_utils as media_utils
+    from utils.note_utils import note_writer
+
+    vault = tmp / title
+    config.OBSIDIAN_PATH = str(vault)
+    config.STATE_DIR = str(vault / '.bot')
+    config.INGEST_JOURNAL = int(journal)
+    media_handler.OBSIDIAN_PATH = config.OBSIDIAN_PATH
+    media_handler.OBSIDIAN_NAME_MD = "inbox.md"
+    media_handler._ready_dirs.clear()
+    # Индекс сохранённых медиа - свой в каждом вальте
+    media_utils._media_store = None
+
+    bot = FakeBot(args.latency, args.mbps, args.link_mbps)
+    units = units_factory(bot)
+    await media_handler.start_ingest(bot)
+    try:
+        latencies, elapsed = await replay(units, bot, args.gap, args.timeout)
+    finally:
+        await media_handler.stop_ingest()
+        await note_writer.drain()
+        media_handler.journal = None
+    note = vault / "inbox.md"
+    entries = note.read_text(encoding='utf-8').count("\n---\n") if note.exists() else 0
+    assert entries == expected_replies(units), f"в заметке {entries} записей из {expected_replies(units)}"
+    return case('replay', title, len(latencies), elapsed, latencies,
+                messages=sum(len(unit) for unit in units), replies=len(bot.sent),
+                downloaded_mb=bot.stats['bytes'] / 1024 / 1024)
+
+
+async def run(args) -> List[dict]:
+    logging.basicConfig(level=logging.WARNING)
+    if args.updates:
+        def factory(bot):
+            units = load_workload(Path(args.updates))
+            for unit in units:
+                for message in unit:
+                    for photo in message.get('photo') or []:
+                        bot.add_file(photo['file_id'], int(args.file_mb * 1024 * 1024))
+            return units
+    else:
+        def factory(bot):
+            return make_workload(args, bot)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for journal in (False, True):
+            title = "с журналом" if journal else "без журнала"
+            result = await run_case(title, factory, args, Path(tmp), journal)
+            emit(result, args)
+            results.append(result)
+    return results
+
+
+def add_args(parser):
+    parser.add_argument('--bursts', type=int, default=4, help="пачек пересланных сообщений")
+    parser.add_argument('--burst', type=int, default=50, help="сообщений в пачке")
+    parser.add_argument('--photos', type=float, default=0.2, help="доля сообщений пачки с фото")
+    parser.add_argument('--albums', type=int, default=4, help="альбомов")
+    parser.add_argument('--album-items', type=int, default=6, help="файлов в альбоме")
+    parser.add_argument('--chats', type=int, default=2, help="из скольких чатов")
+    parser.add_argument('--gap', type=float, default=0.2, help="пауза между пачками и альбомами, с")
+    parser.add_argument('--file-mb', type=float, default=0.5, help="размер файла, МБ")
+    parser.add_argument('--latency', type=float, default=0.1, help="задержка запроса к Telegram, с")
+    parser.add_argument('--mbps', type=float, default=40, help="скорость одного скачивания, МБ/с")
+    parser.add_argument('--link-mbps', type=float, default=100, help="общий канал, МБ/с (0 - без предела)")
+    parser.add_argument('--updates', default=None, help="записанные обновления (JSON на строку) вместо генерации")
+    parser.add_argument('--timeout', type=float, default=120, help="сколько ждать сохранения всех, с")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    add_args(parser)
+    add_common_args(parser)
+    args = parser.parse_args()
+    report(asyncio.run(run(args)), args)
+
+
+if __name__ == '__main__':
+    main()
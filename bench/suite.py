@@ -0,0 +1,103 @@
+"""Все замеры разом - для сравнения между коммитами.
+
+Каждый замер запускается отдельным процессом (пиковая память - своя),
+работает без сети и на одних и тех же синтетических данных (--seed).
+Результаты пишутся одним JSON с коммитом и окружением:
+
+    python -m bench.suite --out before.json
+    git checkout feature && python -m bench.suite --out after.json --compare before.json
+
+По умолчанию - уменьшенные размеры (несколько минут), --full - размеры по
+умолчанию самих замеров. --only выбирает замеры: --only notes replay
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from bench.common import environment
+
+# замер: (модуль, аргументы в быстром режиме)
+BENCHES: Dict[str, Tuple[str, List[str]]] = {
+    'notes': ('bench.bench_notes', ['--messages', '300']),
+    'media': ('bench.bench_media', ['--albums', '3']),
+    'reminders': ('bench.bench_reminders', ['--notes', '10000', '--workers', '1', '8']),
+    'backup': ('bench.bench_backup', ['--notes', '1000', '--media', '12', '--media-mb', '1']),
+    'local_api': ('bench.bench_local_api', ['--files', '10', '--mb', '5']),
+    'webhook': ('bench.bench_webhook', ['--updates', '300']),
+    'replay': ('bench.replay', []),
+}
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def git_commit() -> Dict[str, object]:
+    def git(*args) -> str:
+        return subprocess.run(['git', *args], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    try:
+        return {'commit': git('rev-parse', '--short', 'HEAD'), 'dirty': bool(git('status', '--porcelain'))}
+    except OSError:
+        return {'commit': None, 'dirty': None}
+
+
+def run_bench(name: str, full: bool, seed: int, timeout: float) -> List[dict]:
+    module, quick_args = BENCHES[name]
+    cmd = [sys.executable, '-m', module, '--json', '--seed', str(seed)] + ([] if full else quick_args)
+    proc = subprocess.run(cmd, cwd=ROOT, capture_output=True, text=True, timeout=timeout)
+    if proc.returncode != 0:
+        raise RuntimeError(f"{name}: код {proc.returncode}\n{proc.stderr[-2000:]}")
+    # Список случаев - последняя строка вывода
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def compare(results: List[dict], baseline: List[dict]):
+    before = {(item['bench'], item['case']): item for item in baseline}
+    print(f"\n{'замер':40} {'в секунду':>22} {'p50, мс':>22} {'память, МБ':>16}")
+    for item in results:
+        old = before.get((item['bench'], item['case']))
+        if old is None:
+            continue
+
+        def delta(key: str, width: int) -> str:
+            if item.get(key) is None or not old.get(key):
+                return ' ' * width
+            change = (item[key] - old[key]) / old[key] * 100
+            return f"{old[key]:.1f} -> {item[key]:.1f} ({change:+.0f}%)".rjust(width)
+
+        print(f"{item['bench'] + ': ' + item['case']:40} {delta('throughput', 22)} "
+              f"{delta('p50_ms', 22)} {delta('peak_rss_mb', 16)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHES), help="какие замеры запустить")
+    parser.add_argument('--full', action='store_true', help="полные размеры данных")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', default=None, help="куда записать результаты (JSON)")
+    parser.add_argument('--compare', default=None, help="прошлый результат suite для сравнения")
+    parser.add_argument('--timeout', type=float, default=1800, help="предел на один замер, с")
+    args = parser.parse_args()
+
+    results = []
+    for name in args.only or list(BENCHES):
+        started = time.perf_counter()
+        print(f"{name}...", end=' ', flush=True)
+        cases = run_bench(name, args.full, args.seed, args.timeout)
+        print(f"{time.perf_counter() - started:.1f} c")
+        results.extend(cases)
+
+    document = dict(git_commit(), date=time.strftime('%Y-%m-%dT%H:%M:%S'), full=args.full,
+                    seed=args.seed, environment=environment(), results=results)
+    if args.out:
+        Path(args.out).write_text(json.dumps(document, ensure_ascii=False, indent=2), encoding='utf-8')
+    else:
+        print(json.dumps(document, ensure_ascii=False, indent=2))
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding='utf-8'))
+        compare(results, baseline['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Синтетический вальт для замеров: заметки, строки напоминаний и медиа.
+
+При одном и том же seed получается один и тот же вальт (кроме содержимого
+медиа с random_media - оно из os.urandom и не сжимается, как настоящие фото).
+
+    python -m bench.vault_gen /tmp/vault --notes 5000 --reminders 0.05 --media 40 --media-mb 2
+"""
+import argparse
+import os
+import random
+from pathlib import Path
+from typing import Dict
+
+WORDS = "заметка задача идея проект встреча список купить прочитать обсудить".split()
+MEDIA_KINDS = (('photos', '.jpg'), ('videos', '.mp4'), ('voices', '.ogg'))
+
+
+def reminder_line(rnd: random.Random) -> str:
+    """Строка напоминания в одном из форматов, которые понимает ReminderParser"""
+    task = f"- [ ] {rnd.choice(WORDS)} {rnd.choice(WORDS)}"
+    at = f"{rnd.randint(0, 23)}:{rnd.randint(0, 59):02}"
+    kind = rnd.random()
+    if kind < 0.5:
+        return f"{task} |- {at}"
+    if kind < 0.8:
+        return f"{task} |- {rnd.choice(['пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс'])} {at}"
+    return f"{task} |- {rnd.randint(1, 28):02}.{rnd.randint(1, 12):02}.{rnd.randint(2025, 2027)} {at}"
+
+
+def make_vault(root: Path, notes: int = 1000, reminders: float = 0.02, media: int = 0,
+               media_mb: float = 1, seed: int = 42, folders: int = 100, lines: int = 40,
+               random_media: bool = True) -> Dict[str, int]:
+    """Создаёт вальт в root. reminders - доля заметок с напоминанием.
+
+    Возвращает, сколько создано: notes, reminders, media, bytes.
+    """
+    rnd = random.Random(seed)
+    stats = {'notes': 0, 'reminders': 0, 'media': 0, 'bytes': 0}
+    for i in range(notes):
+        folder = root / f"folder_{i % folders}" / f"sub_{i % 7}"
+        folder.mkdir(parents=True, exist_ok=True)
+        text = [" ".join(rnd.choices(WORDS, k=10)) for _ in range(rnd.randint(5, lines))]
+        if rnd.random() < reminders:
+            text.append(reminder_line(rnd))
+            stats['reminders'] += 1
+        data = "\n".join(text).encode('utf-8')
+        (folder / f"note_{i}.md").write_bytes(data)
+        stats['notes'] += 1
+        stats['bytes'] += len(data)
+
+    size = int(media_mb * 1024 * 1024)
+    for sub, _ in MEDIA_KINDS:
+        if media:
+            (root / 'media-tg' / sub).mkdir(parents=True, exist_ok=True)
+    for i in range(media):
+        sub, ext = MEDIA_KINDS[i % len(MEDIA_KINDS)]
+        data = os.urandom(size) if random_media else rnd.randbytes(256) * (size // 256)
+        (root / 'media-tg' / sub / f"m_{i}{ext}").write_bytes(data)
+        stats['media'] += 1
+        stats['bytes'] += len(data)
+
+    (root / '.obsidian').mkdir(exist_ok=True)
+    (root / '.obsidian' / 'workspace.json').write_text('{}')
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root', help="куда создать вальт (папка создаётся)")
+    parser.add_argument('--notes', type=int, default=1000)
+    parser.add_argument('--reminders', type=float, default=0.02, help="доля заметок с напоминаниями")
+    parser.add_argument('--media', type=int, default=0, help="сколько медиафайлов")
+    parser.add_argument('--media-mb', type=float, default=1, help="размер медиафайла, МБ")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    root = Path(args.root)
+    root.mkdir(parents=True, exist_ok=True)
+    stats = make_vault(root, args.notes, args.reminders, args.media, args.media_mb, args.seed)
+    print(f"{root}: заметок {stats['notes']}, с напоминаниями {stats['reminders']}, "
+          f"медиа {stats['media']}, {stats['bytes'] / 1024 / 1024:.1f} МБ")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,162 @@
-import os
-# ВСЕ ВПИСЫВАЕМ В СВОБОДНЫЕ КАВЫЧКИ. ПРИМЕР os.getenv("BOT_TOKEN", "СЮДА")
-# токен полученный из BotFather
-BOT_TOKEN = os.getenv("BOT_TOKEN", "")
-#пароль на архив бэкапов
-BACKUP_PASSWORD = os.getenv("BACKUP_PASSWORD","")
-
-# место хранения вальта. Пример: /Users/Professional/Obsidian
-OBSIDIAN_PATH = os.getenv("OBSIDIAN_PATH","")
-
-# название файла в который будем сохранять заметку. 
-# если оставить пустым то заметка будет сохраняться с текущей датой и временем по образцу (ниже)
-# указанной в OBSIDIAN_FORMAT_DATA. Пример: notes.md
-OBSIDIAN_NAME_MD = os.getenv("OBSIDIAN_NAME_MD","")
-
-# если оставляем пустым OBSIDIAN_NAME_MD надо задать какой формат даты и времени необходим
-OBSIDIAN_FORMAT_DATA = os.getenv("OBSIDIAN_FORMAT_DATA",'%d.%m.%Y_%H.%M.%S') 
-
-# в каких файлах из вашего вальта будут извлекаться задачи, указываем через запятую в кавычках
-# пример ["1.md","Планы/2.md"]
-REMINDER_FILES = ["Планы.md"]
-
-# путь куда сохранять медиа файлы. Пример: Прочее/file
-OBSIDIAN_SAVE_IMAGE = os.getenv("OBSIDIAN_SAVE_IMAGE","")
-
-# название папки в которую сохранять медиафайлы, если оставить пустым будут 
-# ложиться просто в директорию OBSIDIAN_SAVE_IMAGE (выше) 
-# в определенные папки videos, photos, files, voices
-OBSIDIAN_SAVE_DIR = os.getenv("OBSIDIAN_SAVE_DIR","media-tg")#
-
-# Папка/путь для хранения бэкапов Пример: /appdata/file/backups
-BACKUP_DIR = os.getenv("BACKUP_DIR","")  
-
-# Бэкапы
-BACKUP_AUTO_SAVE = int(os.getenv("BACKUP_AUTO_SAVE", 24))   # Периодичность бекапов в часах (0 - отключено)
-BACKUP_MAX_AGE = int(os.getenv("BACKUP_MAX_AGE", 7)) # Максимальный возраст файлов в днях
-BACKUP_MAX_COUNT = int(os.getenv("BACKUP_MAX_COUNT", 7))   # Максимальное количество хранимых бэкапов
-ADMIN_CHAT_ID = 123456789  # ID чата для уведомлений (можно получить в любом боте)
+import os
+# ВСЕ ВПИСЫВАЕМ В СВОБОДНЫЕ КАВЫЧКИ. ПРИМЕР os.getenv("BOT_TOKEN", "СЮДА")
+# токен полученный из BotFather
+BOT_TOKEN = os.getenv("BOT_TOKEN", "")
+#пароль на архив бэкапов
+BACKUP_PASSWORD = os.getenv("BACKUP_PASSWORD","")
+
+# место хранения вальта. Пример: /Users/Professional/Obsidian
+OBSIDIAN_PATH = os.getenv("OBSIDIAN_PATH","")
+
+# название файла в который будем сохранять заметку. 
+# если оставить пустым то заметка будет сохраняться с текущей датой и временем по образцу (ниже)
+# указанной в OBSIDIAN_FORMAT_DATA. Пример: notes.md
+OBSIDIAN_NAME_MD = os.getenv("OBSIDIAN_NAME_MD","")
+
+# если оставляем пустым OBSIDIAN_NAME_MD надо задать какой формат даты и времени необходим
+OBSIDIAN_FORMAT_DATA = os.getenv("OBSIDIAN_FORMAT_DATA",'%d.%m.%Y_%H.%M.%S') 
+
+# в каких файлах из вашего вальта будут извлекаться задачи, указываем через запятую в кавычках
+# пример ["1.md","Планы/2.md"]
+# можно указывать папки (все .md внутри, пример "Дневник/") и маски как в .gitignore
+# (пример "Проекты/**/*.md" или "*.md" - весь вальт)
+REMINDER_FILES = ["Планы.md"]
+# сколько потоков читают файлы с напоминаниями (0 - автоматически)
+REMINDER_WORKERS = int(os.getenv("REMINDER_WORKERS", 0))
+# за сколько минут досылать напоминания, пропущенные пока бот был выключен (не больше суток)
+REMINDER_GRACE = int(os.getenv("REMINDER_GRACE", 15))
+# как часто (в секундах) проверять, не изменились ли файлы с напоминаниями
+REMINDER_RESCAN = int(os.getenv("REMINDER_RESCAN", 30))
+
+# путь куда сохранять медиа файлы. Пример: Прочее/file
+OBSIDIAN_SAVE_IMAGE = os.getenv("OBSIDIAN_SAVE_IMAGE","")
+
+# название папки в которую сохранять медиафайлы, если оставить пустым будут 
+# ложиться просто в директорию OBSIDIAN_SAVE_IMAGE (выше) 
+# в определенные папки videos, photos, files, voices
+OBSIDIAN_SAVE_DIR = os.getenv("OBSIDIAN_SAVE_DIR","media-tg")#
+
+# Сообщения, пришедшие в одну заметку за столько секунд, дописываются одной записью
+NOTE_WRITE_WINDOW = float(os.getenv("NOTE_WRITE_WINDOW", 0.3))
+# Сбрасывать ли заметку на диск (fsync) перед ответом "✅": batch - да, off - нет
+NOTE_FSYNC = os.getenv("NOTE_FSYNC", "batch")
+
+# Конвейер обработки сообщений: сколько обработчиков на каждом этапе
+INGEST_FETCH_WORKERS = int(os.getenv("INGEST_FETCH_WORKERS", 4))   # скачивание медиа (плюс лимит MEDIA_DOWNLOADS)
+INGEST_RENDER_WORKERS = int(os.getenv("INGEST_RENDER_WORKERS", 1))   # сборка текста заметки
+INGEST_PERSIST_WORKERS = int(os.getenv("INGEST_PERSIST_WORKERS", 2))   # запись и ответ пользователю
+# Сколько сообщений может ждать в очереди каждого этапа, дальше приём притормаживает
+INGEST_QUEUE = int(os.getenv("INGEST_QUEUE", 100))
+
+# Журнал входящих сообщений (1 - включён): сообщение записывается на диск сразу при получении,
+# и если бот перезапустится во время скачивания, оно обработается после запуска
+INGEST_JOURNAL = int(os.getenv("INGEST_JOURNAL", 1))
+# Сколько часов помнить обработанные сообщения, чтобы не записать повторно присланное Telegram
+INGEST_JOURNAL_KEEP = float(os.getenv("INGEST_JOURNAL_KEEP", 24))
+
+# Ограничения на отправку сообщений ботом (Telegram блокирует на время при превышении):
+# сообщений в секунду всего и в один чат
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", 25))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", 1))
+# Однотипные сообщения (напоминания, "✅"), накопившиеся за столько секунд, уходят одним
+OUTBOUND_WINDOW = float(os.getenv("OUTBOUND_WINDOW", 0.5))
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (0 - не отдавать)
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Этап обработки дольше стольких секунд пишет в лог свой стек (0 - выключено)
+METRICS_SLOW_HANDLER = float(os.getenv("METRICS_SLOW_HANDLER", 0))
+
+# Сжатие сохранённых фото в отдельных процессах (1 - включено, нужен Pillow)
+MEDIA_OPTIMIZE = int(os.getenv("MEDIA_OPTIMIZE", 0))
+MEDIA_OPTIMIZE_FORMAT = os.getenv("MEDIA_OPTIMIZE_FORMAT", "webp")   # webp или avif
+MEDIA_OPTIMIZE_MAX_SIZE = int(os.getenv("MEDIA_OPTIMIZE_MAX_SIZE", 2560))   # по длинной стороне, пикселей (0 - не уменьшать)
+MEDIA_OPTIMIZE_QUALITY = int(os.getenv("MEDIA_OPTIMIZE_QUALITY", 80))   # 1-100
+MEDIA_OPTIMIZE_WORKERS = int(os.getenv("MEDIA_OPTIMIZE_WORKERS", 1))   # процессов сжатия
+# Удалять ли из сжатых фото EXIF (место съёмки, модель телефона и т.п.)
+MEDIA_STRIP_METADATA = int(os.getenv("MEDIA_STRIP_METADATA", 1))
+# Превью в заметке со ссылкой на полное фото (0 - без превью) и его размер, пикселей
+MEDIA_THUMBNAILS = int(os.getenv("MEDIA_THUMBNAILS", 1))
+MEDIA_THUMB_SIZE = int(os.getenv("MEDIA_THUMB_SIZE", 320))
+# Оригиналы: keep - оставить как есть (создаётся только превью), drop - заменить сжатой копией
+MEDIA_KEEP_ORIGINALS = os.getenv("MEDIA_KEEP_ORIGINALS", "keep")
+
+# Webhook вместо опроса: публичный адрес, на который Telegram будет присылать обновления
+# (пример: https://example.com/telegram). Пусто - бот сам опрашивает Telegram
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+# Где слушать запросы от Telegram (или от обратного прокси перед ботом)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+# Секрет, который Telegram присылает в каждом запросе. Пусто - случайный при каждом запуске
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Сколько секунд при остановке ждать обработчики, которые уже начали работу
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", 30))
+
+# Свой сервер Bot API (telegram-bot-api). Пусто - обычный api.telegram.org.
+# Пример: http://localhost:8081
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+# Сервер запущен с --local (1 - да): файлы до 2GB берутся прямо с его диска, без скачивания
+BOT_API_LOCAL = int(os.getenv("BOT_API_LOCAL", 0))
+# Если сервер в другом контейнере: его папка --dir и где эта папка видна боту.
+# Пример: /var/lib/telegram-bot-api и /tg-bot-api
+BOT_API_DIR = os.getenv("BOT_API_DIR", "")
+BOT_API_MOUNT = os.getenv("BOT_API_MOUNT", "")
+# Можно ли забирать файлы из папки сервера (1 - да), если ссылку на них создать не удалось.
+# Сервер скачает файл заново, если он понадобится ещё раз
+BOT_API_MOVE_FILES = int(os.getenv("BOT_API_MOVE_FILES", 1))
+
+# сколько файлов скачивать из телеграма одновременно (на все чаты сразу)
+MEDIA_DOWNLOADS = int(os.getenv("MEDIA_DOWNLOADS", 4))
+# сколько раз повторять оборвавшуюся загрузку (докачивается с места обрыва)
+MEDIA_DOWNLOAD_RETRIES = int(os.getenv("MEDIA_DOWNLOAD_RETRIES", 3))
+# через сколько секунд без новых данных считать загрузку оборвавшейся
+MEDIA_STALL_TIMEOUT = int(os.getenv("MEDIA_STALL_TIMEOUT", 60))
+# альбом сохраняется через столько секунд после последнего файла (или сразу, когда пришли все 10)
+MEDIA_GROUP_WAIT = float(os.getenv("MEDIA_GROUP_WAIT", 1.5))
+# но не позже, чем через столько секунд после первого файла
+MEDIA_GROUP_TTL = float(os.getenv("MEDIA_GROUP_TTL", 30))
+# сколько альбомов собирать одновременно, при переполнении самый старый сохраняется досрочно
+MEDIA_GROUP_MAX = int(os.getenv("MEDIA_GROUP_MAX", 100))
+
+# Как следить за изменениями в вальте: auto - inotify, а на сетевых дисках опрос;
+# inotify, poll - опрос раз в VAULT_WATCH_POLL секунд; off - не следить
+# (тогда авто-бэкап делается, даже если ничего не менялось)
+VAULT_WATCH = os.getenv("VAULT_WATCH", "auto")
+VAULT_WATCH_POLL = int(os.getenv("VAULT_WATCH_POLL", 60))
+# Сколько секунд тишины ждать после изменения файла (Syncthing пишет файлы сериями)
+VAULT_WATCH_DEBOUNCE = float(os.getenv("VAULT_WATCH_DEBOUNCE", 2))
+
+# Папка для служебных файлов бота (какие напоминания уже отправлены, журнал сообщений и т.п.).
+# Если оставить пустым - ~/.local/state/obsidian-tg-bot/<вальт>. Не кладите её внутрь вальта:
+# Syncthing будет гонять по устройствам живую базу SQLite и может её испортить
+STATE_DIR = os.getenv("STATE_DIR", "")
+
+# Папка/путь для хранения бэкапов Пример: /appdata/file/backups
+BACKUP_DIR = os.getenv("BACKUP_DIR","")  
+
+# Бэкапы
+BACKUP_AUTO_SAVE = int(os.getenv("BACKUP_AUTO_SAVE", 24))   # Периодичность бекапов в часах (0 - отключено)
+BACKUP_MAX_AGE = int(os.getenv("BACKUP_MAX_AGE", 7)) # Максимальный возраст файлов в днях
+BACKUP_MAX_COUNT = int(os.getenv("BACKUP_MAX_COUNT", 7))   # Максимальное количество хранимых бэкапов
+# Формат бэкапов: zip - зашифрованный ZIP-архив,
+# tar.zst - потоковый tar + zstd + AES-GCM (быстрее, распаковка: python restore.py),
+# chunks - хранилище с дедупликацией (одинаковые части файлов хранятся один раз)
+BACKUP_FORMAT = os.getenv("BACKUP_FORMAT", "zip")
+BACKUP_ZSTD_LEVEL = int(os.getenv("BACKUP_ZSTD_LEVEL", 3))   # Уровень сжатия zstd 1-19 для tar.zst
+# Инкрементальные бэкапы для zip и tar.zst (1 - включено): в архив пишутся только изменённые файлы,
+# полный бэкап создаётся раз в BACKUP_FULL_EVERY дельт
+BACKUP_INCREMENTAL = int(os.getenv("BACKUP_INCREMENTAL", 0))
+BACKUP_FULL_EVERY = int(os.getenv("BACKUP_FULL_EVERY", 6))
+# Что не класть в бэкап: правила в стиле .gitignore через запятую.
+# Дополнительно читается файл .backupignore из корня вальта. Проверить: /backup_dryrun
+BACKUP_EXCLUDE = [rule.strip() for rule in os.getenv(
+    "BACKUP_EXCLUDE",
+    ".obsidian/workspace*.json,.obsidian/cache/,.trash/,.stversions/,.stfolder/,"
+    ".syncthing.*.tmp,~syncthing~*.tmp,*.tmp,.DS_Store"
+).split(",") if rule.strip()]
+# Куда внутри вальта класть файлы, восстановленные командой /restore
+RESTORE_DIR = os.getenv("RESTORE_DIR", "restored")
+BACKUP_WORKERS = int(os.getenv("BACKUP_WORKERS", 0))   # Сколько процессов сжимают архив (0 - по числу ядер)
+BACKUP_COMPRESS_LEVEL = int(os.getenv("BACKUP_COMPRESS_LEVEL", 9))   # Уровень сжатия 0-9 (медиа не сжимаются)
+ADMIN_CHAT_ID = 123456789  # ID чата для уведомлений (можно получить в любом боте)
@@ -1,191 +1,351 @@
-from aiogram import types
-from aiogram.filters import Command
-
-
-import os
-from pathlib import Path
-from datetime import datetime
-from aiogram import Router, types
-from aiogram.types import InputFile
-from aiogram.filters import Command
-from aiogram import Bot  # Добавьте этот импорт
-import config
-import logging
-import asyncio
-import pyzipper  
-from typing import Optional
-
-
-logger = logging.getLogger(__name__)
-backup_router = Router()
-
-
-async def create_zip_with_password(input_dir: Path, output_zip: Path, password: str):
-    """Создает ZIP-архив с полным шифрованием (AES-256)"""
-    try:
-        with pyzipper.AESZipFile(
-            output_zip, 
-            'w', 
-            compression=pyzipper.ZIP_DEFLATED,
-            encryption=pyzipper.WZ_AES,
-            compresslevel=9,
-        ) as zipf:
-            zipf.setpassword(password.encode('utf-8'))
-            zipf.key_size = 256
-            # Включаем шифрование имен файлов и структуры каталогов
-            zipf.encrypt_names = True
-            
-            for root, dirs, files in os.walk(input_dir):
-                for file in files:
-                    file_path = Path(root) / file
-                    # Шифруем пути относительно корневой директории
-                    arcname = file_path.relative_to(input_dir).as_posix()
-                    zipf.write(file_path, arcname=arcname)
-                    
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка при создании архива: {str(e)}")
-        return False
-
-
-
-async def handle_backup(message: types.Message, bot: Bot):
-    try:
-        if not os.path.exists(config.OBSIDIAN_PATH):
-            await message.answer("❌ Директория для резервного копирования не найдена!")
-            return
-
-        if not config.BACKUP_PASSWORD:
-            await message.answer("❌ Пароль для архива не установлен в конфиге!")
-            return
-
-        # Создаем папку для бэкапов
-        backup_dir = Path(config.BACKUP_DIR)
-        backup_dir.mkdir(parents=True, exist_ok=True)
-        
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        zip_filename = backup_dir / f"obsidian_backup_{timestamp}.zip"
-        
-        await message.answer("⏳ Начинаю создание резервной копии... Это может занять некоторое время.")
-        
-        success = await create_zip_with_password(
-            input_dir=Path(config.OBSIDIAN_PATH),
-            output_zip=zip_filename, 
-            password=config.BACKUP_PASSWORD
-        )
-        
-        if not success:
-            await message.answer("❌ Не удалось создать архив!")
-            return
-            
-        await message.answer("✅ Резервная копия успешно создана!")
-
-    except Exception as e:
-        logger.error(f"Ошибка в обработчике backup: {str(e)}", exc_info=True)
-        await message.answer(f"❌ Произошла ошибка: {str(e)}")
-
-
-async def auto_save_backups(bot: Bot):
-    """Автоматическое создание резервных копий по расписанию"""
-    while True:
-        try:
-            if not config.BACKUP_AUTO_SAVE or config.BACKUP_AUTO_SAVE <= 0:
-                await asyncio.sleep(3600)  # Проверяем каждые час, если автосохранение выключено
-                continue
-
-            interval = config.BACKUP_AUTO_SAVE * 3600  # Конвертируем часы в секунды
-            await asyncio.sleep(interval)
-
-            if not os.path.exists(config.OBSIDIAN_PATH):
-                logger.error("Авто-бэкап: директория Obsidian не найдена!")
-                continue
-
-            # Создаем имя файла с временем бэкапа
-            backup_dir = Path(config.BACKUP_DIR)
-            backup_dir.mkdir(parents=True, exist_ok=True)
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            zip_filename = backup_dir / f"auto_backup_{timestamp}.zip"
-
-            # Создаем архив
-            success = await create_zip_with_password(
-                input_dir=Path(config.OBSIDIAN_PATH),
-                output_zip=zip_filename, 
-                password=config.BACKUP_PASSWORD
-            )
-
-            # Отправляем уведомление
-            if success:
-                msg = f"✅ Автоматический бэкап создан: {timestamp}"
-                await bot.send_message(config.ADMIN_CHAT_ID, msg)
-                logger.info(msg)
-                
-                # Вызываем очистку после каждого успешного бэкапа
-                await cleanup_backups()
-            else:
-                await bot.send_message(config.ADMIN_CHAT_ID, "❌ Не удалось создать автоматический бэкап!")
-
-        except Exception as e:
-            logger.error(f"Ошибка в auto_save_backups: {str(e)}")
-            await asyncio.sleep(60)  # Пауза при ошибках
-
-# Модифицируем функцию очистки
-async def cleanup_backups():
-    try:
-        backup_dir = Path(config.BACKUP_DIR)
-        now = datetime.now()
-        backups = sorted(backup_dir.glob("*.zip"), key=os.path.getmtime)
-        
-        # Удаление по возрасту
-        if hasattr(config, 'BACKUP_MAX_AGE'):
-            for file in backups:
-                file_time = datetime.fromtimestamp(file.stat().st_mtime)
-                if (now - file_time).days > config.BACKUP_MAX_AGE:
-                    file.unlink()
-                    
-        # Удаление по количеству (если задано)
-        if hasattr(config, 'BACKUP_MAX_COUNT'):
-            while len(backups) > config.BACKUP_MAX_COUNT:
-                oldest = backups.pop(0)
-                oldest.unlink()
-                
-    except Exception as e:
-        logger.error(f"Ошибка очистки бэкапов: {str(e)}")
-
-def register_backup_handlers(dp):
-    dp.message.register(handle_backup, Command("backup"))
-
-
-
-from utils.reminder_utils import ReminderParser
-
-# Добавим в конец файла
-async def check_and_notify_reminders(bot: Bot):
-    parser = ReminderParser(Path(config.OBSIDIAN_PATH))
-    while True:
-        try:
-            events = parser.check_reminders()
-            for event in events:
-                await bot.send_message(
-                    config.ADMIN_CHAT_ID,
-                    f"🔔 Напоминание!\n\n{event}"
-                )
-            await asyncio.sleep(60)  # Проверка каждую минуту
-        except Exception as e:
-            logger.error(f"Reminder error: {str(e)}")
-            await asyncio.sleep(300)
-
-def register_reminder_handlers(dp):
-    dp.startup.register(start_reminder_checker)
-
-async def start_reminder_checker(bot: Bot):
-    asyncio.create_task(check_and_notify_reminders(bot))
-
-
-
-
-
-async def start_handler(message: types.Message):
-    await message.answer("📚 Бот для сохранения контента в Obsidian готов к работе!")
-
-def register_base_handlers(dp):
+from aiogram import types
+from aiogram.filters import Command, CommandObject
+
+
+import os
+import shlex
+from pathlib import Path
+from datetime import datetime
+from aiogram import Router, types
+from aiogram.types import InputFile
+from aiogram.filters import Command
+from aiogram import Bot  # Добавьте этот импорт
+import config
+import logging
+import asyncio
+from typing import Optional, Dict, Any
+from utils.backup_utils import BackupCancelled, list_backups, vault_filter
+from utils.restore_utils import restore_backup
+from utils.outbound import HIGH, outbound
+from utils.backup_runner import (
+    run_backup_job, run_cleanup_job, run_dry_run_job, run_worker_job, cancel_backup, is_backup_running, format_progress,
+)
+
+
+logger = logging.getLogger(__name__)
+backup_router = Router()
+
+
+def backup_settings() -> Dict[str, Any]:
+    return {
+        'obsidian_path': config.OBSIDIAN_PATH,
+        'backup_dir': config.BACKUP_DIR,
+        'password': config.BACKUP_PASSWORD,
+        'format': config.BACKUP_FORMAT,
+        'incremental': bool(config.BACKUP_INCREMENTAL),
+        'full_every': config.BACKUP_FULL_EVERY,
+        'workers': config.BACKUP_WORKERS,
+        'level': config.BACKUP_COMPRESS_LEVEL,
+        'zstd_level': config.BACKUP_ZSTD_LEVEL,
+        'max_age': getattr(config, 'BACKUP_MAX_AGE', None),
+        'max_count': getattr(config, 'BACKUP_MAX_COUNT', None),
+        # Служебные файлы бота (если STATE_DIR внутри вальта) в бэкап не кладём
+        'exclude': config.BACKUP_EXCLUDE + state_exclude_rules(),
+    }
+
+
+async def make_backup(prefix: str, on_progress=None) -> Optional[Dict[str, Any]]:
+    """Создает полный или инкрементальный бэкап вальта в отдельном процессе.
+
+    Возвращает план бэкапа (см. run_backup) или None при ошибке.
+    При отмене пробрасывает BackupCancelled.
+    """
+    try:
+        return await run_backup_job(backup_settings(), prefix, on_progress)
+    except BackupCancelled:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при создании архива: {str(e)}")
+        return None
+
+
+def describe_backup(plan: Dict[str, Any]) -> str:
+    if plan['kind'] == 'snapshot':
+        return (f"снимок {plan['archive'].stem}: новых кусков {plan['new_chunks']}, "
+                f"{plan['new_bytes'] / 1024 / 1024:.1f} МБ")
+    if plan['kind'] == 'delta':
+        return (f"дельта {plan['archive'].name}: изменено {plan['files_count']}, "
+                f"удалено {len(plan['deleted'])}")
+    return f"полный {plan['archive'].name}"
+
+
+async def handle_backup(message: types.Message, bot: Bot):
+    try:
+        if not os.path.exists(config.OBSIDIAN_PATH):
+            await message.answer("❌ Директория для резервного копирования не найдена!")
+            return
+
+        if not config.BACKUP_PASSWORD:
+            await message.answer("❌ Пароль для архива не установлен в конфиге!")
+            return
+
+        if is_backup_running():
+            await message.answer("⏳ Бэкап уже выполняется, новый будет запущен после него. Отмена: /backup_cancel")
+
+        status = await message.answer("⏳ Начинаю создание резервной копии... Это может занять некоторое время.")
+        last_edit = {'text': status.text, 'time': 0.0}
+
+        async def show_progress(state):
+            # Telegram ограничивает частоту редактирования, обновляем не чаще раза в 3 секунды
+            text = format_progress(state)
+            now = asyncio.get_running_loop().time()
+            if text != last_edit['text'] and now - last_edit['time'] >= 3:
+                last_edit.update(text=text, time=now)
+                await status.edit_text(text)
+
+        try:
+            plan = await make_backup("obsidian_backup", show_progress)
+        except BackupCancelled:
+            await status.edit_text("🛑 Создание резервной копии отменено, недописанный архив удалён.")
+            return
+        
+        if not plan:
+            await status.edit_text("❌ Не удалось создать архив!")
+            return
+
+        if plan['skipped']:
+            await status.edit_text("ℹ️ Изменений с прошлого бэкапа нет, архив не создан.")
+            return
+            
+        await status.edit_text(f"✅ Резервная копия успешно создана! ({describe_backup(plan)})")
+
+    except Exception as e:
+        logger.error(f"Ошибка в обработчике backup: {str(e)}", exc_info=True)
+        await message.answer(f"❌ Произошла ошибка: {str(e)}")
+
+
+async def handle_backup_dryrun(message: types.Message):
+    """Показывает, сколько файлов и места экономит каждое правило исключения"""
+    try:
+        if not os.path.exists(config.OBSIDIAN_PATH):
+            await message.answer("❌ Директория для резервного копирования не найдена!")
+            return
+        stats = await run_dry_run_job(backup_settings())
+        included = stats.pop('')
+        lines = ["🔍 Пробный прогон правил бэкапа:"]
+        for rule, stat in stats.items():
+            lines.append(f"• {rule}: {stat['files']} файлов, {stat['bytes'] / 1024 / 1024:.1f} МБ")
+        saved_files = sum(stat['files'] for stat in stats.values())
+        saved_bytes = sum(stat['bytes'] for stat in stats.values())
+        lines.append(f"\nИсключено: {saved_files} файлов, {saved_bytes / 1024 / 1024:.1f} МБ")
+        lines.append(f"В бэкап попадёт: {included['files']} файлов, "
+                     f"{included['bytes'] / 1024 / 1024:.1f} МБ")
+        await message.answer("\n".join(lines))
+    except Exception as e:
+        logger.error(f"Ошибка в обработчике backup_dryrun: {str(e)}", exc_info=True)
+        await message.answer(f"❌ Произошла ошибка: {str(e)}")
+
+
+def find_backup(backups, query: Optional[str]):
+    """Бэкап по имени или его части; без запроса - самый свежий"""
+    if not query:
+        return backups[0] if backups else None
+    for backup in backups:
+        if backup['name'] == query or query in backup['name']:
+            return backup
+    return None
+
+
+async def handle_backups(message: types.Message):
+    """Список бэкапов без открытия архивов"""
+    try:
+        backups = list_backups(backup_settings())
+        if not backups:
+            await message.answer("ℹ️ Бэкапов пока нет.")
+            return
+        kinds = {'full': 'полный', 'delta': 'дельта', 'snapshot': 'снимок'}
+        lines = ["🗄 Бэкапы (от новых к старым):"]
+        for backup in backups[:30]:
+            created = datetime.fromtimestamp(backup['created']).strftime('%d.%m.%Y %H:%M')
+            files = f", {backup['files']} файлов" if backup['files'] is not None else ""
+            lines.append(f"• {backup['name']} — {kinds.get(backup['kind'], backup['kind'])}, "
+                         f"{created}, {backup['size'] / 1024 / 1024:.1f} МБ{files}")
+        await message.answer("\n".join(lines))
+    except Exception as e:
+        logger.error(f"Ошибка в обработчике backups: {str(e)}", exc_info=True)
+        await message.answer(f"❌ Произошла ошибка: {str(e)}")
+
+
+async def handle_restore(message: types.Message, command: CommandObject):
+    """/restore <путь> [бэкап] - восстанавливает файл или папку в RESTORE_DIR вальта"""
+    try:
+        # Пути с пробелами берутся в кавычки: /restore "Планы на год.md"
+        args = shlex.split(command.args or "")
+        if not args:
+            await message.answer("ℹ️ Использование: /restore <путь в вальте> [бэкап]\nСписок бэкапов: /backups")
+            return
+        path = args[0].strip('/')
+        backup = find_backup(list_backups(backup_settings()), args[1] if len(args) > 1 else None)
+        if not backup:
+            await message.answer("❌ Бэкап не найден. Список: /backups")
+            return
+
+        target = Path(config.OBSIDIAN_PATH) / config.RESTORE_DIR / backup['name'].split('.')[0]
+        status = await message.answer(f"⏳ Восстанавливаю {path} из {backup['name']}...")
+        restored = await run_worker_job(
+            restore_backup, Path(config.BACKUP_DIR), backup['name'],
+            config.BACKUP_PASSWORD, target, [path])
+        if not restored:
+            await status.edit_text(f"⚠️ В бэкапе {backup['name']} нет {path}")
+            return
+        await status.edit_text(
+            f"✅ Восстановлено файлов: {restored}\n"
+            f"📁 {(Path(config.RESTORE_DIR) / target.name / path).as_posix()}")
+    except Exception as e:
+        logger.error(f"Ошибка в обработчике restore: {str(e)}", exc_info=True)
+        await message.answer(f"❌ Произошла ошибка: {str(e)}")
+
+
+async def handle_backup_cancel(message: types.Message):
+    if cancel_backup():
+        await message.answer("🛑 Останавливаю создание резервной копии...")
+    else:
+        await message.answer("ℹ️ Сейчас бэкап не выполняется.")
+
+
+async def auto_save_backups(bot: Bot):
+    """Автоматическое создание резервных копий по расписанию.
+    Если за вальтом следит vault_watcher, бэкап без изменений в вальте пропускается"""
+    changes = vault_watcher.subscribe() if vault_watcher else None
+    if changes:
+        # Что менялось до запуска бота, неизвестно
+        changes.put([ANY])
+    while True:
+        try:
+            if not config.BACKUP_AUTO_SAVE or config.BACKUP_AUTO_SAVE <= 0:
+                await asyncio.sleep(3600)  # Проверяем каждые час, если автосохранение выключено
+                continue
+
+            interval = config.BACKUP_AUTO_SAVE * 3600  # Конвертируем часы в секунды
+            await asyncio.sleep(interval)
+
+            if not os.path.exists(config.OBSIDIAN_PATH):
+                logger.error("Авто-бэкап: директория Obsidian не найдена!")
+                continue
+
+            changed = None
+            if changes and vault_watcher.running:
+                changed = changes.take()
+                if not changed:
+                    logger.info("Авто-бэкап: с прошлого бэкапа в вальте ничего не изменилось")
+                    continue
+
+            # Создаем архив
+            try:
+                plan = await make_backup("auto_backup")
+            except BackupCancelled:
+                if changed:
+                    changes.put(changed)
+                await outbound.send(bot, config.ADMIN_CHAT_ID, "🛑 Автоматический бэкап отменён")
+                continue
+            if not plan and changed:
+                # Не получилось - изменения попадут в следующий бэкап
+                changes.put(changed)
+
+            # Отправляем уведомление
+            if plan and plan['skipped']:
+                continue
+            if plan:
+                msg = f"✅ Автоматический бэкап создан: {describe_backup(plan)}"
+                await outbound.send(bot, config.ADMIN_CHAT_ID, msg)
+                logger.info(msg)
+                
+                # Вызываем очистку после каждого успешного бэкапа
+                await cleanup_backups()
+            else:
+                await outbound.send(bot, config.ADMIN_CHAT_ID, "❌ Не удалось создать автоматический бэкап!")
+
+        except Exception as e:
+            logger.error(f"Ошибка в auto_save_backups: {str(e)}")
+            await asyncio.sleep(60)  # Пауза при ошибках
+
+# Модифицируем функцию очистки
+async def cleanup_backups():
+    """Удаляет старые бэкапы. Полный архив и его дельты удаляются только вместе,
+    из хранилища с дедупликацией удаляются снимки и ненужные куски"""
+    try:
+        removed = await run_cleanup_job(backup_settings())
+        if removed:
+            logger.info(f"Удалены старые бэкапы: {', '.join(removed)}")
+    except Exception as e:
+        logger.error(f"Ошибка очистки бэкапов: {str(e)}")
+
+def register_backup_handlers(dp):
+    dp.message.register(handle_backup, Command("backup"))
+    dp.message.register(handle_backup_cancel, Command("backup_cancel"))
+    dp.message.register(handle_backup_dryrun, Command("backup_dryrun"))
+    dp.message.register(handle_backups, Command("backups"))
+    dp.message.register(handle_restore, Command("restore"))
+
+
+
+from utils.reminder_utils import ReminderParser
+from utils.reminder_scheduler import ReminderScheduler
+from utils.file_utils import state_dir, state_exclude_rules
+from utils.vault_watcher import ANY, Subscription, VaultWatcher
+
+reminder_scheduler: Optional[ReminderScheduler] = None
+# Если файлы напоминаний отслеживает vault_watcher, плановая проверка нужна только на всякий случай
+WATCHED_RESCAN = 600
+
+
+async def watch_reminder_sources(scheduler: ReminderScheduler, changes: Subscription):
+    while True:
+        paths = await changes.get()
+        if ANY in paths or any(scheduler.parser.sources.covers(path) for path in paths):
+            scheduler.notify_changed()
+
+
+def merge_reminders(events) -> str:
+    if len(events) == 1:
+        return f"🔔 Напоминание!\n\n{events[0]}"
+    return "🔔 Напоминания!\n\n" + "\n".join(f"• {event}" for event in events)
+
+
+async def check_and_notify_reminders(bot: Bot):
+    global reminder_scheduler
+
+    async def send(event: str):
+        # Напоминания идут вне очереди ответов; наступившие одновременно - одним сообщением
+        await outbound.send(bot, config.ADMIN_CHAT_ID, event, priority=HIGH,
+                            group='reminder', merge=merge_reminders)
+
+    reminder_scheduler = ReminderScheduler(
+        ReminderParser(Path(config.OBSIDIAN_PATH), ledger_path=state_dir() / "sent_reminders.bin"), send,
+        grace=config.REMINDER_GRACE * 60, rescan=config.REMINDER_RESCAN,
+    )
+    if vault_watcher:
+        reminder_scheduler.rescan = max(config.REMINDER_RESCAN, WATCHED_RESCAN)
+        asyncio.create_task(watch_reminder_sources(reminder_scheduler, vault_watcher.subscribe()))
+    await reminder_scheduler.run()
+
+def register_reminder_handlers(dp):
+    dp.startup.register(start_reminder_checker)
+
+vault_watcher: Optional[VaultWatcher] = None
+
+
+def start_vault_watcher():
+    """Запускает слежение за вальтом. Вызывать до запуска фоновых задач, которые на него подписываются"""
+    global vault_watcher
+    if config.VAULT_WATCH == 'off' or not os.path.isdir(config.OBSIDIAN_PATH):
+        return
+    # Служебные файлы бота меняются сами по себе - исключены в backup_settings
+    settings = backup_settings()
+    vault = Path(config.OBSIDIAN_PATH).resolve()
+    vault_watcher = VaultWatcher(vault, vault_filter(settings), config.VAULT_WATCH,
+                                 debounce=config.VAULT_WATCH_DEBOUNCE, poll=config.VAULT_WATCH_POLL)
+    asyncio.create_task(vault_watcher.run())
+
+async def start_reminder_checker(bot: Bot):
+    asyncio.create_task(check_and_notify_reminders(bot))
+
+
+
+
+
+async def start_handler(message: types.Message):
+    await message.answer("📚 Бот для сохранения контента в Obsidian готов к работе!")
+
+def register_base_handlers(dp):
     dp.message.register(start_handler, Command("start"))
\ No newline at end of file
@@ -1,144 +1,337 @@
 from aiogram import types, Bot
+from aiogram.filters import Command
 from datetime import datetime
-import asyncio
 from pathlib import Path
+from typing import Optional
+import asyncio
 import logging
+import time
 
 
-from utils.media_utils import download_file, process_media_group
-from utils.file_utils import ensure_dirs_exist
-from utils.note_utils import append_to_note
+from utils.media_utils import process_media_group, save_media
+from utils.media_groups import MediaGroupCollector
+from utils.file_utils import ensure_dirs_exist, state_dir, sweep_downloads
+from utils.note_utils import format_entry, note_writer
+from utils.ingest_pipeline import IngestPipeline, describe_pipeline
+from utils.ingest_journal import IngestJournal
+from utils.media_optimizer import QUEUE_NAME, MediaOptimizer
+from utils.outbound import outbound
+from utils.metrics import INGEST_SECONDS, REGISTRY
 from config import OBSIDIAN_PATH, OBSIDIAN_SAVE_DIR, OBSIDIAN_SAVE_IMAGE, OBSIDIAN_NAME_MD, OBSIDIAN_FORMAT_DATA
+import config
 
 logger = logging.getLogger(__name__)
-media_group_data = {}
+
+JOURNAL_NAME = "ingest.sqlite3"
+
+def _log_send_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Reply error: {future.exception()}")
+
+def reply(message: types.Message, text: str, group: str = 'status'):
+    """Ответ о ходе сохранения через общую очередь отправки: обработка его не ждёт,
+    а несколько ответов подряд уходят одним сообщением"""
+    outbound.post(message.bot, message.chat.id, text, group=group).add_done_callback(_log_send_error)
 
 async def send_progress(bot: Bot, chat_id: int, text: str):
-    try:
-        await bot.send_message(chat_id, text)
-    except Exception as e:
-        logger.error(f"Progress message error: {e}")
+    outbound.post(bot, chat_id, text, group='progress').add_done_callback(_log_send_error)
 
-async def handle_message(message: types.Message, bot: Bot):
-    try:
-        logger.debug(f"New message received: {message.message_id}")
-        
-        # Prepare paths
-        obsidian_path = Path(OBSIDIAN_PATH)
-        media_dir = obsidian_path / Path(OBSIDIAN_SAVE_IMAGE) / OBSIDIAN_SAVE_DIR
-        
+# Папки для медиа создаются один раз, а не на каждое сообщение
+_ready_dirs = set()
+
+async def prepare_paths(message: types.Message):
+    """Папка для медиа и файл заметки"""
+    obsidian_path = Path(OBSIDIAN_PATH)
+    media_dir = obsidian_path / Path(OBSIDIAN_SAVE_IMAGE) / OBSIDIAN_SAVE_DIR
+    
+    if media_dir not in _ready_dirs:
         try:
             ensure_dirs_exist(media_dir)
+            _ready_dirs.add(media_dir)
             logger.debug(f"Directories verified: {media_dir}")
         except Exception as e:
-            await message.answer(f"❌ Ошибка создания папок: {str(e)}")
+            reply(message, f"❌ Ошибка создания папок: {str(e)}")
             raise
 
-        # Create note path
-        note_path = obsidian_path / (OBSIDIAN_NAME_MD if OBSIDIAN_NAME_MD 
-                      else f"{datetime.now().strftime(OBSIDIAN_FORMAT_DATA)}.md")
-        logger.debug(f"Note path: {note_path}")
-
-        # Handle media groups
-        if message.media_group_id:
-            logger.debug(f"Media group detected: {message.media_group_id}")
-            
-            if message.media_group_id not in media_group_data:
-                media_group_data[message.media_group_id] = {
-                    'messages': [],
-                    'processed': False
-                }
-                await send_progress(bot, message.chat.id, "⏳ Обрабатываю альбом...")
-            
-            media_group_data[message.media_group_id]['messages'].append(message)
-            await asyncio.sleep(3)  # Wait for all group messages
-            
-            if not media_group_data[message.media_group_id]['processed']:
-                media_info = await process_media_group(
-                    message.media_group_id,
-                    media_dir,
-                    message.chat.id,
-                    media_group_data,
-                    bot
-                )
-                media_group_data[message.media_group_id]['processed'] = True
-            else:
-                return
+    # Create note path
+    note_path = obsidian_path / (OBSIDIAN_NAME_MD if OBSIDIAN_NAME_MD 
+                  else f"{datetime.now().strftime(OBSIDIAN_FORMAT_DATA)}.md")
+    logger.debug(f"Note path: {note_path}")
+    return media_dir, note_path
+
+async def fetch_single(message: types.Message, media_dir: Path, bot: Bot):
+    """Скачивает медиа одиночного сообщения"""
+    media_info = {
+        'text': message.caption or message.text or "",
+        'photos': [],
+        'videos': [],
+        'files': [],
+        'voices': [],
+        # Запись в заметке -> путь, который вернуло хранилище (может быть в другой папке)
+        'saved': {}
+    }
+    
+    if message.photo:
+        # обработка фото
+        file = message.photo[-1]
+        saved = await save_media(bot, file, media_dir / 'photos', "photo.jpg")
+        if saved:
+            media_info['photos'].append(f"{saved.name}")
+            media_info['saved'][saved.name] = saved
         else:
-            # Single message processing
-            logger.debug("Processing single message")
-            media_info = {
-                'text': message.caption or message.text or "",
-                'photos': [],
-                'videos': [],
-                'files': [],
-                'voices': []
-            }
-            
-            if message.photo:
-                # обработка фото
-                file = message.photo[-1]
-                filename = f"photo_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
-                full_path = media_dir / 'photos' / filename
-                await download_file(bot, file.file_id, full_path)
-                media_info['photos'].append(f"{filename}")
-            
-            elif message.voice:
-                # обработка голосовых сообщений
-                file = message.voice
-                filename = f"voice_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ogg"  # Голосовые сообщения в TG всегда в формате OGG
-                full_path = media_dir / 'voices' / filename
-                
-                try:
-                    await download_file(bot, file.file_id, full_path)
-                    media_info['voices'].append(f"{filename}")
-                    logger.info(f"Голосовое сообщение сохранено: {filename}")
-                except Exception as e:
-                    logger.error(f"Ошибка сохранения голосового сообщения: {str(e)}")
-                    await message.answer("⚠️ Не удалось сохранить голосовое сообщение")
-
-            elif message.video:
-                file = message.video
-                filename = f"video_{datetime.now().strftime('%Y%m%d_%H%M%S')}.mp4"
-                full_path = media_dir / 'videos' / filename
-                await download_file(bot, file.file_id, full_path)
-                media_info['videos'].append(f"{filename}")
-            
-            elif message.document:
-                file = message.document
-                # Сохраняем оригинальное имя файла или создаём своё
-                if file.file_name:
-                    filename = f"{file.file_name}"
-                else:
-                    filename = f"file_{datetime.now().strftime('%Y%m%d_%H%M%S')}.bin"
-                
-                full_path = media_dir / 'files' / filename
-                
-                try:
-                    await download_file(bot, file.file_id, full_path)
-                    media_info['files'].append(f"{filename}")
-                    logger.info(f"Документ сохранён: {filename}")
-                except Exception as e:
-                    logger.error(f"Ошибка сохранения документа: {str(e)}")
-                    await message.answer(f"⚠️ Не удалось сохранить документ: {str(e)}")
-
-
-        # Save to Obsidian
-        if media_info and (media_info['text'] or any(media_info.values())):
+            reply(message, "⚠️ Не удалось сохранить фото")
+    
+    elif message.voice:
+        # обработка голосовых сообщений
+        file = message.voice
+        # Голосовые сообщения в TG всегда в формате OGG
+        saved = await save_media(bot, file, media_dir / 'voices', "voice.ogg")
+        if saved:
+            media_info['voices'].append(f"{saved.name}")
+            media_info['saved'][saved.name] = saved
+            logger.info(f"Голосовое сообщение сохранено: {saved.name}")
+        else:
+            reply(message, "⚠️ Не удалось сохранить голосовое сообщение")
+
+    elif message.video:
+        file = message.video
+        saved = await save_media(bot, file, media_dir / 'videos', "video.mp4")
+        if saved:
+            media_info['videos'].append(f"{saved.name}")
+            media_info['saved'][saved.name] = saved
+        else:
+            reply(message, "⚠️ Не удалось сохранить видео")
+    
+    elif message.document:
+        file = message.document
+        # Сохраняем оригинальное имя файла (с хэшем содержимого) или создаём своё
+        filename = file.file_name or "file.bin"
+        saved = await save_media(bot, file, media_dir / 'files', filename)
+        if saved:
+            media_info['files'].append(f"{saved.name}")
+            media_info['saved'][saved.name] = saved
+            logger.info(f"Документ сохранён: {saved.name}")
+        else:
+            reply(message, f"⚠️ Не удалось сохранить документ: {filename}")
+    return media_info
+
+# --- этапы конвейера (см. utils/ingest_pipeline.py) ---
+
+async def fetch_stage(job):
+    """Пути и скачивание медиа"""
+    messages = job['messages']
+    job['media_dir'], job['note_path'] = await prepare_paths(messages[0])
+    if messages[0].media_group_id:
+        logger.debug(f"Processing media group {messages[0].media_group_id}")
+        job['media_info'] = await process_media_group(messages, job['media_dir'], job['bot'])
+    else:
+        logger.debug("Processing single message")
+        job['media_info'] = await fetch_single(messages[0], job['media_dir'], job['bot'])
+
+async def render_stage(job):
+    """Текст записи для заметки"""
+    media_info = job['media_info']
+    job['failed'] = media_info.pop('failed', []) if media_info else []
+    if media_info and (media_info['text'] or any(media_info.values())):
+        if optimizer is not None and media_info['photos']:
+            # Сразу в итоговом виде: превью появится после сжатия, заметку переписывать не придётся
+            media_info['embeds'] = {item: optimizer.embed(media_info['saved'][item])
+                                    for item in media_info['photos']}
+        job['content'] = format_entry(job['messages'][0], media_info)
+    else:
+        job['content'] = None
+
+async def persist_stage(job):
+    """Ставит запись в очередь заметки (по порядку сообщений в чате); ответ - после записи"""
+    message = job['messages'][0]
+    if job['error'] is not None:
+        reply(message, f"❌ Критическая ошибка: {str(job['error'])}")
+        await finish_job(job)
+        return None
+    if job['failed']:
+        reply(message, f"⚠️ Не удалось сохранить файлов: {len(job['failed'])} ({', '.join(job['failed'])})")
+    if job['content'] is None:
+        logger.warning("Нет данных для сохранения")
+        reply(message, "⚠️ Нет контента для сохранения")
+        await finish_job(job)
+        return None
+    return reply_when_written(job, note_writer.submit(job['note_path'], job['content']))
+
+async def reply_when_written(job, written):
+    message = job['messages'][0]
+    try:
+        await written
+        reply(message, "✅ Успешно сохранено!")
+        media_info = job['media_info']
+        if optimizer is not None and media_info['photos']:
+            # Сжатие - в других процессах и уже после ответа
+            optimizer.submit(job['note_path'], [(item, media_info['saved'][item]) for item in media_info['photos']])
+    except Exception as e:
+        logger.error(f"Ошибка записи заметки: {str(e)}")
+        reply(message, f"❌ Ошибка записи: {str(e)}")
+    await finish_job(job)
+
+async def finish_job(job):
+    """Отмечает сообщения задания выполненными в журнале: после перезапуска их не повторять"""
+    INGEST_SECONDS.observe(time.perf_counter() - job['accepted'], type=job['type'])
+    if journal is not None:
+        try:
+            await journal.mark_done(job['journal_ids'])
+        except Exception as e:
+            # Не страшно: после перезапуска сообщение запишется ещё раз
+            logger.error(f"Не удалось отметить сообщение в журнале: {str(e)}")
+
+ingest = IngestPipeline(
+    fetch_stage, render_stage, persist_stage,
+    workers={
+        'fetch': config.INGEST_FETCH_WORKERS,
+        'render': config.INGEST_RENDER_WORKERS,
+        'persist': config.INGEST_PERSIST_WORKERS,
+    },
+    queue_size=config.INGEST_QUEUE,
+)
+REGISTRY.gauge('bot_ingest_queue_depth', 'Сообщений в очереди этапа конвейера', ['stage'],
+               func=lambda: {(stage.name,): stage.queue.qsize() for stage in ingest.stages})
+REGISTRY.gauge('bot_ingest_busy', 'Занятых обработчиков этапа конвейера', ['stage'],
+               func=lambda: {(stage.name,): stage.busy for stage in ingest.stages})
+# Номер в очереди чата, занятый первым сообщением альбома
+album_seq = {}
+# Журнал входящих сообщений (None - INGEST_JOURNAL выключен)
+journal: Optional[IngestJournal] = None
+# Сжатие фото (MEDIA_OPTIMIZE), создаётся в start_ingest
+optimizer: Optional[MediaOptimizer] = None
+# Записи журнала сообщений, которые ещё не дошли до конвейера (альбомы собираются по одному)
+journal_ids = {}
+# Как часто удалять из журнала выполненные записи, секунд
+JOURNAL_COMPACT_EVERY = 600
+
+def new_job(messages, bot: Bot):
+    ids = [journal_ids.pop((msg.chat.id, msg.message_id), None) for msg in messages]
+    return {'chat_id': messages[0].chat.id, 'messages': messages, 'bot': bot,
+            'type': 'album' if len(messages) > 1 else messages[0].content_type,
+            'journal_ids': [journal_id for journal_id in ids if journal_id is not None]}
+
+async def save_album(messages, bot: Bot):
+    """Отдаёт собранный альбом в конвейер (сообщения уже по порядку message_id)"""
+    message = messages[0]
+    seq = album_seq.pop((message.chat.id, message.media_group_id), None)
+    await ingest.submit(new_job(messages, bot), seq)
+
+media_groups = MediaGroupCollector(
+    save_album,
+    quiet=config.MEDIA_GROUP_WAIT,
+    ttl=config.MEDIA_GROUP_TTL,
+    max_groups=config.MEDIA_GROUP_MAX,
+)
+
+async def accept(message: types.Message, bot: Bot, journal_id: Optional[int] = None):
+    """Отдаёт сообщение в конвейер ingest (сообщение альбома - в сборщик альбомов)"""
+    if journal_id is not None:
+        journal_ids[(message.chat.id, message.message_id)] = journal_id
+
+    # Handle media groups: альбом уходит в конвейер целиком, когда придут все его сообщения
+    if message.media_group_id:
+        logger.debug(f"Media group detected: {message.media_group_id}")
+        if media_groups.add(message, bot):
+            album_seq[(message.chat.id, message.media_group_id)] = ingest.reserve(message.chat.id)
+            await send_progress(bot, message.chat.id, "⏳ Обрабатываю альбом...")
+        return
+
+    await ingest.submit(new_job([message], bot))
+
+async def feed_journal(bot: Bot):
+    """Передаёт записи журнала в конвейер по порядку получения (при старте - и оставшиеся с прошлого запуска)"""
+    last_id = 0
+    while True:
+        journal.added.clear()
+        rows = await journal.pending(last_id)
+        if not rows:
+            await journal.added.wait()
+            continue
+        for journal_id, payload in rows:
+            last_id = journal_id
             try:
-                append_to_note(note_path, message, media_info)
-                await message.answer("✅ Успешно сохранено!")
+                message = types.Message.model_validate_json(payload).as_(bot)
             except Exception as e:
-                logger.error(f"Ошибка записи заметки: {str(e)}")
-                await message.answer(f"❌ Ошибка записи: {str(e)}")
-        else:
-            logger.warning("Нет данных для сохранения")
-            await message.answer("⚠️ Нет контента для сохранения")
+                logger.error(f"Испорченная запись журнала {journal_id}: {str(e)}")
+                await journal.mark_done([journal_id])
+                continue
+            try:
+                await accept(message, bot, journal_id)
+            except Exception as e:
+                logger.error(f"Ошибка обработки сообщения: {str(e)}", exc_info=True)
+
+async def compact_journal():
+    while True:
+        await asyncio.sleep(JOURNAL_COMPACT_EVERY)
+        try:
+            await journal.compact()
+        except Exception as e:
+            logger.error(f"Ошибка сжатия журнала сообщений: {str(e)}")
+
+async def handle_message(message: types.Message, bot: Bot):
+    """Приём сообщения. С журналом - только запись в него и короткое "принято":
+    обработчик сразу завершается, сообщение из журнала забирает feed_journal,
+    а "✅" придёт, когда запись окажется в заметке"""
+    try:
+        logger.debug(f"New message received: {message.message_id}")
+        if journal is None:
+            await accept(message, bot)
+        elif await journal.add(message.chat.id, message.message_id, message.model_dump_json(exclude_none=True)):
+            # Пачка подряд (или альбом) подтверждается одним сообщением "(×n)"
+            reply(message, "📥 Принято, сохраняю", group='accepted')
 
     except Exception as e:
         logger.error(f"Ошибка обработки сообщения: {str(e)}", exc_info=True)
         await message.answer(f"❌ Критическая ошибка: {str(e)}")
 
+async def handle_queue(message: types.Message):
+    text = describe_pipeline(ingest.snapshot())
+    if journal is not None:
+        text += f"\nВ журнале не обработано: {await journal.count_pending()}"
+    await message.answer(f"📊 Очередь сообщений\n\n{text}")
+
+_journal_tasks = []
+
+async def start_ingest(bot: Bot):
+    global journal, optimizer
+    ingest.start()
+    await asyncio.to_thread(sweep_downloads)
+    if config.MEDIA_OPTIMIZE:
+        optimizer = MediaOptimizer(
+            Path(OBSIDIAN_PATH), state_dir() / QUEUE_NAME,
+            fmt=config.MEDIA_OPTIMIZE_FORMAT, max_size=config.MEDIA_OPTIMIZE_MAX_SIZE,
+            quality=config.MEDIA_OPTIMIZE_QUALITY, strip_metadata=bool(config.MEDIA_STRIP_METADATA),
+            thumbnails=bool(config.MEDIA_THUMBNAILS), thumb_size=config.MEDIA_THUMB_SIZE,
+            keep=config.MEDIA_KEEP_ORIGINALS, workers=config.MEDIA_OPTIMIZE_WORKERS,
+        )
+        await optimizer.start()
+        if not optimizer.enabled:
+            optimizer = None
+    if not config.INGEST_JOURNAL:
+        return
+    journal = IngestJournal(state_dir() / JOURNAL_NAME, keep=config.INGEST_JOURNAL_KEEP * 3600)
+    pending = await journal.count_pending()
+    if pending:
+        logger.info(f"В журнале с прошлого запуска осталось сообщений: {pending}, обрабатываю")
+    _journal_tasks.extend([asyncio.create_task(feed_journal(bot)), asyncio.create_task(compact_journal())])
+
+async def stop_ingest():
+    # Не взятые из журнала сообщения обработаются при следующем запуске
+    for task in _journal_tasks:
+        task.cancel()
+    await asyncio.gather(*_journal_tasks, return_exceptions=True)
+    await ingest.stop()
+    if journal is not None:
+        await journal.close()
+    if optimizer is not None:
+        await optimizer.stop()
+    # Ответы из очереди отправки - пока сессия бота не закрыта
+    await outbound.drain()
+
 
 def register_media_handlers(dp):
+    dp.startup.register(start_ingest)
+    dp.shutdown.register(stop_ingest)
+    dp.message.register(handle_queue, Command("queue"))
     dp.message.register(handle_message)
@@ -1,32 +1,75 @@
 import asyncio
+import secrets
+from pathlib import Path
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import BareFilesPathWrapper, SimpleFilesPathWrapper, TelegramAPIServer
+import config
 from config import BOT_TOKEN
-from utils.file_utils import cleanup_media_groups
 from handlers.media_handler import register_media_handlers
 from handlers.base import register_base_handlers
 from handlers.base import register_backup_handlers
 import logging
 from handlers.base import cleanup_backups, auto_save_backups
 from handlers.base import register_reminder_handlers
+from handlers.base import start_vault_watcher
+from utils.note_utils import note_writer
+from utils.webhook_server import run_webhook
+from utils.metrics import handler_middleware, start_metrics_server, watch_loop_lag
 
 logging.basicConfig(level=logging.DEBUG)
 
 
 
+def create_session():
+    """Сессия для своего сервера Bot API (None - обычный api.telegram.org)"""
+    if not config.BOT_API_URL:
+        return None
+    wrapper = BareFilesPathWrapper()
+    if config.BOT_API_DIR and config.BOT_API_MOUNT:
+        # Пути к файлам на сервере переводятся в пути, видимые боту
+        wrapper = SimpleFilesPathWrapper(Path(config.BOT_API_DIR), Path(config.BOT_API_MOUNT))
+    api = TelegramAPIServer.from_base(config.BOT_API_URL, is_local=bool(config.BOT_API_LOCAL),
+                                      wrap_local_file=wrapper)
+    logging.info(f"Bot API: {config.BOT_API_URL}{' (--local)' if api.is_local else ''}")
+    return AiohttpSession(api=api)
+
+
 async def main():
-    bot = Bot(token=BOT_TOKEN)
+    bot = Bot(token=BOT_TOKEN, session=create_session())
     dp = Dispatcher()
 
     register_backup_handlers(dp)
     register_base_handlers(dp)
     register_media_handlers(dp)
     
+    start_vault_watcher()
     asyncio.create_task(cleanup_backups())
     asyncio.create_task(auto_save_backups(bot)) 
     register_reminder_handlers(dp)
-    asyncio.create_task(cleanup_media_groups())
-    
-    await dp.start_polling(bot)
+    dp.message.outer_middleware(handler_middleware)
+
+    loop_lag = asyncio.create_task(watch_loop_lag())
+    metrics_server = None
+    if config.METRICS_PORT:
+        metrics_server = await start_metrics_server(config.METRICS_HOST, config.METRICS_PORT)
+
+    try:
+        if config.WEBHOOK_URL:
+            # Без заданного секрета - случайный: он всё равно передаётся Telegram в set_webhook
+            await run_webhook(dp, bot, config.WEBHOOK_HOST, config.WEBHOOK_PORT, config.WEBHOOK_PATH,
+                              config.WEBHOOK_SECRET or secrets.token_urlsafe(32), url=config.WEBHOOK_URL,
+                              drain_timeout=config.WEBHOOK_DRAIN_TIMEOUT)
+        else:
+            # Webhook, оставшийся с прошлого запуска, мешает getUpdates
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        # Дописываем заметки, уже стоящие в очереди
+        await note_writer.drain()
+        loop_lag.cancel()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main())
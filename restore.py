@@ -0,0 +1,70 @@
+"""Восстановление бэкапов без бота (офлайн).
+
+Примеры:
+    python restore.py /backups/auto_backup_20250301_120000.zip /tmp/restore
+    python restore.py /backups/auto_backup_20250302_120000_delta.tar.zst.enc /tmp/restore
+    python restore.py /backups/chunkstore/snapshots/auto_backup_20250301_120000.snap /tmp/restore
+    python restore.py архив папка "Планы.md" "Проекты/"
+    python restore.py --list архив [папка_в_вальте]
+
+Пароль берётся из --password, переменной BACKUP_PASSWORD или config.py.
+Дельта-архив восстанавливается вместе со всей цепочкой до полного бэкапа.
+Если рядом с архивом лежит индекс (.idx), файлы читаются прямо по смещениям,
+без распаковки всего архива.
+"""
+import argparse
+import getpass
+import logging
+import os
+import sys
+from pathlib import Path
+
+from utils.chunk_store import SNAPSHOT_SUFFIX
+from utils.crypto_utils import DecryptionError
+from utils.restore_utils import list_backup_files, restore_archive, restore_backup
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Восстановление бэкапа вальта")
+    parser.add_argument('archive', type=Path, help="архив (.zip, .tar.zst.enc) или снимок (.snap)")
+    parser.add_argument('target', nargs='?', type=Path, help="куда распаковать")
+    parser.add_argument('paths', nargs='*', help="только эти файлы или папки")
+    parser.add_argument('--list', action='store_true',
+                        help="показать содержимое по индексу (вместо target - папка в вальте)")
+    parser.add_argument('--password', help="пароль бэкапов (по умолчанию BACKUP_PASSWORD)")
+    parser.add_argument('--single', action='store_true',
+                        help="распаковать только этот архив, без цепочки дельт")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    password = args.password or os.getenv("BACKUP_PASSWORD")
+    if not password:
+        import config
+        password = config.BACKUP_PASSWORD or getpass.getpass("Пароль бэкапа: ")
+
+    is_snapshot = args.archive.name.endswith(SNAPSHOT_SUFFIX)
+    # Снимки лежат в <папка бэкапов>/chunkstore/snapshots
+    backup_dir = args.archive.parents[2] if is_snapshot else args.archive.parent
+    try:
+        if args.list:
+            prefixes = [str(args.target)] + args.paths if args.target else None
+            for entry in list_backup_files(backup_dir, args.archive.name,
+                                           password, prefixes):
+                print(f"{entry['size']:>12}  {entry['path']}")
+            return
+        if args.target is None:
+            parser.error("не указана папка для восстановления")
+        if args.single or is_snapshot:
+            restored = restore_archive(args.archive, password, args.target, args.paths)
+        else:
+            restored = restore_backup(backup_dir, args.archive.name,
+                                      password, args.target, args.paths)
+    except (DecryptionError, RuntimeError, FileNotFoundError) as e:
+        # pyzipper сообщает о неверном пароле через RuntimeError
+        print(f"❌ {str(e)}", file=sys.stderr)
+        sys.exit(1)
+    print(f"✅ Восстановлено файлов: {restored}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Хранилище кусков: снимок и восстановление, файлы с ошибкой чтения"""
+import builtins
+import os
+
+import utils.chunk_store as chunk_store
+from utils.chunk_store import ChunkStore, backup_to_store, restore_from_store
+
+
+def make_vault(tmp_path):
+    vault = tmp_path / 'vault'
+    vault.mkdir()
+    (vault / 'a.md').write_text("первая заметка\n" * 100)
+    (vault / 'big.pdf').write_bytes(os.urandom(3 * 1024 * 1024))
+    return vault
+
+
+def snapshot(store, vault, name):
+    files = sorted(p.relative_to(vault).as_posix() for p in vault.rglob('*') if p.is_file())
+    plan = backup_to_store(store, vault, files, name)
+    return plan, store.load_snapshot(plan['archive'])['files']
+
+
+def test_round_trip(tmp_path):
+    vault = make_vault(tmp_path)
+    store = ChunkStore(tmp_path / 'store', 'pw')
+    plan, _ = snapshot(store, vault, 's1')
+    assert plan['damaged'] == []
+    target = tmp_path / 'restored'
+    assert restore_from_store(store, plan['archive'], target) == 2
+    for name in ('a.md', 'big.pdf'):
+        assert (target / name).read_bytes() == (vault / name).read_bytes()
+
+
+def test_unreadable_file_keeps_previous_version(tmp_path, monkeypatch):
+    vault = make_vault(tmp_path)
+    store = ChunkStore(tmp_path / 'store', 'pw')
+    snapshot(store, vault, 's1')
+    first = (vault / 'a.md').read_bytes()
+    (vault / 'a.md').write_text("исправленная заметка\n")
+    (vault / 'new.md').write_text("новая\n")
+
+    def locked_open(path, *args, **kwargs):
+        if str(path).endswith(('a.md', 'new.md')):
+            raise PermissionError(13, "Permission denied", str(path))
+        return builtins.open(path, *args, **kwargs)
+
+    monkeypatch.setattr(chunk_store, 'open', locked_open, raising=False)
+    plan, files = snapshot(store, vault, 's2')
+    monkeypatch.undo()
+    assert sorted(plan['damaged']) == ['a.md', 'new.md']
+    assert sorted(files) == ['a.md', 'big.pdf']
+    target = tmp_path / 'restored'
+    restore_from_store(store, plan['archive'], target)
+    assert (target / 'a.md').read_bytes() == first
+
+    # Следующий снимок перечитывает оба файла
+    plan, files = snapshot(store, vault, 's3')
+    assert plan['damaged'] == []
+    assert sorted(files) == ['a.md', 'big.pdf', 'new.md']
+
+
+def test_file_changed_while_reading(tmp_path, monkeypatch):
+    vault = make_vault(tmp_path)
+    store = ChunkStore(tmp_path / 'store', 'pw')
+    original = chunk_store.iter_chunks
+
+    def growing(path):
+        for chunk in original(path):
+            yield chunk
+            if path.name == 'big.pdf':
+                # Syncthing дописывает файл, пока он режется на куски
+                with open(path, 'ab') as f:
+                    f.write(b'x' * 10)
+
+    monkeypatch.setattr(chunk_store, 'iter_chunks', growing)
+    plan, files = snapshot(store, vault, 's1')
+    assert plan['damaged'] == ['big.pdf']
+    assert sorted(files) == ['a.md']
@@ -0,0 +1,56 @@
+"""Докачка по HTTP: обрыв посреди файла, повтор с Range с того места, где остановились"""
+import asyncio
+import os
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+import config
+from bench.fake_bot_api import FakeBotAPI
+from utils.media_utils import WRITE_BUFFER, download_file
+
+DATA = os.urandom(3 * WRITE_BUFFER)
+# Не кратно WRITE_BUFFER: часть полученного лежит в буфере и пишется только при обрыве
+CUT = WRITE_BUFFER + WRITE_BUFFER // 2 + 123
+
+
+class FlakyBotAPI(FakeBotAPI):
+    """Первый запрос файла обрывается после CUT байт"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ranges = []
+
+    async def _file(self, request: web.Request) -> web.StreamResponse:
+        self.ranges.append(request.headers.get('Range'))
+        if len(self.ranges) > 1:
+            return await super()._file(request)
+        resp = web.StreamResponse(headers={'Content-Length': str(len(DATA))})
+        await resp.prepare(request)
+        await resp.write(DATA[:CUT])
+        request.transport.close()
+        return resp
+
+
+def test_resume_after_drop(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'MEDIA_DOWNLOAD_RETRIES', 2)
+
+    async def scenario():
+        server = FlakyBotAPI(tmp_path / 'api', local=False)
+        file_id = server.add_file(DATA, 'documents/file_1.bin')
+        url = await server.start()
+        bot = Bot(server.token, session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+        try:
+            ok = await download_file(bot, file_id, tmp_path / 'vault' / 'file.bin')
+        finally:
+            await bot.session.close()
+            await server.stop()
+        return ok, server.ranges
+
+    ok, ranges = asyncio.run(scenario())
+    assert ok
+    # Всё полученное до обрыва записано, включая недописанный буфер
+    assert ranges == [None, f"bytes={CUT}-"]
+    assert (tmp_path / 'vault' / 'file.bin').read_bytes() == DATA
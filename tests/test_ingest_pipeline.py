@@ -0,0 +1,63 @@
+"""Порядок записи сообщений чата в конвейере при неупорядоченном скачивании"""
+import asyncio
+
+from utils.ingest_pipeline import IngestPipeline
+
+
+def make_pipeline(persisted, workers=None):
+    async def fetch(job):
+        await asyncio.sleep(job.get('delay', 0))
+        if job.get('fail'):
+            raise OSError("скачивание не удалось")
+
+    async def render(job):
+        pass
+
+    async def persist(job):
+        # Запись первого сообщения дольше остальных: порядок держит не скорость этапа
+        await asyncio.sleep(0.02 if job['seq'] == 0 else 0)
+        persisted.append((job['chat_id'], job['name'], job['error'] is not None))
+
+    return IngestPipeline(fetch, render, persist,
+                          workers or {'fetch': 4, 'render': 2, 'persist': 3})
+
+
+def test_album_reserved_before_singles_is_persisted_first():
+    persisted = []
+
+    async def scenario():
+        pipeline = make_pipeline(persisted)
+        pipeline.start()
+        # Альбом занимает номер сразу, а в конвейер попадает, когда соберётся
+        album_seq = pipeline.reserve(1)
+        await pipeline.submit({'chat_id': 1, 'name': 'single-1', 'delay': 0.05})
+        await pipeline.submit({'chat_id': 1, 'name': 'single-2', 'delay': 0})
+        await pipeline.submit({'chat_id': 2, 'name': 'other', 'delay': 0})
+        await asyncio.sleep(0.1)
+        # Другой чат не ждёт альбома, а сообщения первого чата придержаны
+        assert persisted == [(2, 'other', False)]
+        assert pipeline.snapshot()['held'] == 2
+        await pipeline.submit({'chat_id': 1, 'name': 'album', 'delay': 0.01}, seq=album_seq)
+        await pipeline.stop()
+        assert pipeline.snapshot()['held'] == 0
+        assert not pipeline._held and not pipeline._tail
+
+    asyncio.run(scenario())
+    assert [name for chat_id, name, _ in persisted if chat_id == 1] == ['album', 'single-1', 'single-2']
+
+
+def test_failed_fetch_keeps_its_place():
+    persisted = []
+
+    async def scenario():
+        pipeline = make_pipeline(persisted)
+        pipeline.start()
+        await pipeline.submit({'chat_id': 1, 'name': 'slow', 'delay': 0.05})
+        await pipeline.submit({'chat_id': 1, 'name': 'broken', 'fail': True})
+        for index in range(5):
+            await pipeline.submit({'chat_id': 1, 'name': f'msg-{index}', 'delay': 0.01 * (5 - index)})
+        await pipeline.stop()
+
+    asyncio.run(scenario())
+    assert persisted == [(1, 'slow', False), (1, 'broken', True)] + [
+        (1, f'msg-{index}', False) for index in range(5)]
@@ -0,0 +1,116 @@
+"""Перенос файла с диска Bot API сервера (--local): ссылка, reflink, перенос или копия.
+
+Другую ФС изображают двумя способами: подменой os.link/os.rename/_reflink
+на ошибку EXDEV и, если есть, настоящим tmpfs в /dev/shm.
+"""
+import asyncio
+import errno
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+import pytest
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import config
+import utils.file_utils as file_utils
+from bench.fake_bot_api import FakeBotAPI
+from utils.file_utils import link_or_copy
+from utils.media_utils import download_file
+
+DATA = os.urandom(256 * 1024)
+
+
+def cross_device(*args):
+    """Так os.link, os.rename и FICLONE отвечают для файлов на разных ФС"""
+    raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+
+@pytest.fixture
+def other_fs(monkeypatch):
+    """Каждая попытка обойтись без копирования падает, как между разными ФС"""
+    monkeypatch.setattr(os, 'link', cross_device)
+    monkeypatch.setattr(os, 'rename', cross_device)
+    monkeypatch.setattr(file_utils, '_reflink', cross_device)
+
+
+@pytest.fixture
+def shm_dir():
+    """Папка на другой ФС, чем временные файлы теста"""
+    if not os.path.isdir('/dev/shm'):
+        pytest.skip("нет /dev/shm")
+    with tempfile.TemporaryDirectory(dir='/dev/shm') as path:
+        if os.stat(path).st_dev == os.stat(tempfile.gettempdir()).st_dev:
+            pytest.skip("/dev/shm на той же ФС")
+        yield Path(path)
+
+
+def make_source(folder: Path) -> Path:
+    source = folder / 'server' / 'photo.jpg'
+    source.parent.mkdir(parents=True, exist_ok=True)
+    source.write_bytes(DATA)
+    return source
+
+
+def test_same_fs_links(tmp_path):
+    source = make_source(tmp_path)
+    destination = tmp_path / 'photo.jpg.part'
+    assert link_or_copy(source, destination) == 'link'
+    assert os.path.samefile(source, destination)
+
+
+@pytest.mark.parametrize('allow_move', [False, True])
+def test_other_fs_copies(tmp_path, other_fs, allow_move):
+    source = make_source(tmp_path)
+    destination = tmp_path / 'photo.jpg.part'
+    assert link_or_copy(source, destination, allow_move) == 'copy'
+    assert destination.read_bytes() == DATA
+    assert not os.path.samefile(source, destination)
+    # Файл сервера остаётся на месте - его удалит сам сервер
+    assert source.read_bytes() == DATA
+
+
+def test_failed_reflink_leaves_no_file(tmp_path, monkeypatch):
+    fcntl = pytest.importorskip('fcntl')
+    source = make_source(tmp_path)
+    destination = tmp_path / 'photo.jpg.part'
+
+    monkeypatch.setattr(fcntl, 'ioctl', cross_device)
+    with pytest.raises(OSError):
+        file_utils._reflink(source, destination)
+    # Пустой файл от неудачного reflink не мешает следующей попытке
+    assert not destination.exists()
+
+
+@pytest.mark.parametrize('allow_move', [False, True])
+def test_real_other_fs_copies(tmp_path, shm_dir, allow_move):
+    source = make_source(shm_dir)
+    destination = tmp_path / 'photo.jpg.part'
+    assert link_or_copy(source, destination, allow_move) == 'copy'
+    assert destination.read_bytes() == DATA
+    assert source.read_bytes() == DATA
+
+
+def test_local_api_download_from_other_fs(tmp_path, other_fs, monkeypatch, caplog):
+    monkeypatch.setattr(config, 'BOT_API_MOVE_FILES', 1)
+
+    async def scenario():
+        server = FakeBotAPI(tmp_path / 'api', local=True)
+        file_id = server.add_file(DATA, 'photos/file_1.jpg')
+        url = await server.start()
+        bot = Bot(server.token, session=AiohttpSession(api=TelegramAPIServer.from_base(url, is_local=True)))
+        try:
+            return await download_file(bot, file_id, tmp_path / 'vault' / 'photo.jpg')
+        finally:
+            await bot.session.close()
+            await server.stop()
+
+    with caplog.at_level(logging.INFO, logger='utils.media_utils'):
+        assert asyncio.run(scenario())
+    destination = tmp_path / 'vault' / 'photo.jpg'
+    assert destination.read_bytes() == DATA
+    assert not destination.with_name('photo.jpg.part').exists()
+    assert "(copy)" in caplog.text
@@ -0,0 +1,73 @@
+"""Сжатие фото: записи в заметке пишутся сразу в итоговом виде, по drop оригинал удаляется"""
+import asyncio
+import io
+
+import pytest
+
+import config
+import utils.media_utils as media_utils
+from utils.media_optimizer import MediaOptimizer
+from utils.note_utils import note_writer
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def jpeg() -> bytes:
+    buf = io.BytesIO()
+    Image.new('RGB', (640, 480), (200, 80, 40)).save(buf, 'JPEG')
+    return buf.getvalue()
+
+
+@pytest.fixture
+def vault(tmp_path, monkeypatch):
+    vault = tmp_path / 'vault'
+    (vault / 'photos').mkdir(parents=True)
+    monkeypatch.setattr(config, 'OBSIDIAN_PATH', str(vault))
+    monkeypatch.setattr(config, 'STATE_DIR', str(tmp_path / 'state'))
+    monkeypatch.setattr(media_utils, '_media_store', None)
+    return vault
+
+
+def run(vault, keep: str, data: bytes, forwards: int) -> str:
+    """Одно фото, пересланное forwards раз в одну заметку. Возвращает текст заметки"""
+    source = vault / 'photos' / 'photo_1.jpg'
+    source.write_bytes(data)
+    note = vault / 'inbox.md'
+
+    async def scenario():
+        optimizer = MediaOptimizer(vault, vault.parent / 'queue.json', keep=keep)
+        await optimizer.start()
+        assert optimizer.enabled
+        for _ in range(forwards):
+            # Как render_stage + reply_when_written: запись сразу с embed, потом сжатие
+            await note_writer.append(note, f"\n{optimizer.embed(source)}\n---\n")
+            optimizer.submit(note, [('photo_1.jpg', source)])
+        await optimizer.stop()
+        await note_writer.drain()
+
+    asyncio.run(scenario())
+    return note.read_text(encoding='utf-8')
+
+
+def test_drop_repeated_photo_replaces_original(vault):
+    text = run(vault, 'drop', jpeg(), forwards=2)
+    embed = "[![](<photos/thumbs/photo_1_thumb.webp>)](<photos/photo_1.webp>)"
+    assert text.count(embed) == 2
+    assert (vault / 'photos' / 'photo_1.webp').exists()
+    assert (vault / 'photos' / 'thumbs' / 'photo_1_thumb.webp').exists()
+    # Обе записи ссылаются на сжатую копию - оригинал больше не нужен
+    assert not (vault / 'photos' / 'photo_1.jpg').exists()
+
+
+def test_keep_writes_only_thumbnail(vault):
+    text = run(vault, 'keep', jpeg(), forwards=1)
+    assert "[![](<photos/thumbs/photo_1_thumb.webp>)](<photos/photo_1.jpg>)" in text
+    assert sorted(p.name for p in (vault / 'photos').rglob('*') if p.is_file()) == \
+        ['photo_1.jpg', 'photo_1_thumb.webp']
+
+
+def test_failed_photo_falls_back_to_original(vault):
+    text = run(vault, 'drop', b'not an image', forwards=2)
+    assert text.count("![[photo_1.jpg]]") == 2
+    assert "thumb" not in text
+    assert (vault / 'photos' / 'photo_1.jpg').exists()
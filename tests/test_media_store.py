@@ -0,0 +1,90 @@
+"""Хранилище медиа: временные файлы загрузки не лежат в папках медиа и не остаются после ошибки"""
+import asyncio
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+import config
+import utils.media_utils as media_utils
+from bench.fake_bot_api import FakeBotAPI
+from utils.file_utils import DOWNLOADS_NAME, state_exclude_rules, sweep_downloads
+from utils.media_utils import save_media
+
+DATA = os.urandom(512 * 1024)
+
+
+class DroppingBotAPI(FakeBotAPI):
+    """Каждый запрос файла обрывается на половине"""
+
+    async def _file(self, request: web.Request) -> web.StreamResponse:
+        resp = web.StreamResponse(headers={'Content-Length': str(len(DATA))})
+        await resp.prepare(request)
+        await resp.write(DATA[:len(DATA) // 2])
+        request.transport.close()
+        return resp
+
+
+@pytest.fixture
+def vault(tmp_path, monkeypatch):
+    vault = tmp_path / 'vault'
+    vault.mkdir()
+    monkeypatch.setattr(config, 'OBSIDIAN_PATH', str(vault))
+    monkeypatch.setattr(config, 'STATE_DIR', str(tmp_path / 'state'))
+    monkeypatch.setattr(config, 'MEDIA_DOWNLOAD_RETRIES', 0)
+    monkeypatch.setattr(media_utils, '_media_store', None)
+    return vault
+
+
+def download(tmp_path, vault, server_class):
+    async def scenario():
+        server = server_class(tmp_path / 'api', local=False)
+        file_id = server.add_file(DATA, 'photos/file_1.jpg')
+        url = await server.start()
+        bot = Bot(server.token, session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+        file = SimpleNamespace(file_id=file_id, file_unique_id='u1')
+        try:
+            return await save_media(bot, file, vault / 'media' / 'photos', "photo.jpg")
+        finally:
+            await bot.session.close()
+            await server.stop()
+
+    return asyncio.run(scenario())
+
+
+def vault_files(vault):
+    return sorted(p.relative_to(vault).as_posix() for p in vault.rglob('*') if p.is_file())
+
+
+def test_download_leaves_only_final_file(tmp_path, vault):
+    saved = download(tmp_path, vault, FakeBotAPI)
+    assert saved.read_bytes() == DATA
+    assert vault_files(vault) == [saved.relative_to(vault).as_posix()]
+    assert saved.parent == vault / 'media' / 'photos'
+
+
+def test_failed_download_leaves_nothing(tmp_path, vault):
+    assert download(tmp_path, vault, DroppingBotAPI) is None
+    assert vault_files(vault) == []
+
+
+def test_sweep_removes_only_stale_downloads(vault):
+    downloads = vault / DOWNLOADS_NAME
+    downloads.mkdir()
+    stale = downloads / 'download-old.jpg.part'
+    fresh = downloads / 'download-new.jpg.part'
+    stale.write_bytes(b'x')
+    fresh.write_bytes(b'x')
+    old = time.time() - 2 * 24 * 3600
+    os.utime(stale, (old, old))
+    assert sweep_downloads() == 1
+    assert not stale.exists() and fresh.exists()
+
+
+def test_downloads_excluded_from_backup_and_watcher(vault):
+    assert f"/{DOWNLOADS_NAME}/" in state_exclude_rules()
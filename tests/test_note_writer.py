@@ -0,0 +1,69 @@
+"""NoteWriter: дописывание пачками и замена текста без потери чужих правок"""
+import asyncio
+
+import pytest
+
+import utils.note_writer as note_writer_module
+from utils.note_writer import NoteWriter
+
+
+def test_appends_in_order(tmp_path):
+    note = tmp_path / 'note.md'
+
+    async def scenario():
+        writer = NoteWriter(window=0.01)
+        await asyncio.gather(*(writer.append(note, f"{i}\n") for i in range(50)))
+        return writer.stats['batches']
+
+    assert asyncio.run(scenario()) == 1
+    assert note.read_text() == ''.join(f"{i}\n" for i in range(50))
+
+
+def test_replace_keeps_line_endings(tmp_path):
+    note = tmp_path / 'note.md'
+    note.write_bytes(b"a ![[x.jpg]]\r\nb ![[x.jpg]]\r\n")
+
+    async def scenario():
+        return await NoteWriter(window=0).replace(note, "![[x.jpg]]", "![[y.webp]]")
+
+    assert asyncio.run(scenario()) == 2
+    assert note.read_bytes() == b"a ![[y.webp]]\r\nb ![[y.webp]]\r\n"
+
+
+def test_replace_does_not_lose_concurrent_edit(tmp_path, monkeypatch):
+    note = tmp_path / 'note.md'
+    note.write_text("old\n")
+    original = note_writer_module._file_version
+    calls = []
+
+    def edited_once(path):
+        calls.append(path)
+        if len(calls) == 2:
+            # Obsidian дописал строку, пока готовился новый текст
+            with open(path, 'a') as f:
+                f.write("typed by hand\n")
+        return original(path)
+
+    monkeypatch.setattr(note_writer_module, '_file_version', edited_once)
+
+    async def scenario():
+        return await NoteWriter(window=0).replace(note, "old", "new")
+
+    assert asyncio.run(scenario()) == 1
+    assert note.read_text() == "new\ntyped by hand\n"
+    assert not note.with_name('note.md.tmp').exists()
+
+
+def test_replace_gives_up_on_busy_file(tmp_path, monkeypatch):
+    note = tmp_path / 'note.md'
+    note.write_text("old\n")
+    versions = iter(range(1000))
+    monkeypatch.setattr(note_writer_module, '_file_version', lambda path: next(versions))
+
+    async def scenario():
+        return await NoteWriter(window=0).replace(note, "old", "new")
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(scenario())
+    assert note.read_text() == "old\n"
+    assert not note.with_name('note.md.tmp').exists()
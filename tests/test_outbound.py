@@ -0,0 +1,46 @@
+"""Очередь исходящих сообщений: состояние чатов не копится и лимит чата не сбрасывается"""
+import asyncio
+
+from utils.outbound import OutboundSender
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        self.sent.append((chat_id, text, asyncio.get_running_loop().time()))
+
+
+def test_idle_chats_are_forgotten():
+    bot = FakeBot()
+
+    async def scenario():
+        sender = OutboundSender(global_rate=1000, chat_rate=100, chat_burst=1, window=0)
+        await asyncio.gather(*(sender.send(bot, chat_id, "✅") for chat_id in range(50)))
+        await asyncio.sleep(0.05)
+        await sender.send(bot, 999, "✅")
+        await sender.drain()
+        # Остаётся только чат, ведро которого ещё не наполнилось
+        assert set(sender._chats) <= {999}
+        await asyncio.sleep(0.05)
+        await sender.send(bot, 1000, "✅")
+        await sender.drain()
+        assert set(sender._chats) <= {1000}
+
+    asyncio.run(scenario())
+    assert len(bot.sent) == 52
+
+
+def test_chat_rate_survives_empty_lane():
+    bot = FakeBot()
+
+    async def scenario():
+        sender = OutboundSender(global_rate=1000, chat_rate=10, chat_burst=1, window=0)
+        # Между сообщениями полоса пустеет: новая запись чата дала бы лишний токен
+        for index in range(3):
+            await sender.send(bot, 1, f"сообщение {index}")
+
+    asyncio.run(scenario())
+    times = [t for _, _, t in bot.sent]
+    assert all(later - earlier >= 0.09 for earlier, later in zip(times, times[1:]))
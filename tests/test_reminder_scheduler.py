@@ -0,0 +1,74 @@
+"""Планировщик напоминаний: повтор неудачной отправки не сбивается пересборкой расписания"""
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from utils.reminder_scheduler import RETRY_DELAY, ReminderScheduler
+
+
+class FakeParser:
+    def __init__(self, reminders):
+        # идентификатор -> (время, текст)
+        self.reminders = reminders
+        self.sent = SimpleNamespace(retention=7 * 24 * 3600, flush=lambda: None)
+        self.marked = []
+
+    def upcoming(self, since):
+        return sorted((when, identifier, text) for identifier, (when, text) in self.reminders.items()
+                      if when >= since and identifier not in self.marked)
+
+    def mark_sent(self, identifier, reminder_time):
+        self.marked.append(identifier)
+
+
+def test_failed_send_waits_for_retry_after_rebuild():
+    now = datetime.now().replace(microsecond=0)
+    parser = FakeParser({'a': (now - timedelta(seconds=5), "A"), 'b': (now - timedelta(seconds=5), "B")})
+    sent = []
+
+    async def send(text):
+        if text == "A" and not sent:
+            raise ConnectionError("flood")
+        sent.append(text)
+
+    async def scenario():
+        scheduler = ReminderScheduler(parser, send, grace=3600, rescan=60)
+        scheduler._rebuild(now)
+        # A не ушло, B ушло - отправка B пересобирает расписание
+        assert await scheduler._fire_due(now)
+        scheduler._rebuild(now)
+        assert [(at, identifier) for at, _, identifier, _ in scheduler._heap] == \
+            [(now.timestamp() + RETRY_DELAY, 'a')]
+        # До времени повтора ничего не отправляется, даже после новых пересборок
+        later = now + timedelta(seconds=RETRY_DELAY - 1)
+        scheduler._rebuild(later)
+        assert not await scheduler._fire_due(later)
+        retry = now + timedelta(seconds=RETRY_DELAY)
+        assert await scheduler._fire_due(retry)
+        scheduler._rebuild(retry)
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert sent == ["B", "A"]
+    assert parser.marked == ['b', 'a']
+    assert scheduler._heap == [] and scheduler._retry_at == {}
+
+
+def test_retry_dropped_when_reminder_removed():
+    now = datetime.now().replace(microsecond=0)
+    parser = FakeParser({'a': (now - timedelta(seconds=5), "A")})
+
+    async def send(text):
+        raise ConnectionError("flood")
+
+    async def scenario():
+        scheduler = ReminderScheduler(parser, send, grace=3600, rescan=60)
+        scheduler._rebuild(now)
+        await scheduler._fire_due(now)
+        assert 'a' in scheduler._retry_at
+        del parser.reminders['a']
+        scheduler._rebuild(now)
+        return scheduler
+
+    scheduler = asyncio.run(scenario())
+    assert scheduler._retry_at == {} and scheduler._heap == []
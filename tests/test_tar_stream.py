@@ -0,0 +1,124 @@
+"""Зашифрованный tar.zst: запись и восстановление, неверный пароль, порча архива"""
+import builtins
+import json
+import os
+
+import pytest
+
+import utils.tar_stream as tar_stream
+from utils.backup_index import read_index
+from utils.backup_utils import MANIFEST_NAME, run_backup
+from utils.crypto_utils import SALT_SIZE, TAG_SIZE, DecryptionError
+from utils.restore_utils import restore_archive, restore_backup
+from utils.tar_stream import MAGIC, RECORD_SIZE, write_tar_zst
+
+# magic | соль | префикс nonce
+HEADER_SIZE = len(MAGIC) + SALT_SIZE + 4
+
+
+def make_vault(tmp_path):
+    vault = tmp_path / 'vault'
+    (vault / 'notes').mkdir(parents=True)
+    (vault / 'notes' / 'a.md').write_text("заметка\n" * 1000, encoding='utf-8')
+    (vault / 'notes' / 'b.md').write_text("другая\n", encoding='utf-8')
+    # Несжимаемый файл больше записи: архив из нескольких записей
+    (vault / 'video.mp4').write_bytes(os.urandom(3 * RECORD_SIZE))
+    return vault
+
+
+def vault_files(vault):
+    return sorted(p.relative_to(vault).as_posix() for p in vault.rglob('*') if p.is_file())
+
+
+@pytest.fixture
+def archive(tmp_path):
+    vault = make_vault(tmp_path)
+    output = tmp_path / 'backup.tar.zst.enc'
+    entries = write_tar_zst(vault, output, 'pw', vault_files(vault))
+    assert [entry['path'] for entry in entries] == vault_files(vault)
+    return vault, output
+
+
+def test_round_trip(tmp_path, archive):
+    vault, output = archive
+    target = tmp_path / 'restored'
+    assert restore_archive(output, 'pw', target) == 3
+    for name in vault_files(vault):
+        assert (target / name).read_bytes() == (vault / name).read_bytes()
+
+
+def test_wrong_password(tmp_path, archive):
+    _, output = archive
+    with pytest.raises(DecryptionError):
+        restore_archive(output, 'wrong', tmp_path / 'restored')
+
+
+def test_truncated_archive(tmp_path, archive):
+    _, output = archive
+    data = output.read_bytes()
+    # Обрыв посреди записи и ровно по границе записи (без последней)
+    first_record = HEADER_SIZE + 4 + RECORD_SIZE + TAG_SIZE
+    for cut in (len(data) - 100, first_record):
+        output.write_bytes(data[:cut])
+        with pytest.raises(DecryptionError):
+            restore_archive(output, 'pw', tmp_path / f'restored_{cut}')
+
+
+def test_tampered_record(tmp_path, archive):
+    _, output = archive
+    data = bytearray(output.read_bytes())
+    data[HEADER_SIZE + 4 + 1000] ^= 1
+    output.write_bytes(bytes(data))
+    with pytest.raises(DecryptionError):
+        restore_archive(output, 'pw', tmp_path / 'restored')
+
+
+def test_shrinking_file_is_damaged_and_not_indexed(tmp_path, monkeypatch):
+    vault = make_vault(tmp_path)
+
+    class Shrinking:
+        """Файл укорачивают после того, как его размер попал в заголовок tar"""
+
+        def __init__(self, path):
+            self.path = path
+            self.f = builtins.open(path, 'rb')
+
+        def read(self, size=-1):
+            os.truncate(self.path, 10)
+            return self.f.read(size)
+
+        def __getattr__(self, name):
+            return getattr(self.f, name)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            self.f.close()
+
+    def shrinking_open(path, mode='r', *args, **kwargs):
+        if str(path).endswith('a.md'):
+            return Shrinking(path)
+        return builtins.open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr(tar_stream, 'open', shrinking_open, raising=False)
+    settings = {
+        'obsidian_path': str(vault), 'backup_dir': str(tmp_path / 'backups'),
+        'password': 'pw', 'format': 'tar.zst', 'incremental': True, 'full_every': 5,
+        'workers': 1, 'level': 6, 'zstd_level': 3, 'max_age': 0, 'max_count': 0, 'exclude': [],
+    }
+    plan = run_backup(settings, 'vault')
+    monkeypatch.undo()
+    assert plan['damaged'] == ['notes/a.md']
+    archive = tmp_path / 'backups' / plan['archive'].name
+    assert [entry['path'] for entry in read_index(archive, 'pw')['entries']] == ['notes/b.md', 'video.mp4']
+    manifest = json.loads((tmp_path / 'backups' / MANIFEST_NAME).read_text(encoding='utf-8'))
+    assert 'notes/a.md' not in manifest['files']
+
+    target = tmp_path / 'restored'
+    assert restore_backup(tmp_path / 'backups', archive.name, 'pw', target) == 2
+    assert vault_files(target) == ['notes/b.md', 'video.mp4']
+
+    # Следующий бэкап - дельта с этим файлом
+    plan = run_backup(settings, 'vault')
+    assert plan['kind'] == 'delta' and plan['files_count'] == 1
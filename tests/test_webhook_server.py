@@ -0,0 +1,127 @@
+"""run_webhook против заменителя Bot API (bench/fake_bot_api.py).
+
+pytest-asyncio не нужен: каждый тест сам запускает цикл через asyncio.run.
+"""
+import asyncio
+import time
+
+import aiohttp
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Message
+
+from bench.bench_webhook import free_port
+from bench.fake_bot_api import FakeBotAPI
+from utils.webhook_server import SECRET_HEADER, run_webhook
+
+SECRET = "test-secret"
+PATH = "/telegram"
+CHAT_ID = 1000
+
+
+def make_update(update_id: int, text: str) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id, 'date': int(time.time()),
+            'chat': {'id': CHAT_ID, 'type': 'private'},
+            'from': {'id': CHAT_ID, 'is_bot': False, 'first_name': 'test'},
+            'text': text,
+        }
+    }
+
+
+async def serve(tmp_path, dp: Dispatcher, scenario, drain_timeout: float = 5):
+    """Поднимает заменитель Bot API и run_webhook, выполняет scenario(post), останавливает webhook.
+
+    post(update, secret) возвращает HTTP-статус ответа. Возвращает (handler, server).
+    """
+    server = FakeBotAPI(tmp_path / 'api', local=False)
+    url = await server.start()
+    bot = Bot(server.token, session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    port = free_port()
+    stop = asyncio.Event()
+    serving = asyncio.create_task(run_webhook(dp, bot, '127.0.0.1', port, PATH, SECRET,
+                                              drain_timeout=drain_timeout, stop=stop))
+    endpoint = f"http://127.0.0.1:{port}{PATH}"
+    try:
+        async with aiohttp.ClientSession() as client:
+            async def post(update: dict, secret: str) -> int:
+                async with client.post(endpoint, json=update, headers={SECRET_HEADER: secret}) as resp:
+                    return resp.status
+
+            # Ждём, пока сервер начнёт слушать (GET на адрес webhook - 405)
+            for _ in range(100):
+                try:
+                    async with client.get(endpoint):
+                        break
+                except aiohttp.ClientConnectionError:
+                    await asyncio.sleep(0.05)
+            await scenario(post)
+        stop.set()
+        handler = await asyncio.wait_for(serving, drain_timeout + 5)
+    finally:
+        stop.set()
+        await server.stop()
+    return handler, server
+
+
+def test_wrong_secret_rejected(tmp_path):
+    handled = []
+    dp = Dispatcher()
+
+    @dp.message()
+    async def on_message(message: Message):
+        handled.append(message.text)
+
+    async def scenario(post):
+        assert await post(make_update(1, "чужой"), "wrong") == 401
+        assert await post(make_update(2, "без секрета"), "") == 401
+        assert await post(make_update(3, "свой"), SECRET) == 200
+
+    handler, _ = asyncio.run(serve(tmp_path, dp, scenario))
+    assert handler.stats['rejected'] == 2
+    assert handled == ["свой"]
+
+
+def test_shutdown_drains_handlers(tmp_path):
+    started = []
+    dp = Dispatcher()
+
+    @dp.message()
+    async def on_message(message: Message):
+        started.append(message.text)
+        await asyncio.sleep(0.5)
+        # Ответ уходит после остановки сервера - сессия бота ещё должна быть открыта
+        await message.answer(f"✅ {message.text}")
+
+    async def scenario(post):
+        for i in range(3):
+            assert await post(make_update(i + 1, f"сообщение {i}"), SECRET) == 200
+        # Запросы подтверждены сразу, обработчики ещё работают
+        while len(started) < 3:
+            await asyncio.sleep(0.01)
+
+    handler, server = asyncio.run(serve(tmp_path, dp, scenario))
+    assert handler.in_flight == 0
+    assert sorted(text for _, text, _ in server.sent) == [f"✅ сообщение {i}" for i in range(3)]
+
+
+def test_shutdown_cancels_handlers_after_timeout(tmp_path):
+    finished = []
+    dp = Dispatcher()
+
+    @dp.message()
+    async def on_message(message: Message):
+        await asyncio.sleep(30)
+        finished.append(message.text)
+
+    async def scenario(post):
+        assert await post(make_update(1, "долгое"), SECRET) == 200
+        await asyncio.sleep(0.1)
+
+    started = time.monotonic()
+    asyncio.run(serve(tmp_path, dp, scenario, drain_timeout=0.3))
+    assert time.monotonic() - started < 5
+    assert finished == []
@@ -0,0 +1,38 @@
+"""ZIP-бэкап: нечитаемый файл пропускается, а следующий инкрементальный бэкап берёт его снова"""
+import builtins
+import json
+
+import utils.zip_writer as zip_writer
+from utils.backup_utils import MANIFEST_NAME, run_backup
+
+
+def settings(tmp_path):
+    return {
+        'obsidian_path': str(tmp_path / 'vault'), 'backup_dir': str(tmp_path / 'backups'),
+        'password': 'pw', 'format': 'zip', 'incremental': True, 'full_every': 5,
+        'workers': 1, 'level': 6, 'zstd_level': 3, 'max_age': 0, 'max_count': 0, 'exclude': [],
+    }
+
+
+def test_unreadable_file_is_skipped_and_retried(tmp_path, monkeypatch):
+    vault = tmp_path / 'vault'
+    vault.mkdir()
+    for name in ('a.md', 'locked.md', 'c.md'):
+        (vault / name).write_text(f"заметка {name}\n" * 100)
+
+    def locked_open(path, *args, **kwargs):
+        if str(path).endswith('locked.md'):
+            raise PermissionError(13, "Permission denied", str(path))
+        return builtins.open(path, *args, **kwargs)
+
+    monkeypatch.setattr(zip_writer, 'open', locked_open, raising=False)
+    plan = run_backup(settings(tmp_path), 'vault')
+    assert plan['archive'].exists()
+    assert plan['files_total'] == 3
+    manifest = json.loads((tmp_path / 'backups' / MANIFEST_NAME).read_text(encoding='utf-8'))
+    assert sorted(manifest['files']) == ['a.md', 'c.md']
+
+    monkeypatch.undo()
+    plan = run_backup(settings(tmp_path), 'vault')
+    assert plan['kind'] == 'delta'
+    assert plan['files_count'] == 1
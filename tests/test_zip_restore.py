@@ -0,0 +1,101 @@
+"""Выборочное восстановление из ZIP по смещениям из индекса и защита от выхода за пределы папки"""
+import io
+import os
+
+import pytest
+
+from utils.backup_index import read_index
+from utils.backup_utils import run_backup
+from utils.restore_utils import _safe_dest, _extract_planned, restore_archive, restore_backup
+from utils.zip_writer import extract_member, write_aes_zip
+
+FILES = {
+    'notes/a.md': "заметка a\n" * 500,
+    'notes/b.md': "заметка b\n",
+    'media/clip.mp4': None,  # несжимаемый, больше окна чтения
+}
+
+
+def make_vault(tmp_path):
+    vault = tmp_path / 'vault'
+    for name, text in FILES.items():
+        path = vault / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if text is None:
+            path.write_bytes(os.urandom(3 * 1024 * 1024))
+        else:
+            path.write_text(text, encoding='utf-8')
+    return vault
+
+
+def test_extract_member_by_offset(tmp_path):
+    vault = make_vault(tmp_path)
+    output = tmp_path / 'backup.zip'
+    entries = write_aes_zip(vault, output, 'pw', sorted(FILES), workers=1)
+    with open(output, 'rb') as fp:
+        # В обратном порядке: каждый файл читается только по своему смещению
+        for entry in reversed(entries):
+            out = io.BytesIO()
+            assert extract_member(fp, entry['offset'], 'pw', out) == entry['size']
+            assert out.getvalue() == (vault / entry['path']).read_bytes()
+        with pytest.raises(RuntimeError):
+            extract_member(fp, entries[0]['offset'], 'wrong', io.BytesIO())
+
+
+def test_extract_member_detects_tampering(tmp_path):
+    vault = make_vault(tmp_path)
+    output = tmp_path / 'backup.zip'
+    entries = write_aes_zip(vault, output, 'pw', ['notes/a.md'], workers=1)
+    data = bytearray(output.read_bytes())
+    # Байт шифротекста: после заголовка (30 + имя + extra), соли (16) и проверки пароля (2)
+    data[entries[0]['offset'] + 30 + len('notes/a.md') + 11 + 16 + 2 + 5] ^= 1
+    output.write_bytes(bytes(data))
+    with open(output, 'rb') as fp, pytest.raises(ValueError):
+        extract_member(fp, entries[0]['offset'], 'pw', io.BytesIO())
+
+
+def test_selective_restore_from_chain(tmp_path):
+    vault = make_vault(tmp_path)
+    backups = tmp_path / 'backups'
+    settings = {
+        'obsidian_path': str(vault), 'backup_dir': str(backups),
+        'password': 'pw', 'format': 'zip', 'incremental': True, 'full_every': 5,
+        'workers': 1, 'level': 6, 'zstd_level': 3, 'max_age': 0, 'max_count': 0, 'exclude': [],
+    }
+    run_backup(settings, 'vault')
+    (vault / 'notes' / 'b.md').write_text("заметка b, исправлена\n", encoding='utf-8')
+    delta = run_backup(settings, 'vault')
+    assert delta['kind'] == 'delta'
+
+    target = tmp_path / 'restored'
+    # Один файл - из дельты, папка - из полного бэкапа и дельты
+    assert restore_backup(backups, delta['archive'].name, 'pw', target, ['notes/b.md']) == 1
+    assert sorted(p.name for p in target.rglob('*') if p.is_file()) == ['b.md']
+    assert (target / 'notes' / 'b.md').read_text(encoding='utf-8') == "заметка b, исправлена\n"
+    assert restore_backup(backups, delta['archive'].name, 'pw', target, ['notes']) == 2
+    assert (target / 'notes' / 'a.md').read_text(encoding='utf-8') == FILES['notes/a.md']
+    assert not (target / 'media').exists()
+
+
+def test_safe_dest_rejects_escaping_names(tmp_path):
+    target = (tmp_path / 'restore').resolve()
+    target.mkdir()
+    assert _safe_dest(target, 'notes/a.md') == target / 'notes' / 'a.md'
+    for name in ('../evil.md', 'notes/../../evil.md', str(tmp_path / 'evil.md')):
+        assert _safe_dest(target, name) is None
+
+
+def test_restore_skips_path_traversal_members(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    (tmp_path / 'evil.md').write_text("чужой файл")
+    (src / 'ok.md').write_text("нормальный")
+    output = tmp_path / 'backup.zip'
+    entries = write_aes_zip(src, output, 'pw', ['ok.md', '../evil.md'], workers=1)
+    target = (tmp_path / 'area' / 'restore').resolve()
+
+    # Полная распаковка и выборочная по смещениям
+    assert restore_archive(output, 'pw', target) == 1
+    assert _extract_planned(output, entries, 'pw', target) == 1
+    assert (target / 'ok.md').read_text() == "нормальный"
+    assert not (tmp_path / 'area' / 'evil.md').exists()
@@ -0,0 +1,161 @@
+"""Правила исключения файлов из бэкапа в стиле .gitignore.
+
+Поддерживается: `*`, `?`, `**`, `[...]`, `!` (вернуть файл), `/` в конце
+(только папки), `/` в начале или середине (путь от корня вальта).
+Как и в git, файл внутри исключённой папки вернуть нельзя - такие папки
+целиком пропускаются при обходе.
+"""
+import os
+import re
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+IGNORE_FILE_NAME = ".backupignore"
+
+
+class Rule:
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        body = pattern
+        self.negate = body.startswith('!')
+        if self.negate:
+            body = body[1:]
+        self.dir_only = body.endswith('/')
+        body = body.rstrip('/')
+        anchored = '/' in body
+        body = body.lstrip('/')
+        prefix = '' if anchored else '(?:.*/)?'
+        self.regex = '^' + prefix + _translate(body) + '$'
+        self.match = re.compile(self.regex).match
+
+
+def _translate(glob: str) -> str:
+    out = []
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        if glob.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+        elif glob.startswith('/**', i) and i + 3 == len(glob):
+            out.append('/.*')
+            i += 3
+        elif glob.startswith('**', i):
+            out.append('.*')
+            i += 2
+        elif c == '*':
+            out.append('[^/]*')
+            i += 1
+        elif c == '?':
+            out.append('[^/]')
+            i += 1
+        elif c == '[' and ']' in glob[i + 1:]:
+            end = glob.index(']', i + 1)
+            cls = glob[i + 1:end]
+            if cls.startswith('!'):
+                cls = '^' + cls[1:]
+            out.append('[' + cls.replace('\\', '\\\\') + ']')
+            i = end + 1
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return ''.join(out)
+
+
+def parse_rules(lines: Iterable[str]) -> List[str]:
+    patterns = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            patterns.append(line)
+    return patterns
+
+
+class BackupFilter:
+    """Скомпилированный набор правил. Побеждает последнее подходящее правило"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self.rules = [Rule(p) for p in patterns]
+        # Одна общая регулярка: большинство путей не подходят ни под одно правило,
+        # и для них хватает одной проверки
+        self._any = re.compile('|'.join(f'(?:{r.regex})' for r in self.rules)).match \
+            if self.rules else None
+
+    @classmethod
+    def for_vault(cls, input_dir: Path, patterns: Iterable[str]) -> 'BackupFilter':
+        """Правила из конфига плюс .backupignore из корня вальта"""
+        patterns = list(patterns)
+        ignore_file = input_dir / IGNORE_FILE_NAME
+        if ignore_file.exists():
+            with open(ignore_file, 'r', encoding='utf-8') as f:
+                patterns += parse_rules(f)
+        return cls(patterns)
+
+    def excluded_by(self, path: str, is_dir: bool) -> Optional[Rule]:
+        """Правило, исключающее путь, или None если путь попадает в бэкап"""
+        if self._any is None or not self._any(path):
+            return None
+        for rule in reversed(self.rules):
+            if rule.dir_only and not is_dir:
+                continue
+            if rule.match(path):
+                return None if rule.negate else rule
+        return None
+
+    def walk(self, input_dir: Path) -> Iterable[Tuple[str, os.DirEntry]]:
+        """Обходит вальт, пропуская исключённые папки целиком.
+
+        Отдаёт (относительный путь, DirEntry) для каждого включённого файла.
+        """
+        stack = ['']
+        while stack:
+            rel_dir = stack.pop()
+            try:
+                entries = list(os.scandir(input_dir / rel_dir if rel_dir else input_dir))
+            except OSError:
+                continue
+            for entry in entries:
+                rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not is_dir and entry.is_dir():
+                    # Ссылки на папки не обходим, как и os.walk
+                    continue
+                if self.excluded_by(rel, is_dir):
+                    continue
+                if is_dir:
+                    stack.append(rel)
+                else:
+                    yield rel, entry
+
+    def dry_run(self, input_dir: Path) -> Dict[str, Dict[str, int]]:
+        """Сколько файлов и байт отсекает каждое правило.
+
+        Возвращает {правило: {'files': n, 'bytes': n}}, плюс ключ '' для
+        того, что попадёт в бэкап.
+        """
+        stats = {rule.pattern: {'files': 0, 'bytes': 0} for rule in self.rules if not rule.negate}
+        stats[''] = {'files': 0, 'bytes': 0}
+        stack = [('', None)]
+        while stack:
+            rel_dir, dir_rule = stack.pop()
+            try:
+                entries = list(os.scandir(input_dir / rel_dir if rel_dir else input_dir))
+            except OSError:
+                continue
+            for entry in entries:
+                rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not is_dir and entry.is_dir():
+                    continue
+                rule = dir_rule or self.excluded_by(rel, is_dir)
+                if is_dir:
+                    stack.append((rel, rule))
+                    continue
+                try:
+                    size = entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+                bucket = stats[rule.pattern if rule else '']
+                bucket['files'] += 1
+                bucket['bytes'] += size
+        return stats
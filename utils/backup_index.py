@@ -0,0 +1,42 @@
+"""Зашифрованный индекс архива (<архив>.idx).
+
+Хранит список файлов архива (путь, размер, mtime, sha256, смещение) и сведения
+о бэкапе. По нему выборочное восстановление читает из многогигабайтного
+архива только нужные файлы, а список содержимого не требует открывать архив.
+"""
+import json
+import os
+import zlib
+from pathlib import Path
+from typing import Any, Dict, List
+
+from utils.crypto_utils import SALT_SIZE, decrypt_blob, derive_key, encrypt_blob
+
+INDEX_SUFFIX = ".idx"
+MAGIC = b'OTIDX1'
+
+
+def index_path(archive: Path) -> Path:
+    return archive.with_name(archive.name + INDEX_SUFFIX)
+
+
+def write_index(archive: Path, password: str, meta: Dict[str, Any], entries: List[Dict[str, Any]]):
+    salt = os.urandom(SALT_SIZE)
+    data = zlib.compress(json.dumps({'meta': meta, 'entries': entries},
+                                    ensure_ascii=False).encode('utf-8'))
+    path = index_path(archive)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + salt + encrypt_blob(derive_key(password, salt), data, b'index'))
+    os.replace(tmp_path, path)
+
+
+def read_index(archive: Path, password: str) -> Dict[str, Any]:
+    """{'meta': {...}, 'entries': [...]}. FileNotFoundError - индекса нет (старый архив)"""
+    with open(index_path(archive), 'rb') as f:
+        blob = f.read()
+    if blob[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{index_path(archive).name}: неизвестный формат индекса")
+    salt = blob[len(MAGIC):len(MAGIC) + SALT_SIZE]
+    data = decrypt_blob(derive_key(password, salt), blob[len(MAGIC) + SALT_SIZE:], b'index')
+    return json.loads(zlib.decompress(data))
@@ -0,0 +1,169 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from utils.backup_utils import BackupCancelled, dry_run, run_backup, run_cleanup
+from utils.metrics import record_backup
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = 0.5  # как часто рабочий процесс отправляет прогресс, сек
+
+_executor: Optional[ProcessPoolExecutor] = None
+_progress_queue = None
+_cancel_event = None
+_job_lock = asyncio.Lock()
+_running = False
+
+# Состояние внутри рабочего процесса (заполняется _init_worker)
+_worker_queue = None
+_worker_cancel = None
+
+
+def _init_worker(progress_queue, cancel_event):
+    global _worker_queue, _worker_cancel
+    _worker_queue = progress_queue
+    _worker_cancel = cancel_event
+
+
+def _worker_job(settings: Dict[str, Any], prefix: str) -> Dict[str, Any]:
+    last_sent = 0.0
+
+    def progress(state: Dict[str, Any]):
+        nonlocal last_sent
+        if _worker_cancel.is_set():
+            raise BackupCancelled()
+        now = time.monotonic()
+        if now - last_sent >= PROGRESS_INTERVAL:
+            last_sent = now
+            try:
+                _worker_queue.put_nowait(state)
+            except queue.Full:
+                pass
+
+    return run_backup(settings, prefix, progress, _worker_cancel.is_set)
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """Один рабочий процесс на все бэкапы: сжатие и шифрование не блокируют event loop бота"""
+    global _executor, _progress_queue, _cancel_event
+    if _executor is None:
+        ctx = multiprocessing.get_context('spawn')
+        _progress_queue = ctx.Queue(maxsize=100)
+        _cancel_event = ctx.Event()
+        _executor = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=ctx,
+            initializer=_init_worker,
+            initargs=(_progress_queue, _cancel_event),
+        )
+    return _executor
+
+
+def is_backup_running() -> bool:
+    return _running
+
+
+def cancel_backup() -> bool:
+    """Просит рабочий процесс остановить текущий бэкап. False - бэкап не запущен"""
+    if not _running:
+        return False
+    _cancel_event.set()
+    return True
+
+
+async def run_backup_job(
+    settings: Dict[str, Any],
+    prefix: str,
+    on_progress: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+) -> Dict[str, Any]:
+    """Запускает бэкап в рабочем процессе и ждёт результата.
+
+    Бэкапы выполняются по одному. on_progress получает словарь с полями
+    files_done/files_total/bytes_done/bytes_total/elapsed.
+    При отмене выбрасывает BackupCancelled.
+    """
+    global _running, _executor
+    async with _job_lock:
+        executor = _get_executor()
+        _cancel_event.clear()
+        _drain_queue()
+        _running = True
+        started = time.monotonic()
+        try:
+            future = asyncio.get_running_loop().run_in_executor(
+                executor, _worker_job, settings, prefix)
+            while True:
+                done, _ = await asyncio.wait({future}, timeout=PROGRESS_INTERVAL)
+                state = _drain_queue()
+                if state and on_progress:
+                    state['elapsed'] = time.monotonic() - started
+                    try:
+                        await on_progress(state)
+                    except Exception as e:
+                        logger.warning(f"Ошибка отображения прогресса бэкапа: {str(e)}")
+                if done:
+                    plan = future.result()
+                    if not plan.get('skipped'):
+                        record_backup(plan, time.monotonic() - started)
+                    return plan
+        except BrokenProcessPool:
+            # Рабочий процесс упал (например, OOM) - при следующем бэкапе создадим новый
+            logger.error("Процесс бэкапа аварийно завершился")
+            _executor = None
+            raise
+        finally:
+            _running = False
+
+
+async def run_worker_job(func: Callable, *args):
+    """Выполняет func(*args) в рабочем процессе бэкапов.
+
+    Общая блокировка с бэкапами гарантирует, что очистка и сборка мусора
+    в хранилище не пересекутся с бэкапом, который ещё пишется.
+    """
+    global _executor
+    async with _job_lock:
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                _get_executor(), func, *args)
+        except BrokenProcessPool:
+            logger.error("Процесс бэкапа аварийно завершился")
+            _executor = None
+            raise
+
+
+async def run_cleanup_job(settings: Dict[str, Any]):
+    return await run_worker_job(run_cleanup, settings)
+
+
+async def run_dry_run_job(settings: Dict[str, Any]):
+    return await run_worker_job(dry_run, settings)
+
+
+def _drain_queue() -> Optional[Dict[str, Any]]:
+    """Забирает все накопившиеся сообщения о прогрессе, возвращает последнее"""
+    state = None
+    while True:
+        try:
+            state = _progress_queue.get_nowait()
+        except queue.Empty:
+            return state
+
+
+def format_progress(state: Dict[str, Any]) -> str:
+    mb_done = state['bytes_done'] / 1024 / 1024
+    mb_total = state['bytes_total'] / 1024 / 1024
+    text = (f"⏳ Резервное копирование: {state['files_done']}/{state['files_total']} файлов, "
+            f"{mb_done:.1f}/{mb_total:.1f} МБ")
+    elapsed = state.get('elapsed', 0)
+    if state['bytes_done'] and elapsed:
+        rate = state['bytes_done'] / elapsed
+        eta = max(state['bytes_total'] - state['bytes_done'], 0) / rate
+        text += f", осталось ~{int(eta // 60)} мин {int(eta % 60)} сек"
+    return text
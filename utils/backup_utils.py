@@ -0,0 +1,483 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Any, Callable
+
+from utils.backup_filter import BackupFilter
+from utils.backup_index import index_path, write_index
+from utils.chunk_store import SNAPSHOT_SUFFIX, STORE_DIR_NAME, ChunkStore, backup_to_store
+from utils.tar_stream import ARCHIVE_SUFFIX as TAR_SUFFIX, write_tar_zst
+from utils.zip_writer import write_aes_zip
+
+logger = logging.getLogger(__name__)
+
+# Служебные файлы в папке бэкапов
+MANIFEST_NAME = "backup_manifest.json"   # состояние вальта на момент последнего бэкапа
+CHAINS_NAME = "backup_chains.json"       # связи дельта-архивов с их полными бэкапами
+# Служебный файл внутри дельта-архива: родитель и список удалённых файлов
+DELTA_MEMBER = ".backup_delta.json"
+
+HASH_CHUNK = 1024 * 1024
+
+# Расширения архивов по значению BACKUP_FORMAT
+ARCHIVE_SUFFIXES = {
+    'zip': '.zip',
+    'tar.zst': TAR_SUFFIX,
+}
+
+
+class BackupCancelled(Exception):
+    """Бэкап остановлен командой /backup_cancel"""
+
+
+# progress(файлов_готово, байт_готово) - вызывается по ходу архивации,
+# может выбросить BackupCancelled
+ProgressCallback = Callable[[int, int], None]
+
+
+def load_json(path: Path, default):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except Exception as e:
+        logger.error(f"Не удалось прочитать {path.name}: {str(e)}")
+        return default
+
+
+def save_json(path: Path, data):
+    """Атомарная запись: пишем во временный файл и переименовываем"""
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def file_hash(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def scan_vault(input_dir: Path, known: Optional[Dict[str, list]] = None,
+               flt: Optional[BackupFilter] = None,
+               cancelled: Optional[Callable[[], bool]] = None) -> Dict[str, list]:
+    """Собирает манифест вальта: путь -> [размер, mtime_ns, sha256].
+
+    Хэш пересчитывается только для файлов, у которых изменились размер или mtime,
+    для остальных берётся из предыдущего манифеста. cancelled() проверяется
+    перед каждым файлом: на первом бэкапе хэширование всего вальта идёт долго.
+    """
+    known = known or {}
+    flt = flt or BackupFilter([])
+    files = {}
+    for arcname, entry in flt.walk(input_dir):
+        if cancelled and cancelled():
+            raise BackupCancelled()
+        try:
+            st = entry.stat()
+            old = known.get(arcname)
+            if old and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+                files[arcname] = old
+            else:
+                files[arcname] = [st.st_size, st.st_mtime_ns, file_hash(Path(entry.path))]
+        except OSError as e:
+            # Файл могли удалить или переименовать во время обхода
+            logger.warning(f"Пропускаю {arcname}: {str(e)}")
+    return files
+
+
+def diff_manifest(old: Dict[str, list], new: Dict[str, list]):
+    """Возвращает (новые/изменённые, удалённые) пути"""
+    changed = [path for path, meta in new.items()
+               if path not in old or old[path][2] != meta[2]]
+    deleted = [path for path in old if path not in new]
+    return sorted(changed), sorted(deleted)
+
+
+def load_chains(backup_dir: Path) -> Dict[str, Dict[str, Any]]:
+    return load_json(backup_dir / CHAINS_NAME, {})
+
+
+def plan_backup(input_dir: Path, backup_dir: Path, prefix: str,
+                incremental: bool, full_every: int, suffix: str = '.zip',
+                flt: Optional[BackupFilter] = None,
+                cancelled: Optional[Callable[[], bool]] = None) -> Dict[str, Any]:
+    """Определяет, какой бэкап делать (полный или дельта) и какие файлы в него писать.
+
+    Манифест и цепочки не меняются до вызова commit_backup, поэтому неудачный
+    архив не портит состояние.
+    """
+    timestamp = time.strftime("%Y%m%d_%H%M%S")
+    plan = {
+        'archive': backup_dir / f"{prefix}_{timestamp}{suffix}",
+        'kind': 'full',
+        'parent': None,
+        'base': None,
+        'files': None,  # None - архивировать весь вальт без манифеста
+        'deleted': [],
+        'manifest_files': None,
+    }
+    if not incremental:
+        return plan
+
+    manifest = load_json(backup_dir / MANIFEST_NAME, {})
+    chains = load_chains(backup_dir)
+    files = scan_vault(input_dir, manifest.get('files'), flt, cancelled)
+    plan['files'] = sorted(files)
+    plan['manifest_files'] = files
+
+    last = manifest.get('last')
+    base = manifest.get('base')
+    chain_ok = (
+        last and base
+        and (backup_dir / last).exists()
+        and all((backup_dir / name).exists()
+                for name, meta in chains.items() if meta.get('base') == base)
+    )
+    deltas = sum(1 for meta in chains.values()
+                 if meta.get('base') == base and meta.get('kind') == 'delta')
+    if not chain_ok or deltas >= full_every:
+        return plan
+
+    changed, deleted = diff_manifest(manifest.get('files', {}), files)
+    plan.update({
+        'archive': backup_dir / f"{prefix}_{timestamp}_delta{suffix}",
+        'kind': 'delta',
+        'parent': last,
+        'base': base,
+        'files': changed,
+        'deleted': deleted,
+    })
+    return plan
+
+
+def delta_member(plan: Dict[str, Any]) -> bytes:
+    return json.dumps({
+        'parent': plan['parent'],
+        'base': plan['base'],
+        'deleted': plan['deleted'],
+    }, ensure_ascii=False).encode('utf-8')
+
+
+def commit_backup(backup_dir: Path, plan: Dict[str, Any]):
+    """Фиксирует успешный бэкап в индексе цепочек и (для инкрементальных) в манифесте"""
+    name = plan['archive'].name
+    base = plan['base'] or name
+    chains = load_chains(backup_dir)
+    chains[name] = {
+        'kind': plan['kind'],
+        'parent': plan['parent'],
+        'base': base,
+        'created': time.time(),
+        'files': plan['files_count'],
+        'bytes': plan['bytes_total'],
+    }
+    save_json(backup_dir / CHAINS_NAME, chains)
+    if plan['manifest_files'] is None:
+        return
+    save_json(backup_dir / MANIFEST_NAME, {
+        'base': base,
+        'last': name,
+        'files': plan['manifest_files'],
+    })
+
+
+def list_archives(backup_dir: Path) -> List[Path]:
+    """Архивы всех форматов в папке бэкапов (без хранилища с дедупликацией)"""
+    return [path for path in backup_dir.iterdir()
+            if path.is_file() and path.name.endswith(tuple(ARCHIVE_SUFFIXES.values()))]
+
+
+def plan_cleanup(backup_dir: Path, max_age_days: Optional[int],
+                 max_count: Optional[int]) -> List[Path]:
+    """Список архивов на удаление с учётом цепочек.
+
+    Полный бэкап и все его дельты удаляются только вместе, поэтому база, нужная
+    живой дельте, никогда не удаляется раньше неё. Текущая цепочка не трогается.
+    """
+    chains = load_chains(backup_dir)
+    manifest = load_json(backup_dir / MANIFEST_NAME, {})
+    current_base = manifest.get('base')
+
+    groups: Dict[str, List[Path]] = {}
+    for archive in list_archives(backup_dir):
+        # Архивы, которых нет в индексе (старые), считаются самостоятельными
+        base = chains.get(archive.name, {}).get('base', archive.name)
+        groups.setdefault(base, []).append(archive)
+
+    ordered = sorted(groups.items(),
+                     key=lambda item: max(os.path.getmtime(p) for p in item[1]))
+    now = time.time()
+    doomed = []
+    kept = []
+    for base, archives in ordered:
+        newest = max(os.path.getmtime(p) for p in archives)
+        if (base != current_base and max_age_days is not None
+                and (now - newest) // 86400 > max_age_days):
+            doomed.extend(archives)
+        else:
+            kept.append((base, archives))
+
+    if max_count is not None:
+        total = sum(len(archives) for _, archives in kept)
+        for base, archives in kept:
+            if total <= max_count:
+                break
+            if base == current_base:
+                continue
+            doomed.extend(archives)
+            total -= len(archives)
+
+    return doomed
+
+
+def forget_archives(backup_dir: Path, names: List[str]):
+    chains = load_chains(backup_dir)
+    if any(name in chains for name in names):
+        for name in names:
+            chains.pop(name, None)
+        save_json(backup_dir / CHAINS_NAME, chains)
+
+
+def list_vault_files(input_dir: Path, flt: Optional[BackupFilter] = None) -> List[str]:
+    # Пути относительно корня вальта
+    flt = flt or BackupFilter([])
+    return [arcname for arcname, _ in flt.walk(input_dir)]
+
+
+def vault_filter(settings: Dict[str, Any]) -> BackupFilter:
+    """Правила исключений из конфига и .backupignore; папка бэкапов внутри вальта
+    исключается всегда"""
+    input_dir = Path(settings['obsidian_path'])
+    patterns = list(settings.get('exclude', []))
+    backup_dir = Path(settings['backup_dir']).resolve()
+    if backup_dir.is_relative_to(input_dir.resolve()) and backup_dir != input_dir.resolve():
+        patterns.append('/' + backup_dir.relative_to(input_dir.resolve()).as_posix() + '/')
+    return BackupFilter.for_vault(input_dir, patterns)
+
+
+def dry_run(settings: Dict[str, Any]) -> Dict[str, Dict[str, int]]:
+    return vault_filter(settings).dry_run(Path(settings['obsidian_path']))
+
+
+def create_zip_with_password(input_dir: Path, output_zip: Path, password: str,
+                             files: List[str],
+                             extra: Optional[Dict[str, bytes]] = None,
+                             progress: Optional[ProgressCallback] = None,
+                             workers: int = 0, level: int = 9):
+    """Создает ZIP-архив с полным шифрованием (AES-256).
+
+    files - относительные пути для архивации, extra - служебные файлы
+    {имя: содержимое}. Файлы сжимаются параллельно в workers процессах,
+    уже сжатые медиа (jpg, mp4, ogg...) записываются без сжатия.
+    При ошибке или отмене недописанный архив удаляется.
+    Возвращает записи для индекса архива.
+    """
+    return write_aes_zip(input_dir, output_zip, password, files, extra,
+                         workers=workers, level=level, progress=progress)
+
+
+def run_backup(settings: Dict[str, Any], prefix: str,
+               progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+               cancelled: Optional[Callable[[], bool]] = None) -> Dict[str, Any]:
+    """Полный цикл бэкапа: план, архив, фиксация манифеста.
+
+    Синхронная функция - выполняется в отдельном процессе (см. backup_runner).
+    settings: obsidian_path, backup_dir, password, format, incremental,
+    full_every, workers, level, zstd_level, max_age, max_count, exclude.
+    Если в инкрементальном режиме ничего не изменилось, архив не создается
+    и в плане выставляется 'skipped'. cancelled() - запрошена ли отмена: до
+    начала архивации progress не вызывается, поэтому обход вальта проверяет её сам.
+    """
+    input_dir = Path(settings['obsidian_path'])
+    backup_dir = Path(settings['backup_dir'])
+    backup_dir.mkdir(parents=True, exist_ok=True)
+
+    if settings['format'] == 'chunks':
+        return _run_store_backup(settings, input_dir, backup_dir, prefix, progress)
+
+    flt = vault_filter(settings)
+    plan = plan_backup(input_dir, backup_dir, prefix,
+                       incremental=settings['incremental'],
+                       full_every=settings['full_every'],
+                       suffix=ARCHIVE_SUFFIXES[settings['format']],
+                       flt=flt, cancelled=cancelled)
+    plan['skipped'] = False
+    extra = None
+    if plan['kind'] == 'delta':
+        if not plan['files'] and not plan['deleted']:
+            logger.info("Бэкап: изменений с прошлого архива нет")
+            plan['skipped'] = True
+            return plan
+        extra = {DELTA_MEMBER: delta_member(plan)}
+
+    files = plan['files'] if plan['files'] is not None else list_vault_files(input_dir, flt)
+    files_total = len(files)
+    bytes_total = _vault_size(input_dir, files)
+    report = _progress_reporter(progress, files_total, bytes_total)
+    report(0, 0)
+    if settings['format'] == 'tar.zst':
+        entries = write_tar_zst(input_dir, plan['archive'], settings['password'],
+                                files=files, extra=extra, level=settings['zstd_level'],
+                                progress=report)
+    else:
+        entries = create_zip_with_password(input_dir, plan['archive'], settings['password'],
+                                           files=files, extra=extra, progress=report,
+                                           workers=settings['workers'], level=settings['level'])
+    damaged = [entry['path'] for entry in entries if entry.get('damaged')]
+    # Неполные копии не предлагаем для восстановления
+    entries = [entry for entry in entries if not entry.get('damaged')]
+    if plan['manifest_files'] is not None:
+        # Файлы, которых нет в архиве (пропали, не читаются, скопированы не полностью), -
+        # без записи в манифесте инкрементальный бэкап сочтёт их новыми и возьмёт в следующий архив
+        written = {entry['path'] for entry in entries}
+        for path in files:
+            if path not in written:
+                plan['manifest_files'].pop(path, None)
+    plan['damaged'] = damaged
+    plan['files_total'] = files_total
+    plan['bytes_total'] = bytes_total
+    plan['files_count'] = len(files)
+    try:
+        write_index(plan['archive'], settings['password'], {
+            'kind': plan['kind'],
+            'format': settings['format'],
+            'parent': plan['parent'],
+            'base': plan['base'] or plan['archive'].name,
+            'created': time.time(),
+            'deleted': plan['deleted'],
+        }, entries)
+        commit_backup(backup_dir, plan)
+    except BaseException:
+        plan['archive'].unlink(missing_ok=True)
+        index_path(plan['archive']).unlink(missing_ok=True)
+        raise
+    plan['format'] = settings['format']
+    plan['bytes_written'] = plan['archive'].stat().st_size
+    # Полный список файлов в процесс бота не возвращаем - он может быть большим
+    plan['manifest_files'] = None
+    plan['files'] = None
+    return plan
+
+
+def _progress_reporter(progress, files_total: int, bytes_total: int):
+    def report(files_done: int, bytes_done: int):
+        if progress:
+            progress({
+                'files_done': files_done, 'files_total': files_total,
+                'bytes_done': bytes_done, 'bytes_total': bytes_total,
+            })
+    return report
+
+
+def _vault_size(input_dir: Path, files: List[str]) -> int:
+    total = 0
+    for arcname in files:
+        try:
+            total += (input_dir / arcname).stat().st_size
+        except OSError:
+            pass
+    return total
+
+
+def _run_store_backup(settings: Dict[str, Any], input_dir: Path, backup_dir: Path,
+                      prefix: str, progress) -> Dict[str, Any]:
+    """Снимок в хранилище с дедупликацией (BACKUP_FORMAT=chunks)"""
+    store = ChunkStore(backup_dir / STORE_DIR_NAME, settings['password'])
+    files = list_vault_files(input_dir, vault_filter(settings))
+    bytes_total = _vault_size(input_dir, files)
+    report = _progress_reporter(progress, len(files), bytes_total)
+    report(0, 0)
+    plan = backup_to_store(store, input_dir, files,
+                           f"{prefix}_{time.strftime('%Y%m%d_%H%M%S')}", report)
+    plan.update({
+        'skipped': False,
+        'format': 'chunks',
+        'bytes_written': plan['new_bytes'],
+        'files_count': len(files),
+        'files_total': len(files),
+        'bytes_total': bytes_total,
+    })
+    return plan
+
+
+def run_cleanup(settings: Dict[str, Any]) -> List[str]:
+    """Удаляет устаревшие бэкапы обоих форматов. Возвращает имена удалённых.
+
+    Для хранилища с дедупликацией удаляются снимки, а затем куски,
+    на которые больше никто не ссылается.
+    """
+    backup_dir = Path(settings['backup_dir'])
+    max_age = settings['max_age']
+    max_count = settings['max_count']
+
+    doomed = plan_cleanup(backup_dir, max_age, max_count)
+    for file in doomed:
+        file.unlink(missing_ok=True)
+        index_path(file).unlink(missing_ok=True)
+    forget_archives(backup_dir, [file.name for file in doomed])
+    removed = [file.name for file in doomed]
+
+    store_dir = backup_dir / STORE_DIR_NAME
+    if (store_dir / "store.json").exists():
+        store = ChunkStore(store_dir, settings['password'])
+        snapshots = store.list_snapshots()
+        now = time.time()
+        # Самый свежий снимок не удаляем никогда
+        expired = [path for path in snapshots[:-1]
+                   if max_age is not None and (now - path.stat().st_mtime) // 86400 > max_age]
+        alive = [path for path in snapshots if path not in expired]
+        if max_count is not None and len(alive) > max_count:
+            expired += alive[:len(alive) - max(max_count, 1)]
+        for path in expired:
+            path.unlink(missing_ok=True)
+            removed.append(path.name)
+        chunks, freed = store.gc()
+        if chunks:
+            logger.info(f"Очистка хранилища: удалено кусков {chunks}, "
+                        f"освобождено {freed / 1024 / 1024:.1f} МБ")
+    return removed
+
+
+def list_backups(settings: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Список бэкапов от новых к старым. Архивы не открываются: сведения
+    берутся из индекса цепочек и атрибутов файлов"""
+    backup_dir = Path(settings['backup_dir'])
+    if not backup_dir.exists():
+        return []
+    chains = load_chains(backup_dir)
+    backups = []
+    for archive in list_archives(backup_dir):
+        meta = chains.get(archive.name, {})
+        st = archive.stat()
+        backups.append({
+            'name': archive.name,
+            'kind': meta.get('kind', 'full'),
+            'created': meta.get('created', st.st_mtime),
+            'files': meta.get('files'),
+            'size': st.st_size,
+            'indexed': index_path(archive).exists(),
+        })
+    snapshots_dir = backup_dir / STORE_DIR_NAME / "snapshots"
+    if snapshots_dir.exists():
+        for snapshot in snapshots_dir.glob(f"*{SNAPSHOT_SUFFIX}"):
+            st = snapshot.stat()
+            backups.append({
+                'name': snapshot.name,
+                'kind': 'snapshot',
+                'created': st.st_mtime,
+                'files': None,
+                'size': st.st_size,
+                'indexed': True,
+            })
+    backups.sort(key=lambda item: item['created'], reverse=True)
+    return backups
@@ -0,0 +1,340 @@
+"""Хранилище бэкапов с дедупликацией.
+
+Файлы режутся на куски по содержимому (content-defined chunking), каждый
+уникальный кусок хранится один раз в зашифрованном виде (AES-256-GCM), а снимок
+вальта - это небольшой зашифрованный список ссылок на куски. Семь ежедневных
+снимков почти не отличающегося вальта занимают чуть больше одного.
+
+Структура папки:
+    store.json          соль и контрольное значение для проверки пароля
+    chunks/ab/<id>      куски, id = HMAC-SHA256 содержимого
+    snapshots/<имя>.snap
+"""
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+import zlib
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Any
+
+try:
+    import numpy as np
+except ImportError:  # без numpy границы кусков ищутся циклом на Python - в десятки раз медленнее
+    np = None
+
+from utils.crypto_utils import SALT_SIZE, DecryptionError, decrypt_blob, derive_key, encrypt_blob
+from utils.zip_writer import COMPRESSED_EXTENSIONS
+
+logger = logging.getLogger(__name__)
+
+STORE_DIR_NAME = "chunkstore"
+SNAPSHOT_SUFFIX = ".snap"
+
+MIN_CHUNK = 256 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+AVG_MASK = (1 << 20) - 1  # средний размер куска ~1 МБ
+READ_SIZE = 8 * 1024 * 1024
+# Младшие биты Gear-хэша, которые проверяет AVG_MASK, зависят только от
+# последних стольких байт - поэтому хэш можно считать блоками, независимо
+CUT_WINDOW = AVG_MASK.bit_length()
+SCAN_BLOCK = 256 * 1024
+
+RAW = b'\x00'
+DEFLATED = b'\x01'
+
+_M64 = (1 << 64) - 1
+_GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'little') for i in range(256)]
+
+
+_GEAR_LOW = np.array([g & 0xFFFFFFFF for g in _GEAR], dtype=np.uint32) if np is not None else None
+
+
+def _find_cut(buf: bytes) -> int:
+    """Граница куска по Gear-хэшу (FastCDC без нормализации).
+
+    Файлы меньше MIN_CHUNK не просматриваются вовсе. С numpy хэш считается
+    сразу для блока SCAN_BLOCK байт (~100 МБ/с); без него - по байту
+    в цикле на Python (~6 МБ/с), и на больших заметках и PDF это дольше
+    хэширования и шифрования вместе взятых. Границы в обоих случаях одинаковые.
+    """
+    end = min(len(buf), MAX_CHUNK)
+    if end <= MIN_CHUNK:
+        return end
+    if np is not None:
+        return _find_cut_blocks(buf, end)
+    gear = _GEAR
+    h = 0
+    for i in range(MIN_CHUNK, end):
+        h = ((h << 1) + gear[buf[i]]) & _M64
+        if not h & AVG_MASK:
+            return i + 1
+    return end
+
+
+def _window_sums(gear, width: int):
+    """sum(gear[i - k] << k for k < width) для каждого i - удвоением окна, за log2(width) шагов"""
+    total, covered = None, 0
+    part, size = gear, 1   # part[i] - такая же сумма по окну из size байт
+    while width:
+        if width & 1:
+            if total is None:
+                total = part.copy()
+            else:
+                total[covered:] += part[:len(part) - covered] << covered
+            covered += size
+        width >>= 1
+        if width:
+            doubled = part.copy()
+            doubled[size:] += part[:len(part) - size] << size
+            part, size = doubled, size * 2
+    return total
+
+
+def _find_cut_blocks(buf: bytes, end: int) -> int:
+    """То же, что цикл в _find_cut, но блоками на numpy: младшие CUT_WINDOW бит хэша
+    в позиции i - это сумма gear[buf[i - k]] << k по k < CUT_WINDOW (по модулю 2**32)"""
+    view = memoryview(buf)
+    start = MIN_CHUNK
+    while start < end:
+        stop = min(end, start + SCAN_BLOCK)
+        # Хэш начинается с нуля в MIN_CHUNK, поэтому байты до него не учитываются
+        first = max(MIN_CHUNK, start - CUT_WINDOW + 1)
+        h = _window_sums(_GEAR_LOW[np.frombuffer(view[first:stop], dtype=np.uint8)], CUT_WINDOW)
+        hits = np.flatnonzero((h[start - first:] & AVG_MASK) == 0)
+        if hits.size:
+            return start + int(hits[0]) + 1
+        start = stop
+    return end
+
+
+def iter_chunks(path: Path) -> Iterator[bytes]:
+    """Режет файл на куски.
+
+    Медиа (jpg, mp4, ogg...) не редактируются на месте, поэтому их режем на
+    куски фиксированного размера - это быстрее и дедуплицируется так же.
+    """
+    fixed = path.suffix.lower() in COMPRESSED_EXTENSIONS
+    with open(path, 'rb') as f:
+        if fixed:
+            while chunk := f.read(MAX_CHUNK):
+                yield chunk
+            return
+        buf = b''
+        eof = False
+        while True:
+            if not eof and len(buf) < MAX_CHUNK:
+                data = f.read(READ_SIZE)
+                eof = not data
+                buf += data
+                continue
+            if not buf:
+                return
+            cut = _find_cut(buf)
+            yield buf[:cut]
+            buf = buf[cut:]
+
+
+class ChunkStore:
+    def __init__(self, root: Path, password: str):
+        self.root = root
+        self.chunks_dir = root / "chunks"
+        self.snapshots_dir = root / "snapshots"
+        self.chunks_dir.mkdir(parents=True, exist_ok=True)
+        self.snapshots_dir.mkdir(parents=True, exist_ok=True)
+
+        meta_path = root / "store.json"
+        if meta_path.exists():
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            keys = derive_key(password, bytes.fromhex(meta['salt']), 64)
+            self._enc_key, self._id_key = keys[:32], keys[32:]
+            decrypt_blob(self._enc_key, bytes.fromhex(meta['check']), b'check')
+        else:
+            salt = os.urandom(SALT_SIZE)
+            keys = derive_key(password, salt, 64)
+            self._enc_key, self._id_key = keys[:32], keys[32:]
+            meta = {
+                'version': 1,
+                'salt': salt.hex(),
+                'check': encrypt_blob(self._enc_key, b'obsitele', b'check').hex(),
+            }
+            tmp_path = meta_path.with_suffix('.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, meta_path)
+
+    # --- куски ---
+
+    def chunk_id(self, data: bytes) -> str:
+        return hmac.new(self._id_key, data, hashlib.sha256).hexdigest()
+
+    def _chunk_path(self, chunk_id: str) -> Path:
+        return self.chunks_dir / chunk_id[:2] / chunk_id
+
+    def put_chunk(self, data: bytes, compress: bool = True):
+        """Сохраняет кусок, если такого ещё нет. Возвращает (id, записано_байт)"""
+        chunk_id = self.chunk_id(data)
+        path = self._chunk_path(chunk_id)
+        if path.exists():
+            return chunk_id, 0
+        body = RAW + data
+        if compress:
+            packed = zlib.compress(data, 6)
+            if len(packed) < len(data):
+                body = DEFLATED + packed
+        blob = encrypt_blob(self._enc_key, body, chunk_id.encode())
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(blob)
+        os.replace(tmp_path, path)
+        return chunk_id, len(blob)
+
+    def get_chunk(self, chunk_id: str) -> bytes:
+        with open(self._chunk_path(chunk_id), 'rb') as f:
+            body = decrypt_blob(self._enc_key, f.read(), chunk_id.encode())
+        return zlib.decompress(body[1:]) if body[:1] == DEFLATED else body[1:]
+
+    # --- снимки ---
+
+    def snapshot_path(self, name: str) -> Path:
+        return self.snapshots_dir / f"{name}{SNAPSHOT_SUFFIX}"
+
+    def list_snapshots(self) -> List[Path]:
+        """Снимки от старых к новым (без расшифровки)"""
+        return sorted(self.snapshots_dir.glob(f"*{SNAPSHOT_SUFFIX}"), key=os.path.getmtime)
+
+    def save_snapshot(self, name: str, snapshot: Dict[str, Any]):
+        data = zlib.compress(json.dumps(snapshot, ensure_ascii=False).encode('utf-8'))
+        path = self.snapshot_path(name)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(encrypt_blob(self._enc_key, data, b'snapshot'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def load_snapshot(self, path: Path) -> Dict[str, Any]:
+        with open(path, 'rb') as f:
+            data = decrypt_blob(self._enc_key, f.read(), b'snapshot')
+        return json.loads(zlib.decompress(data))
+
+    def gc(self):
+        """Удаляет куски, на которые не ссылается ни один снимок.
+
+        Возвращает (удалено_кусков, освобождено_байт).
+        """
+        live = set()
+        for path in self.list_snapshots():
+            for _, _, chunks in self.load_snapshot(path)['files'].values():
+                live.update(chunks)
+        removed = 0
+        freed = 0
+        for path in self.chunks_dir.glob("*/*"):
+            if path.name not in live:
+                freed += path.stat().st_size
+                path.unlink()
+                removed += 1
+        return removed, freed
+
+
+class _ChangedWhileReading(Exception):
+    """Размер или mtime файла изменились, пока он резался на куски"""
+
+
+def backup_to_store(store: ChunkStore, input_dir: Path, files: List[str], name: str,
+                    progress: Optional[Callable[[int, int], None]] = None) -> Dict[str, Any]:
+    """Создает снимок вальта. Файлы с теми же размером и mtime, что в прошлом
+    снимке, не перечитываются.
+
+    Файл, который не удалось прочитать или который изменился во время чтения,
+    в снимок попадает в прошлой версии (если она была), а в 'damaged' плана -
+    его путь: его размер и mtime не совпадут с записанными, и следующий снимок
+    прочитает его заново. Если бэкап прерван, записанные куски без снимка
+    удалит следующий gc.
+    """
+    previous = {}
+    snapshots = store.list_snapshots()
+    if snapshots:
+        try:
+            previous = store.load_snapshot(snapshots[-1])['files']
+        except (DecryptionError, OSError, ValueError) as e:
+            logger.warning(f"Не удалось прочитать прошлый снимок: {str(e)}")
+
+    entries = {}
+    damaged = []
+    new_chunks = 0
+    new_bytes = 0
+    bytes_done = 0
+    for files_done, arcname in enumerate(files, 1):
+        path = input_dir / arcname
+        old = previous.get(arcname)
+        try:
+            st = path.stat()
+            if old and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+                entries[arcname] = old
+            else:
+                compress = path.suffix.lower() not in COMPRESSED_EXTENSIONS
+                chunks = []
+                size = 0
+                for chunk in iter_chunks(path):
+                    chunk_id, written = store.put_chunk(chunk, compress)
+                    chunks.append(chunk_id)
+                    size += len(chunk)
+                    if written:
+                        new_chunks += 1
+                        new_bytes += written
+                after = path.stat()
+                if size != st.st_size or after.st_size != st.st_size or after.st_mtime_ns != st.st_mtime_ns:
+                    raise _ChangedWhileReading()
+                entries[arcname] = [st.st_size, st.st_mtime_ns, chunks]
+            bytes_done += st.st_size
+        except FileNotFoundError:
+            # Файл удалили между сканированием и архивацией
+            logger.warning(f"Файл пропал во время бэкапа: {arcname}")
+        except (OSError, _ChangedWhileReading) as e:
+            # В живом вальте (Syncthing, Obsidian) это обычное дело - снимок остальных файлов продолжается
+            reason = "изменился во время чтения" if isinstance(e, _ChangedWhileReading) else str(e)
+            logger.warning(f"{arcname} не сохранён ({reason}), "
+                           f"{'в снимке прошлая версия' if old else 'в снимок не попал'}")
+            damaged.append(arcname)
+            if old:
+                entries[arcname] = old
+        if progress:
+            progress(files_done, bytes_done)
+
+    store.save_snapshot(name, {'name': name, 'created': time.time(), 'files': entries})
+    return {
+        'archive': store.snapshot_path(name),
+        'kind': 'snapshot',
+        'new_chunks': new_chunks,
+        'new_bytes': new_bytes,
+        'damaged': damaged,
+    }
+
+
+def restore_from_store(store: ChunkStore, snapshot: Path, target: Path,
+                       paths: Optional[List[str]] = None) -> int:
+    """Восстанавливает файлы снимка в target. paths - файлы или папки (None - все).
+
+    Возвращает количество восстановленных файлов.
+    """
+    files = store.load_snapshot(snapshot)['files']
+    restored = 0
+    for arcname, (size, mtime_ns, chunks) in files.items():
+        if paths and not any(arcname == p or arcname.startswith(p.rstrip('/') + '/') for p in paths):
+            continue
+        dest = target / arcname
+        if not dest.resolve().is_relative_to(target.resolve()):
+            logger.warning(f"Пропускаю подозрительный путь: {arcname}")
+            continue
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        with open(dest, 'wb') as f:
+            for chunk_id in chunks:
+                f.write(store.get_chunk(chunk_id))
+        os.utime(dest, ns=(mtime_ns, mtime_ns))
+        restored += 1
+    return restored
@@ -0,0 +1,38 @@
+import hashlib
+import os
+
+from Cryptodome.Cipher import AES
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+SALT_SIZE = 16
+
+
+class DecryptionError(Exception):
+    """Неверный пароль или повреждённые данные"""
+
+
+def derive_key(password: str, salt: bytes, length: int = 32) -> bytes:
+    """Ключ из BACKUP_PASSWORD (scrypt, ~32 МБ памяти и ~0.1 с на вычисление)"""
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt,
+                          n=2 ** 15, r=8, p=1, maxmem=64 * 1024 * 1024, dklen=length)
+
+
+def encrypt_blob(key: bytes, data: bytes, aad: bytes = b'') -> bytes:
+    """AES-256-GCM: nonce + шифротекст + тег"""
+    nonce = os.urandom(NONCE_SIZE)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(aad)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    return nonce + ciphertext + tag
+
+
+def decrypt_blob(key: bytes, blob: bytes, aad: bytes = b'') -> bytes:
+    if len(blob) < NONCE_SIZE + TAG_SIZE:
+        raise DecryptionError("Слишком короткий зашифрованный блок")
+    cipher = AES.new(key, AES.MODE_GCM, nonce=blob[:NONCE_SIZE])
+    cipher.update(aad)
+    try:
+        return cipher.decrypt_and_verify(blob[NONCE_SIZE:-TAG_SIZE], blob[-TAG_SIZE:])
+    except ValueError:
+        raise DecryptionError("Неверный пароль или данные повреждены")
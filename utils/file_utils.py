@@ -1,12 +1,14 @@
-import asyncio
-from datetime import datetime
 from pathlib import Path
-from typing import Dict, Any
+from typing import List
+import errno
+import hashlib
 import logging
+import os
+import shutil
+import time
+import config
 logger = logging.getLogger(__name__)
 
-media_group_data: Dict[str, Dict[str, Any]] = {}
-
 def ensure_dirs_exist(base_path: Path):
     """Создаём все необходимые папки для медиа"""
     required_dirs = ['photos', 'videos', 'files', 'voices']
@@ -19,10 +21,132 @@ def ensure_dirs_exist(base_path: Path):
             raise
 
 
-async def cleanup_media_groups():
-    while True:
-        await asyncio.sleep(3600)
-        current_time = datetime.now()
-        for group_id in list(media_group_data):
-            if (current_time - media_group_data[group_id]['timestamp']).total_seconds() > 86400:
-                del media_group_data[group_id]
+# Где служебные файлы лежали раньше - внутри вальта (см. state_dir)
+LEGACY_STATE_NAME = ".tg-bot"
+_state_checked = set()
+
+
+def default_state_dir() -> Path:
+    """Папка по умолчанию - вне вальта: служебные файлы (в том числе живая база SQLite)
+    не должны синхронизироваться Syncthing между устройствами и попадать в бэкапы.
+    У каждого вальта своя подпапка"""
+    base = Path(os.getenv("XDG_STATE_HOME") or Path.home() / ".local" / "state")
+    vault = Path(config.OBSIDIAN_PATH).resolve()
+    digest = hashlib.sha1(str(vault).encode('utf-8')).hexdigest()[:8]
+    return base / "obsidian-tg-bot" / f"{vault.name or 'vault'}-{digest}"
+
+
+def _migrate_legacy_state(path: Path):
+    """Переносит служебные файлы из .tg-bot внутри вальта (как было раньше) в path"""
+    legacy = Path(config.OBSIDIAN_PATH) / LEGACY_STATE_NAME
+    if not config.OBSIDIAN_PATH or not legacy.is_dir() or legacy.resolve() == path.resolve():
+        return
+    moved = 0
+    for item in legacy.iterdir():
+        if not (path / item.name).exists():
+            shutil.move(str(item), str(path / item.name))
+            moved += 1
+    logger.info(f"Служебные файлы перенесены из {legacy} в {path}: {moved}")
+    try:
+        legacy.rmdir()
+    except OSError:
+        logger.warning(f"В {legacy} остались файлы - их можно удалить вручную")
+
+
+def state_dir() -> Path:
+    """Папка для служебных файлов бота (журналы, индексы): STATE_DIR или default_state_dir()"""
+    path = Path(config.STATE_DIR) if config.STATE_DIR else default_state_dir()
+    path.mkdir(parents=True, exist_ok=True)
+    if path not in _state_checked:
+        _state_checked.add(path)
+        _migrate_legacy_state(path)
+    return path
+
+
+# Недокачанные файлы: внутри вальта, чтобы готовый файл переносился в папку
+# медиа переименованием, а не копированием (STATE_DIR может быть на другой ФС)
+DOWNLOADS_NAME = ".tg-downloads"
+# Недокачанное после перезапуска докачивается (журнал сообщений), более старое удаляется
+DOWNLOADS_MAX_AGE = 24 * 3600
+
+
+def downloads_dir() -> Path:
+    """Папка для скачиваемых файлов. Obsidian не показывает папки с точкой, бэкап
+    и слежение за вальтом её пропускают (state_exclude_rules), для Syncthing её
+    нужно добавить в .stignore"""
+    path = Path(config.OBSIDIAN_PATH) / DOWNLOADS_NAME
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def sweep_downloads(max_age: float = DOWNLOADS_MAX_AGE) -> int:
+    """Удаляет брошенные загрузки старше max_age секунд. Возвращает, сколько удалено"""
+    removed = 0
+    cutoff = time.time() - max_age
+    for entry in os.scandir(downloads_dir()):
+        try:
+            if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+                removed += 1
+        except OSError as e:
+            logger.warning(f"Не удалось удалить {entry.name}: {str(e)}")
+    if removed:
+        logger.info(f"Удалено брошенных загрузок: {removed}")
+    return removed
+
+
+def state_exclude_rules() -> List[str]:
+    """Правила исключения служебных файлов из бэкапа и слежения: недокачанные файлы,
+    старая папка .tg-bot (если перенести её не удалось) и STATE_DIR, если он всё же внутри вальта"""
+    rules = ['/' + DOWNLOADS_NAME + '/', '/' + LEGACY_STATE_NAME + '/']
+    if not config.OBSIDIAN_PATH:
+        return rules
+    vault = Path(config.OBSIDIAN_PATH).resolve()
+    state = state_dir().resolve()
+    if state.is_relative_to(vault) and state != vault:
+        rules.append('/' + state.relative_to(vault).as_posix() + '/')
+    return rules
+
+
+
+# ioctl FICLONE: копия, разделяющая блоки с исходным файлом (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def _reflink(source: Path, destination: Path):
+    import fcntl
+    with open(source, 'rb') as src, open(destination, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            destination.unlink(missing_ok=True)
+            raise
+
+
+def link_or_copy(source: Path, destination: Path, allow_move: bool = False) -> str:
+    """Переносит файл без копирования данных, если получится.
+
+    По очереди пробует жёсткую ссылку, reflink и (если allow_move) переименование -
+    все три работают только в пределах одной ФС. Иначе копирует (на Linux копирование
+    идёт внутри ядра). Возвращает способ: link, reflink, move или copy.
+    """
+    try:
+        os.link(source, destination)
+        return 'link'
+    except OSError as e:
+        logger.debug(f"Жёсткая ссылка на {source.name} не создана: {str(e)}")
+    try:
+        _reflink(source, destination)
+        return 'reflink'
+    except (OSError, ImportError) as e:
+        logger.debug(f"reflink для {source.name} не создан: {str(e)}")
+    if allow_move:
+        try:
+            os.rename(source, destination)
+            return 'move'
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                logger.debug(f"Не удалось переместить {source.name}: {str(e)}")
+    shutil.copyfile(source, destination)
+    return 'copy'
@@ -0,0 +1,139 @@
+"""Журнал входящих сообщений (SQLite в режиме WAL).
+
+Сообщение записывается в журнал сразу при получении, до скачивания медиа,
+и отмечается выполненным, когда заметка записана. Если бот перезапустился
+посередине, невыполненные записи обрабатываются заново при старте
+(pending() отдаёт их по порядку получения). Повторно присланное Telegram
+сообщение (тот же chat_id и message_id) в журнал второй раз не попадает.
+
+Выполненные записи хранятся keep секунд (для отсева повторов), потом
+compact() удаляет их и возвращает место на диске.
+
+Все обращения к базе идут через один поток: цикл событий не ждёт диска.
+"""
+import asyncio
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS updates (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL,
+    done REAL,
+    UNIQUE (chat_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS updates_pending ON updates (id) WHERE done IS NULL;
+CREATE INDEX IF NOT EXISTS updates_done ON updates (done) WHERE done IS NOT NULL;
+"""
+
+
+class IngestJournal:
+    def __init__(self, path: Path, keep: float = 24 * 3600, synchronous: str = 'NORMAL'):
+        self.path = path
+        self.keep = keep
+        self.synchronous = synchronous
+        # Появились новые записи - pending() есть что отдать
+        self.added = asyncio.Event()
+        self.stats = {'added': 0, 'duplicates': 0, 'done': 0, 'compacted': 0}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest-journal')
+        self._db: Optional[sqlite3.Connection] = None
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            # auto_vacuum можно включить только до создания таблиц
+            db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            db.execute("PRAGMA journal_mode = WAL")
+            # NORMAL в режиме WAL: запись переживает падение бота, fsync - при checkpoint
+            db.execute(f"PRAGMA synchronous = {self.synchronous}")
+            db.executescript(SCHEMA)
+            self._db = db
+        return self._db
+
+    # --- запросы (выполняются в потоке журнала) ---
+
+    def _add(self, chat_id: int, message_id: int, payload: str) -> Optional[int]:
+        cursor = self._connect().execute(
+            "INSERT OR IGNORE INTO updates (chat_id, message_id, payload, created) VALUES (?, ?, ?, ?)",
+            (chat_id, message_id, payload, time.time()))
+        return cursor.lastrowid if cursor.rowcount else None
+
+    def _pending(self, after: int, limit: int) -> List[Tuple[int, str]]:
+        return self._connect().execute(
+            "SELECT id, payload FROM updates WHERE done IS NULL AND id > ? ORDER BY id LIMIT ?",
+            (after, limit)).fetchall()
+
+    def _mark_done(self, ids: List[int]):
+        now = time.time()
+        db = self._connect()
+        db.execute("BEGIN")
+        try:
+            db.executemany("UPDATE updates SET done = ? WHERE id = ?", [(now, jid) for jid in ids])
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _compact(self) -> int:
+        db = self._connect()
+        deleted = db.execute("DELETE FROM updates WHERE done IS NOT NULL AND done < ?",
+                             (time.time() - self.keep,)).rowcount
+        # execute() выполнил бы только первый шаг incremental_vacuum, executescript - целиком
+        db.executescript("PRAGMA incremental_vacuum;")
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return deleted
+
+    def _count_pending(self) -> int:
+        return self._connect().execute("SELECT count(*) FROM updates WHERE done IS NULL").fetchone()[0]
+
+    # --- интерфейс для цикла событий ---
+
+    async def add(self, chat_id: int, message_id: int, payload: str) -> Optional[int]:
+        """Записывает сообщение. None - такое сообщение уже было"""
+        journal_id = await self._call(self._add, chat_id, message_id, payload)
+        if journal_id is None:
+            self.stats['duplicates'] += 1
+            logger.info(f"Сообщение {message_id} из чата {chat_id} уже получено, пропускаю")
+        else:
+            self.stats['added'] += 1
+            self.added.set()
+        return journal_id
+
+    async def pending(self, after: int = 0, limit: int = 100) -> List[Tuple[int, str]]:
+        """Невыполненные записи с id больше after по порядку получения"""
+        return await self._call(self._pending, after, limit)
+
+    async def mark_done(self, ids: Iterable[int]):
+        ids = list(ids)
+        if ids:
+            await self._call(self._mark_done, ids)
+            self.stats['done'] += len(ids)
+
+    async def count_pending(self) -> int:
+        return await self._call(self._count_pending)
+
+    async def compact(self) -> int:
+        deleted = await self._call(self._compact)
+        self.stats['compacted'] += deleted
+        if deleted:
+            logger.debug(f"Журнал сообщений: удалено выполненных записей {deleted}")
+        return deleted
+
+    async def close(self):
+        if self._db is not None:
+            await self._call(self._db.close)
+            self._db = None
+        self._executor.shutdown(wait=False)
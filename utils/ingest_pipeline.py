@@ -0,0 +1,213 @@
+"""Конвейер обработки входящих сообщений.
+
+    приём (submit) -> fetch: скачать медиа -> render: собрать текст -> persist: записать
+
+Этапы связаны очередями ограниченной длины: если скачивание или запись не
+успевают, submit() ждёт свободного места, и приём сообщений притормаживает,
+а не копит сотни одновременных обработчиков. У каждого этапа свой пул
+обработчиков (workers).
+
+Сообщения одного чата записываются в порядке приёма, даже если медиа второго
+скачалось раньше первого: перед persist они выстраиваются по номеру (seq).
+Номер можно занять заранее через reserve() - так альбом, который собирается
+несколько секунд, не окажется в заметке после сообщений, пришедших за ним.
+
+persist(job) выполняется строго по порядку и может вернуть awaitable - остаток
+работы (ожидание записи на диск, ответ пользователю), который выполняется
+отдельно и не задерживает persist следующих сообщений.
+
+Задание - словарь: chat_id и любые поля обработчиков. Исключение на этапе
+записывается в job['error'], дальнейшие этапы, кроме persist, пропускаются.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from utils.metrics import STAGE_SECONDS, slow_handlers
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+class Stage:
+    def __init__(self, name: str, handler: Handler, workers: int, queue_size: int):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self.busy = 0
+        self.stats = {'done': 0, 'errors': 0, 'time': 0.0, 'max_time': 0.0}
+
+    def record(self, elapsed: float, failed: bool):
+        self.stats['done'] += 1
+        self.stats['errors'] += failed
+        self.stats['time'] += elapsed
+        self.stats['max_time'] = max(self.stats['max_time'], elapsed)
+
+    def snapshot(self) -> Dict[str, Any]:
+        done = self.stats['done']
+        return {
+            'depth': self.queue.qsize(), 'busy': self.busy, 'workers': self.workers,
+            'done': done, 'errors': self.stats['errors'],
+            'avg_ms': self.stats['time'] / done * 1000 if done else 0.0,
+            'max_ms': self.stats['max_time'] * 1000,
+        }
+
+
+class IngestPipeline:
+    def __init__(self, fetch: Handler, render: Handler, persist: Handler,
+                 workers: Dict[str, int], queue_size: int = 100):
+        self.stages: List[Stage] = [
+            Stage(name, handler, workers.get(name, 1), queue_size)
+            for name, handler in (('fetch', fetch), ('render', render), ('persist', persist))
+        ]
+        self._seq: Dict[int, int] = {}
+        self._next: Dict[int, int] = {}
+        self._held: Dict[int, Dict[int, Dict[str, Any]]] = {}
+        # Последнее по порядку сообщение чата, отданное в persist: следующее ждёт его
+        self._tail: Dict[int, asyncio.Future] = {}
+        self._release_lock = asyncio.Lock()
+        self._tasks: Set[asyncio.Task] = set()
+        self._finishing: Set[asyncio.Task] = set()
+        self.stats = {'accepted': 0, 'completed': 0, 'time': 0.0, 'max_time': 0.0}
+
+    def reserve(self, chat_id: int) -> int:
+        """Занимает место в очереди чата для сообщения, которое придёт в submit позже"""
+        seq = self._seq.get(chat_id, 0)
+        self._seq[chat_id] = seq + 1
+        return seq
+
+    async def submit(self, job: Dict[str, Any], seq: Optional[int] = None):
+        """Принимает задание. Ждёт, если очередь первого этапа заполнена"""
+        job['seq'] = self.reserve(job['chat_id']) if seq is None else seq
+        job['accepted'] = time.perf_counter()
+        job.setdefault('error', None)
+        self.stats['accepted'] += 1
+        await self.stages[0].queue.put(job)
+
+    def start(self):
+        for index, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                task = asyncio.create_task(self._worker(index))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        logger.info("Конвейер сообщений запущен: " +
+                    ", ".join(f"{stage.name} x{stage.workers}" for stage in self.stages))
+
+    async def stop(self):
+        """Дожидается обработки принятых сообщений и останавливает обработчики"""
+        for stage in self.stages:
+            await stage.queue.join()
+        await asyncio.gather(*self._finishing, return_exceptions=True)
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        completed = self.stats['completed']
+        return {
+            'stages': {stage.name: stage.snapshot() for stage in self.stages},
+            'held': sum(len(held) for held in self._held.values()),
+            'accepted': self.stats['accepted'],
+            'completed': completed,
+            'avg_ms': self.stats['time'] / completed * 1000 if completed else 0.0,
+            'max_ms': self.stats['max_time'] * 1000,
+        }
+
+    async def _worker(self, index: int):
+        stage = self.stages[index]
+        last = index == len(self.stages) - 1
+        while True:
+            job = await stage.queue.get()
+            try:
+                if last:
+                    await self._persist(stage, job)
+                else:
+                    if job['error'] is None:
+                        await self._run(stage, job)
+                    if index == len(self.stages) - 2:
+                        await self._release(job)
+                    else:
+                        await self.stages[index + 1].queue.put(job)
+            except Exception as e:
+                logger.error(f"Ошибка конвейера на этапе {stage.name}: {str(e)}", exc_info=True)
+            finally:
+                stage.queue.task_done()
+
+    async def _run(self, stage: Stage, job: Dict[str, Any]) -> Any:
+        stage.busy += 1
+        started = time.perf_counter()
+        try:
+            with slow_handlers.watch(f"ingest:{stage.name}"):
+                return await stage.handler(job)
+        except Exception as e:
+            logger.error(f"Этап {stage.name}: {type(e).__name__}: {str(e)}", exc_info=True)
+            job['error'] = e
+        finally:
+            stage.busy -= 1
+            elapsed = time.perf_counter() - started
+            stage.record(elapsed, job['error'] is not None)
+            STAGE_SECONDS.observe(elapsed, stage=stage.name)
+
+    async def _release(self, job: Dict[str, Any]):
+        """Передаёт задания в persist по порядку seq внутри чата"""
+        chat_id = job['chat_id']
+        async with self._release_lock:
+            held = self._held.setdefault(chat_id, {})
+            held[job['seq']] = job
+            next_seq = self._next.get(chat_id, 0)
+            while next_seq in held:
+                ready = held.pop(next_seq)
+                next_seq += 1
+                self._next[chat_id] = next_seq
+                ready['previous'] = self._tail.get(chat_id)
+                ready['ordered'] = self._tail[chat_id] = asyncio.get_running_loop().create_future()
+                await self.stages[-1].queue.put(ready)
+            if not held:
+                del self._held[chat_id]
+
+    async def _persist(self, stage: Stage, job: Dict[str, Any]):
+        chat_id = job['chat_id']
+        ordered = job.pop('ordered')
+        previous = job.pop('previous')
+        try:
+            if previous is not None:
+                await previous
+            rest = await self._run(stage, job)
+        finally:
+            ordered.set_result(None)
+            if self._tail.get(chat_id) is ordered:
+                del self._tail[chat_id]
+        if rest is None:
+            self._completed(job)
+            return
+        # Остаток не занимает обработчик этапа: следующее сообщение уже можно ставить в запись
+        task = asyncio.create_task(self._finish(stage, job, rest))
+        self._finishing.add(task)
+        task.add_done_callback(self._finishing.discard)
+
+    async def _finish(self, stage: Stage, job: Dict[str, Any], rest: Awaitable):
+        try:
+            await rest
+        except Exception as e:
+            logger.error(f"Этап {stage.name}: {type(e).__name__}: {str(e)}", exc_info=True)
+        self._completed(job)
+
+    def _completed(self, job: Dict[str, Any]):
+        elapsed = time.perf_counter() - job['accepted']
+        self.stats['completed'] += 1
+        self.stats['time'] += elapsed
+        self.stats['max_time'] = max(self.stats['max_time'], elapsed)
+
+
+def describe_pipeline(snapshot: Dict[str, Any]) -> str:
+    lines = [f"Принято: {snapshot['accepted']}, обработано: {snapshot['completed']}, "
+             f"ждут очереди в чате: {snapshot['held']}",
+             f"От приёма до записи: в среднем {snapshot['avg_ms']:.0f} мс, макс. {snapshot['max_ms']:.0f} мс"]
+    for name, stage in snapshot['stages'].items():
+        lines.append(f"{name}: в очереди {stage['depth']}, в работе {stage['busy']}/{stage['workers']}, "
+                     f"готово {stage['done']} (ошибок {stage['errors']}), "
+                     f"{stage['avg_ms']:.0f}/{stage['max_ms']:.0f} мс")
+    return "\n".join(lines)
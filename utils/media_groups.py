@@ -0,0 +1,87 @@
+"""Сборка альбомов (media group) из отдельных сообщений.
+
+Telegram присылает каждый файл альбома отдельным сообщением. Альбом
+считается собранным, когда после последнего сообщения прошло quiet секунд,
+в нём набралось max_items файлов (больше Telegram не присылает) или с
+первого сообщения прошло ttl секунд. Одновременно открыто не больше
+max_groups альбомов - при переполнении самый старый сохраняется досрочно.
+Собранный альбом сразу удаляется из памяти и передаётся в on_ready.
+"""
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Set, Tuple
+
+from aiogram import Bot, types
+
+from utils.metrics import ALBUM_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Альбом в Telegram - не больше 10 файлов
+MAX_ALBUM_ITEMS = 10
+
+
+class MediaGroupCollector:
+    def __init__(self, on_ready: Callable[[List[types.Message], Bot], Awaitable[None]],
+                 quiet: float, ttl: float, max_items: int = MAX_ALBUM_ITEMS, max_groups: int = 100):
+        self.on_ready = on_ready
+        self.quiet = quiet
+        self.ttl = ttl
+        self.max_items = max_items
+        self.max_groups = max_groups
+        # Словарь упорядочен по времени создания: первый - самый старый альбом
+        self._groups: Dict[Tuple[int, str], Dict[str, Any]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.stats = {'groups': 0, 'messages': 0, 'quiet': 0, 'full': 0, 'ttl': 0, 'overflow': 0}
+
+    def __len__(self) -> int:
+        return len(self._groups)
+
+    def add(self, message: types.Message, bot: Bot) -> bool:
+        """Добавляет сообщение в его альбом. True - это первое сообщение альбома"""
+        loop = asyncio.get_running_loop()
+        key = (message.chat.id, message.media_group_id)
+        group = self._groups.get(key)
+        first = group is None
+        if first:
+            if len(self._groups) >= self.max_groups:
+                self._finalize(next(iter(self._groups)), 'overflow')
+            group = {'messages': [], 'bot': bot, 'started': loop.time(), 'timer': None}
+            self._groups[key] = group
+            self.stats['groups'] += 1
+
+        group['messages'].append(message)
+        self.stats['messages'] += 1
+        if group['timer']:
+            group['timer'].cancel()
+        if len(group['messages']) >= self.max_items:
+            self._finalize(key, 'full')
+            return first
+
+        left = group['started'] + self.ttl - loop.time()
+        if left < self.quiet:
+            group['timer'] = loop.call_later(max(0.0, left), self._finalize, key, 'ttl')
+        else:
+            group['timer'] = loop.call_later(self.quiet, self._finalize, key, 'quiet')
+        return first
+
+    def _finalize(self, key: Tuple[int, str], reason: str):
+        group = self._groups.pop(key, None)
+        if group is None:
+            return
+        if group['timer']:
+            group['timer'].cancel()
+        self.stats[reason] += 1
+        ALBUM_WAIT_SECONDS.observe(asyncio.get_running_loop().time() - group['started'], reason=reason)
+        messages = sorted(group['messages'], key=lambda msg: msg.message_id)
+        logger.debug(f"Альбом {key[1]} собран ({reason}): файлов {len(messages)}, "
+                     f"открытых альбомов {len(self._groups)}")
+        task = asyncio.create_task(self._run(messages, group['bot']))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, messages: List[types.Message], bot: Bot):
+        try:
+            await self.on_ready(messages, bot)
+        except Exception as e:
+            logger.error(f"Ошибка обработки альбома: {str(e)}", exc_info=True)
@@ -0,0 +1,292 @@
+"""Сжатие фото после сохранения: превью для заметки, WebP/AVIF, без метаданных.
+
+Фото после записи заметки (и ответа "✅") обрабатываются в отдельных
+процессах - цикл событий бота этим не занят:
+
+    photo_3f2a9c1d.jpg -> thumbs/photo_3f2a9c1d_thumb.webp  (превью thumb_size пикселей)
+                       -> photo_3f2a9c1d.webp              (только по политике drop:
+                                                            не больше max_size пикселей, quality)
+
+По политике keep оригинал остаётся единственной полной копией, создаётся
+только превью. По drop оригинал заменяется сжатой копией, а индекс медиа
+(MediaStore) начинает указывать на неё.
+
+Имена файлов известны заранее, поэтому запись в заметке сразу пишется
+в итоговом виде - превью со ссылкой на полное фото (embed), и заметку не
+приходится переписывать: превью появляется через долю секунды после ответа.
+Если сжать не удалось, запись исправляется на ссылку на оригинал - только
+в этом случае заметка переписывается целиком. Оригинал удаляется (drop)
+только после того, как сжатая копия создана.
+
+Недоделанные задания записаны в optimize_queue.json в папке служебных файлов
+и продолжаются после перезапуска бота. Нужен Pillow; без него сжатие выключено.
+Голосовые и видео не перекодируются: Telegram уже отдаёт их в Opus/H.264,
+а для перекодирования понадобился бы ffmpeg.
+"""
+import asyncio
+import importlib.util
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from utils.backup_utils import load_json, save_json
+from utils.metrics import OPTIMIZE_BYTES, OPTIMIZE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('webp', 'avif')
+KEEP_POLICIES = ('keep', 'drop')
+QUEUE_NAME = "optimize_queue.json"
+THUMB_DIR = "thumbs"
+THUMB_QUALITY = 70
+
+
+# --- рабочий процесс ---
+
+def _save_image(image, path: Path, fmt: str, quality: int, metadata: Dict[str, Any]):
+    """Атомарная запись: пишем во временный файл и переименовываем"""
+    tmp_path = path.with_name(path.name + '.part')
+    options = {'quality': quality}
+    if fmt == 'webp':
+        options['method'] = 6
+    options.update(metadata)
+    image.save(tmp_path, format=fmt.upper(), **options)
+    os.replace(tmp_path, path)
+
+
+def avif_supported() -> bool:
+    from PIL import features
+    return bool(features.check('avif'))
+
+
+def optimize_image(source: str, target: Optional[str], thumb: Optional[str],
+                   settings: Dict[str, Any]) -> Dict[str, Any]:
+    """Создаёт target (сжатая копия) и thumb (превью) из source. Готовые файлы не пересоздаются"""
+    from PIL import Image, ImageOps
+
+    source_path = Path(source)
+    target_path = Path(target) if target else None
+    thumb_path = Path(thumb) if thumb else None
+    result = {'bytes_in': source_path.stat().st_size, 'bytes_out': 0, 'thumb_bytes': 0}
+    with Image.open(source_path) as original:
+        # Поворот из EXIF применяется к пикселям: после удаления EXIF фото не ляжет набок
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+        metadata = {}
+        if original.info.get('icc_profile'):
+            # Цветовой профиль - не личные данные, без него цвета поедут
+            metadata['icc_profile'] = original.info['icc_profile']
+        if not settings['strip_metadata']:
+            exif = original.getexif()
+            if exif:
+                metadata['exif'] = exif.tobytes()
+
+        if target_path is not None and not target_path.exists():
+            full = image.copy()
+            if settings['max_size']:
+                full.thumbnail((settings['max_size'], settings['max_size']), Image.Resampling.LANCZOS)
+            _save_image(full, target_path, settings['format'], settings['quality'], metadata)
+        if thumb_path is not None and not thumb_path.exists():
+            thumb_path.parent.mkdir(parents=True, exist_ok=True)
+            preview = image.copy()
+            preview.thumbnail((settings['thumb_size'], settings['thumb_size']), Image.Resampling.LANCZOS)
+            _save_image(preview, thumb_path, settings['format'], THUMB_QUALITY, metadata)
+
+    if target_path is not None:
+        result['bytes_out'] = target_path.stat().st_size
+    if thumb_path is not None:
+        result['thumb_bytes'] = thumb_path.stat().st_size
+    return result
+
+
+# --- цикл событий ---
+
+class MediaOptimizer:
+    def __init__(self, vault: Path, queue_path: Path, fmt: str = 'webp', max_size: int = 2560,
+                 quality: int = 80, strip_metadata: bool = True, thumbnails: bool = True,
+                 thumb_size: int = 320, keep: str = 'keep', workers: int = 1):
+        if fmt not in FORMATS:
+            raise ValueError(f"Неизвестный формат {fmt}, допустимы: {', '.join(FORMATS)}")
+        if keep not in KEEP_POLICIES:
+            raise ValueError(f"Неизвестная политика {keep}, допустимы: {', '.join(KEEP_POLICIES)}")
+        self.vault = vault
+        self.queue_path = queue_path
+        self.settings = {
+            'format': fmt, 'max_size': max_size, 'quality': quality,
+            'strip_metadata': strip_metadata, 'keep': keep, 'thumb_size': thumb_size,
+        }
+        self.thumbnails = thumbnails
+        self.workers = max(1, workers)
+        # Выключено, пока не проверено, что Pillow есть (start)
+        self.enabled = False
+        self.stats = {'done': 0, 'errors': 0, 'bytes_in': 0, 'bytes_out': 0}
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # Фото, которые ещё не обработаны: путь от корня вальта -> записи о нём
+        # в заметках [[путь заметки от корня вальта, текст внутри ![[...]]], ...]
+        # (нужны, только если сжать не удастся)
+        self._pending: Dict[str, List[List[str]]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._save_lock = asyncio.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    async def start(self):
+        """Проверяет Pillow и формат, продолжает задания с прошлого запуска"""
+        if importlib.util.find_spec('PIL') is None:
+            logger.warning("Сжатие фото выключено: не установлен Pillow (pip install pillow)")
+            return
+        if self.settings['format'] == 'avif':
+            loop = asyncio.get_running_loop()
+            if not await loop.run_in_executor(self._get_executor(), avif_supported):
+                logger.warning("Pillow собран без AVIF - фото будут сжиматься в WebP")
+                self.settings['format'] = 'webp'
+        self.enabled = True
+        pending = load_json(self.queue_path, {})
+        if pending:
+            logger.info(f"Сжатие фото: с прошлого запуска осталось {len(pending)}")
+            for rel, refs in pending.items():
+                self._schedule(rel, refs)
+
+    async def stop(self):
+        """Дожидается сжатия поставленных фото. Если процесс бота убит раньше,
+        очередь продолжится при следующем запуске (start)"""
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def plan(self, source: Path) -> Tuple[Optional[Path], Optional[Path]]:
+        """(сжатая копия, превью) для фото source; None - этот файл не нужен"""
+        ext = '.' + self.settings['format']
+        target = None
+        # По keep полная копия не нужна: заметка ссылается на оригинал
+        if self.settings['keep'] == 'drop' and source.suffix.lower() != ext:
+            target = source.with_suffix(ext)
+        thumb = source.parent / THUMB_DIR / f"{source.stem}_thumb{ext}" if self.thumbnails else None
+        return target, thumb
+
+    def embed(self, source: Path) -> str:
+        """Запись о фото в заметке: превью со ссылкой на полное фото (после сжатия)"""
+        target, thumb = self.plan(source)
+        link = (target or source).relative_to(self.vault).as_posix()
+        if thumb is None:
+            return f"![[{link}]]"
+        return f"[![](<{thumb.relative_to(self.vault).as_posix()}>)](<{link}>)"
+
+    def submit(self, note_path: Path, photos: List[Tuple[str, Path]]):
+        """Ставит фото в очередь и сразу возвращает управление.
+
+        photos - (текст внутри ![[...]] без сжатия, путь к файлу) для каждого фото,
+        которое записано в note_path как embed(): если сжать не удастся,
+        запись вернётся к ![[...]]
+        """
+        if not self.enabled:
+            return
+        note = note_path.relative_to(self.vault).as_posix()
+        for item, source in photos:
+            if self.plan(source) == (None, None):
+                continue
+            rel = source.relative_to(self.vault).as_posix()
+            ref = [note, item]
+            if rel not in self._pending:
+                self._schedule(rel, [ref])
+            elif ref not in self._pending[rel]:
+                # То же фото ещё в работе (например, переслали повторно в другую заметку).
+                # Повтор в ту же заметку не добавляем: одна замена исправит обе записи
+                self._pending[rel].append(ref)
+        self._track(asyncio.create_task(self._save()))
+
+    def _schedule(self, rel: str, refs: List[List[str]]):
+        self._pending[rel] = refs
+        self._track(asyncio.create_task(self._optimize(rel)))
+
+    def _track(self, task: asyncio.Task):
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _optimize(self, rel: str):
+        source = self.vault / rel
+        target, thumb = self.plan(source)
+        started = time.perf_counter()
+        if not source.exists() and target is not None and target.exists():
+            # Оригинал уже заменён сжатой копией, пока это фото сохранялось ещё раз
+            await self._finish(source, target)
+            del self._pending[rel]
+            await self._save()
+            return
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self._get_executor(), optimize_image, str(source),
+                str(target) if target else None, str(thumb) if thumb else None, self.settings)
+        except BrokenProcessPool:
+            # Процесс упал (например, OOM на огромной картинке) - пул пересоздастся
+            logger.error(f"Процесс сжатия аварийно завершился на {source.name}, в заметке остаётся оригинал")
+            self._executor = None
+            result = None
+        except Exception as e:
+            logger.error(f"Не удалось сжать {source.name}, в заметке остаётся оригинал: "
+                         f"{type(e).__name__}: {str(e)}")
+            result = None
+        try:
+            if result is None:
+                self.stats['errors'] += 1
+                await self._restore_entries(source)
+            else:
+                elapsed = time.perf_counter() - started
+                self.stats['done'] += 1
+                self.stats['bytes_in'] += result['bytes_in']
+                self.stats['bytes_out'] += result['bytes_out'] + result['thumb_bytes']
+                OPTIMIZE_SECONDS.observe(elapsed)
+                OPTIMIZE_BYTES.inc(result['bytes_in'], direction='in')
+                OPTIMIZE_BYTES.inc(result['bytes_out'] + result['thumb_bytes'], direction='out')
+                logger.info(f"Сжато {source.name}: {result['bytes_in'] / 1024:.0f} -> "
+                            f"{(result['bytes_out'] + result['thumb_bytes']) / 1024:.0f} КБ за {elapsed:.2f} с")
+                await self._finish(source, target)
+        except Exception as e:
+            # Задание остаётся в очереди: после перезапуска попробуем ещё раз
+            logger.error(f"Не удалось завершить сжатие {source.name}: {type(e).__name__}: {str(e)}")
+            return
+        del self._pending[rel]
+        await self._save()
+
+    async def _finish(self, source: Path, target: Optional[Path]):
+        """Сжатие удалось: по drop индекс медиа переводится на сжатую копию, оригинал удаляется"""
+        if target is None:
+            return
+        # Повторно присланное фото найдётся как сжатая копия
+        from utils.media_utils import get_media_store
+        await get_media_store().relocate(source, target)
+        await asyncio.to_thread(source.unlink, True)
+
+    async def _restore_entries(self, source: Path):
+        """Сжатие не удалось: записи о фото снова ссылаются на оригинал"""
+        from utils.note_utils import note_writer
+
+        embed = self.embed(source)
+        refs = self._pending[source.relative_to(self.vault).as_posix()]
+        # Пока записи исправляются, к фото могут добавиться новые (submit) - их тоже
+        while refs:
+            note, item = refs.pop(0)
+            plain = f"![[{item}]]"
+            if embed == plain:
+                continue
+            try:
+                if not await note_writer.replace(self.vault / note, embed, plain):
+                    logger.warning(f"Запись о {source.name} в {note} не найдена - её изменили вручную")
+            except Exception as e:
+                logger.error(f"Не удалось вернуть запись о {source.name} в {note}: {str(e)}")
+
+    async def _save(self):
+        snapshot = {rel: [list(ref) for ref in refs] for rel, refs in self._pending.items()}
+        async with self._save_lock:
+            await asyncio.to_thread(save_json, self.queue_path, snapshot)
@@ -0,0 +1,121 @@
+"""Хранение медиа без повторов.
+
+Имя файла строится из sha256 содержимого (photo_3f2a9c1d0b7e5a64.jpg), поэтому
+имена не совпадают у разных файлов, а одинаковый файл хранится один раз.
+Индекс (media_index.json в папке служебных файлов) помнит:
+    by_id   - file_unique_id из Telegram -> путь в вальте: повторно
+              пересланный файл вообще не скачивается;
+    by_hash - sha256 -> путь: тот же файл с другим file_unique_id
+              (например, документ, загруженный заново) скачивается, но не
+              сохраняется второй раз.
+"""
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Optional
+
+from utils.backup_utils import file_hash, load_json, save_json
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = "media_index.json"
+NAME_HASH_LEN = 16
+
+
+class MediaStore:
+    def __init__(self, vault: Path, index_path: Path, tmp_dir: Path):
+        self.vault = vault
+        self.index_path = index_path
+        # Куда качать: на той же ФС, что и вальт, но не в папках медиа
+        self.tmp_dir = tmp_dir
+        self._index: Optional[Dict[str, Dict[str, str]]] = None
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._save_lock = asyncio.Lock()
+        self.stats = {'downloads': 0, 'id_hits': 0, 'hash_hits': 0}
+
+    def _load(self) -> Dict[str, Dict[str, str]]:
+        if self._index is None:
+            index = load_json(self.index_path, {})
+            self._index = {'by_id': index.get('by_id', {}), 'by_hash': index.get('by_hash', {})}
+        return self._index
+
+    def _existing(self, table: str, key: str) -> Optional[Path]:
+        rel = self._load()[table].get(key)
+        if rel is None:
+            return None
+        path = self.vault / rel
+        if path.exists():
+            return path
+        # Файл удалили из вальта - забываем его
+        del self._index[table][key]
+        return None
+
+    async def store(self, unique_id: Optional[str], target_dir: Path, name: str,
+                    download: Callable[[Path], Awaitable[bool]]) -> Optional[Path]:
+        """Сохраняет файл в target_dir и возвращает путь к нему (или к уже лежащей копии).
+
+        name - образец имени: хэш содержимого вставляется перед расширением
+        (photo.jpg -> photo_<хэш>.jpg). download(путь) скачивает файл и
+        возвращает True при успехе. None - скачать не удалось.
+        """
+        if unique_id:
+            existing = self._existing('by_id', unique_id)
+            if existing:
+                self.stats['id_hits'] += 1
+                logger.info(f"Файл уже сохранён: {existing.name}")
+                return existing
+            # Тот же файл уже качается (например, из другого чата) - ждём его
+            if unique_id in self._inflight:
+                return await asyncio.shield(self._inflight[unique_id])
+            self._inflight[unique_id] = asyncio.get_running_loop().create_future()
+        path = None
+        try:
+            path = await self._download(unique_id, target_dir, name, download)
+            return path
+        finally:
+            if unique_id:
+                self._inflight.pop(unique_id).set_result(path)
+
+    async def _download(self, unique_id: Optional[str], target_dir: Path, name: str,
+                        download: Callable[[Path], Awaitable[bool]]) -> Optional[Path]:
+        target_dir.mkdir(parents=True, exist_ok=True)
+        # Постоянное имя по file_unique_id: недокачанный после перезапуска файл докачается
+        tmp_path = self.tmp_dir / f"download-{unique_id or os.urandom(6).hex()}{Path(name).suffix}"
+        if not await download(tmp_path) or not tmp_path.exists():
+            tmp_path.unlink(missing_ok=True)
+            return None
+        self.stats['downloads'] += 1
+
+        digest = await asyncio.to_thread(file_hash, tmp_path)
+        path = self._existing('by_hash', digest)
+        if path:
+            self.stats['hash_hits'] += 1
+            tmp_path.unlink()
+            logger.info(f"Такой файл уже есть: {path.name}")
+        else:
+            stem, suffix = os.path.splitext(name)
+            path = target_dir / f"{stem}_{digest[:NAME_HASH_LEN]}{suffix}"
+            os.replace(tmp_path, path)
+            self._index['by_hash'][digest] = path.relative_to(self.vault).as_posix()
+        if unique_id:
+            self._index['by_id'][unique_id] = path.relative_to(self.vault).as_posix()
+        await self._save()
+        return path
+
+    async def relocate(self, old: Path, new: Path):
+        """Файл old заменён на new (например, сжатой копией) - индекс ведёт на new"""
+        old_rel = old.relative_to(self.vault).as_posix()
+        new_rel = new.relative_to(self.vault).as_posix()
+        index = self._load()
+        for entries in index.values():
+            for key, rel in entries.items():
+                if rel == old_rel:
+                    entries[key] = new_rel
+        await self._save()
+
+    async def _save(self):
+        # Копия: пока индекс пишется в потоке, в него могут добавиться новые файлы
+        snapshot = {table: dict(entries) for table, entries in self._index.items()}
+        async with self._save_lock:
+            await asyncio.to_thread(save_json, self.index_path, snapshot)
@@ -1,92 +1,244 @@
 import logging
 from pathlib import Path
-from datetime import datetime
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
 from aiogram import Bot
+from aiogram.types import Message
 import asyncio
+import os
+import time
+import aiohttp
+import config
+from utils.file_utils import downloads_dir, link_or_copy, state_dir
+from utils.metrics import DOWNLOAD_BYTES, DOWNLOAD_ERRORS, DOWNLOAD_SECONDS, DOWNLOAD_SIZE
+from utils.media_store import INDEX_NAME, MediaStore
 logger = logging.getLogger(__name__)
 
+# Сколько файлов качается одновременно во всех чатах
+download_slots = asyncio.Semaphore(config.MEDIA_DOWNLOADS)
+DOWNLOAD_CHUNK = 256 * 1024
+# Куски копятся в памяти и пишутся на диск в потоке пачками такого размера
+WRITE_BUFFER = 1024 * 1024
+# Ограничения на размер файла: публичный Bot API и свой сервер в режиме --local
+MAX_FILE_SIZE = 50 * 1024 * 1024
+LOCAL_MAX_FILE_SIZE = 2000 * 1024 * 1024
+_media_store: Optional[MediaStore] = None
+
+class DownloadError(Exception):
+    pass
+
+def _fsync(path: Path):
+    with open(path, 'rb+') as f:
+        os.fsync(f.fileno())
+
+def _write_and_close(f, data: bytes):
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+def _local_path(bot: Bot, file) -> Optional[Path]:
+    """Путь к файлу на диске, если бот работает через свой Bot API сервер в режиме --local"""
+    api = getattr(getattr(bot, 'session', None), 'api', None)
+    if api is None or not api.is_local or not file.file_path:
+        return None
+    path = Path(api.wrap_local_file.to_local(file.file_path))
+    return path if path.is_absolute() else None
+
+async def _fetch(bot: Bot, file, part: Path):
+    """Докачивает файл в part: если part уже есть, запрашивает только остаток (Range)"""
+    offset = part.stat().st_size if part.exists() else 0
+    if file.file_size and offset >= file.file_size:
+        return
+    create_session = getattr(bot.session, 'create_session', None)
+    if create_session is None:
+        # Сессия не aiohttp - докачка невозможна, качаем заново средствами aiogram
+        await bot.download_file(file.file_path, part, timeout=config.MEDIA_STALL_TIMEOUT)
+        return
+
+    session = await create_session()
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    headers = {'Range': f"bytes={offset}-"} if offset else {}
+    # Ограничено время ожидания следующего куска, а не всей загрузки:
+    # медленный, но живой канал не обрывается
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=config.MEDIA_STALL_TIMEOUT)
+    async with session.get(url, headers=headers, timeout=timeout) as resp:
+        resp.raise_for_status()
+        if offset and resp.status != 206:
+            # Сервер не умеет Range - начинаем сначала
+            logger.debug(f"Сервер не поддерживает докачку, качаю {part.name} заново")
+            offset = 0
+        # Запись на медленный диск (SD-карта, сетевая папка) не должна держать цикл событий
+        f = await asyncio.to_thread(open, part, 'ab' if offset else 'wb')
+        buffer = bytearray()
+        try:
+            async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK):
+                buffer += chunk
+                if len(buffer) >= WRITE_BUFFER:
+                    # Копия: если загрузку отменят во время записи, поток допишет свои данные,
+                    # а остаток буфера не повторит их
+                    data = bytes(buffer)
+                    buffer.clear()
+                    await asyncio.to_thread(f.write, data)
+        finally:
+            # Полученное до обрыва тоже сохраняется - повтор докачает с этого места
+            await asyncio.to_thread(_write_and_close, f, bytes(buffer))
+
+async def _fetch_retrying(bot: Bot, file, part: Path, name: str):
+    """_fetch с повторами: сетевые ошибки повторяются с нарастающей паузой"""
+    for attempt in range(config.MEDIA_DOWNLOAD_RETRIES + 1):
+        try:
+            await _fetch(bot, file, part)
+            return
+        except (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError) as e:
+            if isinstance(e, aiohttp.ClientResponseError) and e.status < 500 and e.status != 429:
+                raise
+            if attempt == config.MEDIA_DOWNLOAD_RETRIES:
+                raise
+            delay = 2 ** attempt
+            done = part.stat().st_size if part.exists() else 0
+            logger.warning(f"Обрыв загрузки {name} на {done} байт "
+                           f"({type(e).__name__}), повтор через {delay} с")
+            await asyncio.sleep(delay)
+
 async def download_file(bot: Bot, file_id: str, destination: Path):
-    """Улучшенная загрузка с проверкой размера"""
+    """Улучшенная загрузка с проверкой размера.
+
+    Файл качается потоком во временный destination.part и появляется под
+    своим именем только целиком (после fsync и проверки размера). MediaStore
+    передаёт сюда путь в папке .tg-downloads (file_utils.downloads_dir), так что
+    недокачанный файл не лежит рядом с медиа. Сетевые ошибки повторяются
+    с нарастающей паузой, повтор докачивает файл с места обрыва. Если скачать
+    так и не удалось, .part удаляется; при остановке бота он остаётся и
+    докачается после перезапуска.
+    Через свой Bot API сервер (--local) файл берётся прямо с диска сервера.
+    """
+    part = destination.with_name(destination.name + '.part')
     try:
         # Создаём папку, если её нет
         destination.parent.mkdir(parents=True, exist_ok=True)
         
+        # get_file не занимает слот: пока качается один файл, для следующих
+        # уже получены пути
         file = await bot.get_file(file_id)
         file_size = file.file_size  # Размер в байтах
+        local_path = _local_path(bot, file)
         
-        # Проверяем размер файла (не более 50MB)
-        if file_size > 50 * 1024 * 1024:
-            raise ValueError("Файл слишком большой (макс. 50MB)")
+        # Проверяем размер файла (не более 50MB, через свой сервер - до 2GB)
+        max_size = LOCAL_MAX_FILE_SIZE if local_path else MAX_FILE_SIZE
+        if file_size and file_size > max_size:
+            raise ValueError(f"Файл слишком большой (макс. {max_size // 1024 // 1024}MB)")
         
-        await bot.download_file(
-            file.file_path,
-            destination,
-            timeout=60  # Увеличиваем таймаут для больших файлов
-        )
+        async with download_slots:
+            started = time.perf_counter()
+            resumed_from = part.stat().st_size if part.exists() else 0
+            if local_path:
+                # Файл уже лежит на диске у сервера - передаём его без HTTP
+                part.unlink(missing_ok=True)
+                resumed_from = 0
+                method = await asyncio.to_thread(link_or_copy, local_path, part, config.BOT_API_MOVE_FILES)
+            else:
+                await _fetch_retrying(bot, file, part, destination.name)
+                method = 'http'
+            elapsed = time.perf_counter() - started
+
+        size = part.stat().st_size
+        DOWNLOAD_SECONDS.observe(elapsed, method=method)
+        DOWNLOAD_BYTES.inc(size - resumed_from, method=method)
+        DOWNLOAD_SIZE.observe(size, method=method)
+        if file_size and size != file_size:
+            part.unlink(missing_ok=True)
+            raise DownloadError(f"получено {size} байт вместо {file_size}")
+        if method not in ('link', 'move'):
+            # Ссылка и перенос не пишут новых данных - сбрасывать на диск нечего
+            await asyncio.to_thread(_fsync, part)
+        os.replace(part, destination)
+
+        loaded = (size - resumed_from) / 1024 / 1024
+        logger.info(f"Скачан {destination.name} ({method}): {size / 1024 / 1024:.1f} МБ за {elapsed:.1f} с "
+                    f"({loaded / max(elapsed, 1e-3):.2f} МБ/с)")
         return True
     except Exception as e:
+        DOWNLOAD_ERRORS.inc()
         logger.error(f"Ошибка загрузки: {type(e).__name__}: {str(e)}")
+        part.unlink(missing_ok=True)
         return False
 
+def get_media_store() -> MediaStore:
+    global _media_store
+    if _media_store is None:
+        _media_store = MediaStore(Path(config.OBSIDIAN_PATH), state_dir() / INDEX_NAME, downloads_dir())
+    return _media_store
+
+async def save_media(bot: Bot, file, target_dir: Path, name: str) -> Optional[Path]:
+    """Сохраняет файл из Telegram в target_dir под именем name + хэш содержимого.
+    Уже сохранённый раньше файл не скачивается. None - не удалось скачать"""
+    return await get_media_store().store(
+        getattr(file, 'file_unique_id', None), target_dir, name,
+        lambda path: download_file(bot, file.file_id, path)
+    )
+
 async def process_media_group(
-    media_group_id: str,
+    messages: List[Message],
     media_dir: Path,
-    chat_id: int,
-    media_group_data: Dict[str, Any],
     bot: Bot
 ) -> Optional[Dict[str, Any]]:
     """Обработка медиагруппы с улучшенным логированием"""
     try:
-        group = media_group_data.get(media_group_id)
-        if not group or group.get('processed'):
-            return None
-
-        logger.info(f"Начало обработки группы: {media_group_id}")
-        group['processed'] = True
-        messages = sorted(group['messages'], key=lambda x: x.message_id)
+        logger.info(f"Начало обработки группы: {messages[0].media_group_id}")
+        messages = sorted(messages, key=lambda x: x.message_id)
 
         media_info = {
             'text': next((msg.caption for msg in messages if msg.caption), ""),
             'photos': [],
             'videos': [],
             'files': [],
-            'voices': []
+            'voices': [],
+            'saved': {},
+            'failed': []
         }
 
         # Костыль для Windows: создаём все подпапки заранее
         for media_type in ['photos', 'videos', 'files', 'voices']:
             (media_dir / media_type).mkdir(exist_ok=True)
 
+        items = []
         for msg in messages:
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            
+            # Имя файла дополняется хэшем содержимого (см. save_media)
             if msg.photo:
                 file = msg.photo[-1]
-                filename = f"photo_{timestamp}.jpg"
+                filename = "photo.jpg"
                 subfolder = 'photos'
             elif msg.video:
                 file = msg.video
-                filename = f"video_{timestamp}.mp4"
+                filename = "video.mp4"
                 subfolder = 'videos'
             elif msg.document:
                 file = msg.document
-                filename = f"doc_{timestamp}{Path(file.file_name).suffix if file.file_name else '.bin'}"
+                filename = f"doc{Path(file.file_name).suffix if file.file_name else '.bin'}"
                 subfolder = 'files'
             elif msg.voice:
                 file = msg.voice
-                filename = f"voice_{timestamp}.ogg"
+                filename = "voice.ogg"
                 subfolder = 'voices'
             else:
                 continue
+            items.append((file, filename, subfolder))
 
-            full_path = media_dir / subfolder / filename
-            success = await download_file(bot, file.file_id, full_path)
-            
-            if success and full_path.exists():
-                media_info[subfolder].append(f"{subfolder}/{filename}")
+        # Все файлы альбома качаются одновременно (в пределах download_slots),
+        # результаты разбираются в порядке message_id
+        results = await asyncio.gather(
+            *(save_media(bot, file, media_dir / subfolder, filename)
+              for file, filename, subfolder in items),
+            return_exceptions=True
+        )
+        for (file, filename, subfolder), saved in zip(items, results):
+            if isinstance(saved, Path):
+                item = saved.relative_to(media_dir).as_posix()
+                media_info[subfolder].append(item)
+                media_info['saved'][item] = saved
             else:
                 logger.warning(f"Не удалось сохранить файл: {filename}")
+                media_info['failed'].append(filename)
 
         return media_info
 
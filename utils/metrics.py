@@ -0,0 +1,382 @@
+"""Метрики бота в формате Prometheus и поиск медленных обработчиков.
+
+Метрики собираются всегда (это несколько сложений на событие), а отдаются
+по HTTP, только если задан METRICS_PORT:
+
+    curl http://127.0.0.1:9108/metrics
+
+Счётчики и гистограммы объявлены здесь же, ниже по файлу, - чтобы все имена
+были видны в одном месте. Замер в коде:
+
+    with DOWNLOAD_SECONDS.time(method='http'):
+        ...
+    DOWNLOAD_BYTES.inc(size, method='http')
+
+Медленные обработчики (METRICS_SLOW_HANDLER секунд, 0 - выключено): этап,
+который выполняется дольше порога, пишет в лог свой стек - место, где он
+ждёт. Если же цикл событий заблокирован синхронным кодом, стек главного
+потока снимает отдельный поток-наблюдатель.
+"""
+import abc
+import asyncio
+import io
+import logging
+import math
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+
+import config
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric(abc.ABC):
+    """Общее у всех метрик: имя, описание, метки и вывод в текстовом формате"""
+    kind = ''
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 func: Optional[Callable[[], Dict[LabelValues, float]]] = None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # func - значения берутся в момент выдачи метрик из чужой статистики
+        self.func = func
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name}: ожидались метки {self.labels}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    @abc.abstractmethod
+    def _samples(self) -> Iterable[Tuple[str, Sequence[str], Sequence[str], float]]:
+        """Строки метрики: (суффикс имени, имена меток, значения меток, значение)"""
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values)} {_format_value(value)}")
+        return lines
+
+
+class _Value(_Metric):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        values = self.func() if self.func else self._values
+        for key, value in sorted(values.items()):
+            yield '', self.labels, key, value
+
+
+class Counter(_Value):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Value):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # метки -> [счётчики по корзинам, сумма, количество]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[0][i] += 1
+                break
+        data[1] += value
+        data[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def count(self, **labels) -> int:
+        data = self._values.get(self._key(labels))
+        return data[2] if data else 0
+
+    def _samples(self):
+        names = self.labels + ('le',)
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                yield '_bucket', names, key + (_format_value(bound),), cumulative
+            yield '_sum', self.labels, key, total
+            yield '_count', self.labels, key, count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _add(self, metric: _Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже объявлена")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = (), func=None) -> Counter:
+        return self._add(Counter(name, help, labels, func))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = (), func=None) -> Gauge:
+        return self._add(Gauge(name, help, labels, func))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # Сломанный источник не должен лишать остальных метрик
+                logger.error(f"Ошибка сбора метрики {metric.name}: {str(e)}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+SIZE_BUCKETS = tuple(2 ** i * 1024 for i in range(0, 22, 2))  # 1 КБ .. 2 ГБ
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+LONG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600)
+
+# --- обработка сообщений ---
+HANDLER_SECONDS = REGISTRY.histogram(
+    'bot_handler_seconds', 'Время обработчика входящего сообщения', ['type'])
+INGEST_SECONDS = REGISTRY.histogram(
+    'bot_ingest_seconds', 'От приёма сообщения конвейером до записи в заметку', ['type'])
+STAGE_SECONDS = REGISTRY.histogram(
+    'bot_ingest_stage_seconds', 'Время этапа конвейера на одно сообщение', ['stage'])
+SLOW_HANDLERS = REGISTRY.counter(
+    'bot_slow_handlers_total', 'Обработчики дольше METRICS_SLOW_HANDLER (стек записан в лог)', ['stage'])
+
+# --- медиа ---
+DOWNLOAD_SECONDS = REGISTRY.histogram(
+    'bot_download_seconds', 'Время скачивания файла', ['method'])
+DOWNLOAD_BYTES = REGISTRY.counter(
+    'bot_download_bytes_total', 'Скачано байт', ['method'])
+DOWNLOAD_SIZE = REGISTRY.histogram(
+    'bot_download_size_bytes', 'Размер скачанного файла', ['method'], buckets=SIZE_BUCKETS)
+DOWNLOAD_ERRORS = REGISTRY.counter(
+    'bot_download_errors_total', 'Неудачные скачивания')
+ALBUM_WAIT_SECONDS = REGISTRY.histogram(
+    'bot_album_wait_seconds', 'Сколько собирался альбом до передачи в обработку', ['reason'],
+    buckets=(0.5, 1, 1.5, 2, 3, 5, 10, 30, 60))
+
+# --- заметки ---
+NOTE_WRITE_SECONDS = REGISTRY.histogram(
+    'bot_note_write_seconds', 'Запись пачки записей в заметку (с fsync)')
+NOTE_WRITE_BYTES = REGISTRY.counter(
+    'bot_note_write_bytes_total', 'Дописано в заметки байт')
+NOTE_BATCH_SIZE = REGISTRY.histogram(
+    'bot_note_batch_entries', 'Записей в одной пачке', buckets=(1, 2, 5, 10, 20, 50, 100))
+
+# --- напоминания ---
+REMINDER_SCAN_SECONDS = REGISTRY.histogram(
+    'bot_reminder_scan_seconds', 'Проверка файлов напоминаний')
+REMINDER_LINES = REGISTRY.counter(
+    'bot_reminder_lines_parsed_total', 'Разобрано строк в изменившихся файлах напоминаний')
+REMINDER_FILES = REGISTRY.counter(
+    'bot_reminder_files_total', 'Проверено файлов напоминаний', ['source'])
+
+# --- бэкапы ---
+BACKUP_SECONDS = REGISTRY.histogram(
+    'bot_backup_seconds', 'Время создания бэкапа', ['format', 'kind'], buckets=LONG_BUCKETS)
+BACKUP_BYTES_IN = REGISTRY.counter(
+    'bot_backup_bytes_in_total', 'Прочитано байт вальта при бэкапе', ['format'])
+BACKUP_BYTES_OUT = REGISTRY.counter(
+    'bot_backup_bytes_out_total', 'Записано байт бэкапа', ['format'])
+BACKUP_RATIO = REGISTRY.gauge(
+    'bot_backup_compression_ratio', 'Записано / прочитано в последнем бэкапе', ['format'])
+
+# --- сжатие фото ---
+OPTIMIZE_SECONDS = REGISTRY.histogram(
+    'bot_media_optimize_seconds', 'Сжатие одного фото (с ожиданием свободного процесса)')
+OPTIMIZE_BYTES = REGISTRY.counter(
+    'bot_media_optimize_bytes_total', 'Байт фото до сжатия (in) и после, с превью (out)', ['direction'])
+
+# --- цикл событий ---
+LOOP_LAG_SECONDS = REGISTRY.histogram(
+    'bot_event_loop_lag_seconds', 'На сколько позже срабатывает таймер цикла событий', buckets=LAG_BUCKETS)
+
+
+def record_backup(plan: Dict, elapsed: float):
+    """Метрики завершённого бэкапа (план из run_backup)"""
+    fmt = plan.get('format') or plan['kind']
+    BACKUP_SECONDS.observe(elapsed, format=fmt, kind=plan['kind'])
+    bytes_in = plan.get('bytes_total') or 0
+    bytes_out = plan.get('bytes_written') or 0
+    BACKUP_BYTES_IN.inc(bytes_in, format=fmt)
+    BACKUP_BYTES_OUT.inc(bytes_out, format=fmt)
+    if bytes_in:
+        BACKUP_RATIO.set(bytes_out / bytes_in, format=fmt)
+
+
+# --- поиск медленных обработчиков ---
+
+class SlowHandlerWatch:
+    """Пишет в лог стек этапа, который выполняется дольше threshold секунд"""
+
+    def __init__(self, threshold: float = 0):
+        self.threshold = threshold
+        self._loop_thread: Optional[int] = None
+        self._beat = time.monotonic()
+        self._sampler: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+
+    @contextmanager
+    def watch(self, stage: str):
+        """Оборачивает выполнение этапа внутри корутины"""
+        if not self.threshold:
+            yield
+            return
+        task = asyncio.current_task()
+        started = time.perf_counter()
+        timer = asyncio.get_running_loop().call_later(self.threshold, self._dump_task, task, stage, started)
+        try:
+            yield
+        finally:
+            timer.cancel()
+            elapsed = time.perf_counter() - started
+            if elapsed > self.threshold:
+                SLOW_HANDLERS.inc(stage=stage)
+                logger.warning(f"Медленный обработчик {stage}: {elapsed:.2f} с")
+
+    def _dump_task(self, task: Optional[asyncio.Task], stage: str, started: float):
+        if task is None or task.done():
+            return
+        out = io.StringIO()
+        task.print_stack(file=out)
+        logger.warning(f"{stage} выполняется {time.perf_counter() - started:.2f} с, стек:\n{out.getvalue()}")
+
+    def heartbeat(self):
+        """Цикл событий жив (вызывается из watch_loop_lag)"""
+        self._beat = time.monotonic()
+
+    def start_sampler(self):
+        """Поток, который снимает стек главного потока, если цикл событий завис"""
+        if not self.threshold or self._sampler is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, name='slow-handler-sampler', daemon=True)
+        self._sampler.start()
+
+    def stop_sampler(self):
+        self._stop.set()
+        self._sampler = None
+
+    def _sample(self):
+        reported = None
+        while not self._stop.wait(self.threshold / 4):
+            beat = self._beat
+            stalled = time.monotonic() - beat
+            if stalled < self.threshold or reported == beat:
+                continue
+            # Одна запись на каждую остановку цикла
+            reported = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            SLOW_HANDLERS.inc(stage='event_loop')
+            stack = ''.join(traceback.format_stack(frame))
+            logger.warning(f"Цикл событий не отвечает {stalled:.2f} с, стек:\n{stack}")
+
+
+slow_handlers = SlowHandlerWatch(config.METRICS_SLOW_HANDLER)
+
+
+async def watch_loop_lag(interval: float = 0.5):
+    """Замеряет задержку цикла событий: насколько позже обещанного просыпается sleep"""
+    loop = asyncio.get_running_loop()
+    if slow_handlers.threshold:
+        # Наблюдатель считает цикл зависшим без отметок дольше порога
+        interval = min(interval, slow_handlers.threshold / 2)
+    slow_handlers.start_sampler()
+    try:
+        while True:
+            started = loop.time()
+            await asyncio.sleep(interval)
+            LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - started - interval))
+            slow_handlers.heartbeat()
+    finally:
+        slow_handlers.stop_sampler()
+
+
+async def handler_middleware(handler, event, data):
+    """Внешний middleware aiogram: время обработчика по типу сообщения"""
+    kind = getattr(event, 'content_type', None) or type(event).__name__
+    with HANDLER_SECONDS.time(type=kind), slow_handlers.watch(f"handler:{kind}"):
+        return await handler(event, data)
+
+
+async def start_metrics_server(host: str, port: int, registry: Registry = REGISTRY) -> web.AppRunner:
+    """Отдаёт метрики по http://host:port/metrics"""
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(body=registry.render().encode(),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики: http://{host}:{port}/metrics")
+    return runner
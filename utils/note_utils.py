@@ -1,6 +1,13 @@
 from pathlib import Path
+import logging
 from aiogram.types import Message
 from aiogram import types
+import config
+from utils.note_writer import NoteWriter
+logger = logging.getLogger(__name__)
+
+# Все обработчики пишут заметки через одну очередь на файл
+note_writer = NoteWriter(window=config.NOTE_WRITE_WINDOW, fsync=config.NOTE_FSYNC)
 
 def get_forward_source(message: Message) -> str:
     if message.forward_from_chat:
@@ -10,23 +17,25 @@ def get_forward_source(message: Message) -> str:
         return f"Пользователь: {message.forward_from.full_name}"
     return "Моя заметка"
 
-def append_to_note(note_path: Path, message: types.Message, media_info: dict):
-    try:
-        
-        note_path.parent.mkdir(exist_ok=True, parents=True)
-        source = get_forward_source(message)
-        content = f"\n## {message.date.strftime('%d-%m-%Y %H:%M')} | {source}\n"
-        
-        for media_type in ['photos', 'videos', 'files', 'voices']:
-            for item in media_info[media_type]:
-                content += f"![[{item}]]\n"
+def format_entry(message: types.Message, media_info: dict) -> str:
+    """Текст записи о сообщении для заметки"""
+    source = get_forward_source(message)
+    content = f"\n## {message.date.strftime('%d-%m-%Y %H:%M')} | {source}\n"
+
+    # embeds - готовый текст записи для фото, которые сжимаются (превью со ссылкой)
+    embeds = media_info.get('embeds', {})
+    for media_type in ['photos', 'videos', 'files', 'voices']:
+        for item in media_info[media_type]:
+            content += embeds.get(item, f"![[{item}]]") + "\n"
 
-        if media_info['text']:
-            content += f"{media_info['text']}\n"
-        
-        with open(note_path, 'a', encoding='utf-8') as f:
-            f.write(content+"\n---\n")
-            
+    if media_info['text']:
+        content += f"{media_info['text']}\n"
+    return content + "\n---\n"
+
+async def append_to_note(note_path: Path, message: types.Message, media_info: dict):
+    """Дописывает сообщение в заметку. Возвращает управление, когда запись на диске"""
+    try:
+        await note_writer.append(note_path, format_entry(message, media_info))
     except Exception as e:
         logger.error(f"Note append error: {str(e)}")
-        raise
\ No newline at end of file
+        raise
@@ -0,0 +1,170 @@
+"""Запись в заметки пачками.
+
+У каждой заметки своя очередь: записи дописываются строго в порядке
+поступления, а пришедшие в течение window секунд объединяются в одну запись
+на диск (одно изменение файла - один пересчёт у Syncthing). Файл пишется
+в отдельном потоке, цикл событий не блокируется. append() возвращает
+управление, когда пачка с его записью сохранена:
+
+    await note_writer.append(note_path, "текст\\n")
+
+replace() правит уже записанный текст в той же очереди (после всех
+поставленных раньше записей) - так запись о фото возвращается к оригиналу,
+если сжать его не удалось (utils/media_optimizer.py). Заметка при этом
+переписывается целиком; если её за это время изменил кто-то ещё (Obsidian,
+Syncthing), замена повторяется на новом тексте.
+
+fsync: batch - сбрасывать на диск каждую пачку до подтверждения,
+off - оставить это системе.
+"""
+import asyncio
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from utils.metrics import NOTE_BATCH_SIZE, NOTE_WRITE_BYTES, NOTE_WRITE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+FSYNC_MODES = ('batch', 'off')
+# Сколько раз перечитать заметку, которую меняют во время замены
+REWRITE_ATTEMPTS = 3
+
+# Операция очереди: текст для дописывания или замена (старый текст, новый)
+Operation = Union[str, Tuple[str, str]]
+
+
+class NoteWriter:
+    def __init__(self, window: float = 0.3, fsync: str = 'batch', max_batch: int = 100):
+        if fsync not in FSYNC_MODES:
+            raise ValueError(f"fsync: {fsync}, ожидается одно из {', '.join(FSYNC_MODES)}")
+        self.window = window
+        self.fsync = fsync
+        self.max_batch = max_batch
+        self._queues: Dict[Path, List[Tuple[Operation, asyncio.Future]]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.stats = {'entries': 0, 'batches': 0, 'bytes': 0, 'errors': 0}
+
+    async def append(self, note_path: Path, content: str):
+        """Дописывает content в конец заметки. Ошибка записи пробрасывается сюда же"""
+        await self.submit(note_path, content)
+
+    def submit(self, note_path: Path, content: str) -> asyncio.Future:
+        """Ставит запись в очередь сразу, без ожидания. Future завершится, когда она на диске"""
+        self.stats['entries'] += 1
+        return self._enqueue(note_path, content)
+
+    async def replace(self, note_path: Path, old: str, new: str) -> int:
+        """Заменяет old на new во всей заметке. Возвращает число замен (0 - текст не найден)"""
+        return await self._enqueue(note_path, (old, new))
+
+    def _enqueue(self, note_path: Path, operation: Operation) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(note_path)
+        if queue is None:
+            queue = self._queues[note_path] = []
+            task = asyncio.create_task(self._run(note_path, queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        queue.append((operation, future))
+        return future
+
+    async def drain(self):
+        """Дожидается записи всего, что уже поставлено в очереди"""
+        while self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _run(self, note_path: Path, queue: List[Tuple[Operation, asyncio.Future]]):
+        try:
+            while queue:
+                # Ждём, не придёт ли ещё что-нибудь в ту же заметку
+                if len(queue) < self.max_batch:
+                    await asyncio.sleep(self.window)
+                batch = queue[:self.max_batch]
+                del queue[:len(batch)]
+                operations = [operation for operation, _ in batch]
+                data = ''.join(op for op in operations if isinstance(op, str))
+                started = time.perf_counter()
+                try:
+                    if all(isinstance(op, str) for op in operations):
+                        await asyncio.to_thread(self._write, note_path, data)
+                        results = [None] * len(batch)
+                    else:
+                        results = await asyncio.to_thread(self._rewrite, note_path, operations)
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    logger.error(f"Не удалось записать {note_path.name}: {str(e)}")
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                    continue
+                self.stats['batches'] += 1
+                self.stats['bytes'] += len(data)
+                NOTE_WRITE_SECONDS.observe(time.perf_counter() - started)
+                NOTE_WRITE_BYTES.inc(len(data.encode('utf-8')))
+                NOTE_BATCH_SIZE.observe(len(batch))
+                logger.debug(f"{note_path.name}: записано {len(batch)} шт. одной пачкой")
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            # Новые записи после этого момента запустят новую очередь
+            if self._queues.get(note_path) is queue:
+                del self._queues[note_path]
+            for _, future in queue:
+                future.cancel()
+
+    def _write(self, note_path: Path, data: str):
+        note_path.parent.mkdir(exist_ok=True, parents=True)
+        with open(note_path, 'a', encoding='utf-8') as f:
+            f.write(data)
+            if self.fsync == 'batch':
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _rewrite(self, note_path: Path, operations: List[Operation]) -> List:
+        """Пачка с заменами: заметка перечитывается и записывается целиком (атомарно).
+
+        Если файл изменился, пока готовился новый текст, чужая правка не затирается:
+        попытка повторяется, а после REWRITE_ATTEMPTS неудач - ошибка.
+        """
+        note_path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = note_path.with_name(note_path.name + '.tmp')
+        for _ in range(REWRITE_ATTEMPTS):
+            before = _file_version(note_path)
+            # newline='': концы строк, которые уже в заметке, остаются как были
+            text = ''
+            if before is not None:
+                with open(note_path, encoding='utf-8', newline='') as f:
+                    text = f.read()
+            results = []
+            for operation in operations:
+                if isinstance(operation, str):
+                    text += operation
+                    results.append(None)
+                else:
+                    old, new = operation
+                    results.append(text.count(old))
+                    text = text.replace(old, new)
+            with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+                f.write(text)
+                if self.fsync == 'batch':
+                    f.flush()
+                    os.fsync(f.fileno())
+            if _file_version(note_path) == before:
+                os.replace(tmp_path, note_path)
+                return results
+            logger.info(f"{note_path.name} изменилась во время записи, перечитываю")
+        tmp_path.unlink(missing_ok=True)
+        raise RuntimeError(f"{note_path.name} меняется во время записи, замена не выполнена")
+
+
+def _file_version(path: Path) -> Optional[Tuple[int, int]]:
+    """(mtime_ns, размер) файла; None - файла нет"""
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
@@ -0,0 +1,232 @@
+"""Отправка сообщений от бота с соблюдением лимитов Telegram.
+
+Все исходящие сообщения идут через одну очередь с двумя ограничениями
+(ведро токенов): на весь бот (global_rate в секунду) и на каждый чат
+(chat_rate в секунду). Ответ 429 (Flood Control) не считается ошибкой:
+отправка приостанавливается на retry_after секунд, сообщение уходит позже.
+
+У каждого чата две полосы: HIGH (напоминания) обслуживается раньше LOW
+(ответы о сохранении, прогресс), поэтому напоминание не застревает за сотней
+"✅". Подряд идущие сообщения одной группы (group) в одной полосе, которые
+ждут отправки или пришли в течение window секунд, склеиваются в одно
+функцией merge - например, пять "✅ Успешно сохранено!" станут одним
+"✅ Успешно сохранено! (×5)". Сообщения одного чата уходят по порядку.
+
+    await outbound.send(bot, chat_id, "текст", group="status")
+"""
+import asyncio
+import logging
+from collections import deque
+from contextlib import suppress
+from typing import Any, Callable, Deque, Dict, List, Optional, Set
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+import config
+from utils.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+HIGH = 0
+LOW = 1
+# Предел длины сообщения в Telegram
+MAX_TEXT = 4096
+SEND_RETRIES = 3
+
+
+def merge_lines(texts: List[str]) -> str:
+    """Одинаковые подряд сообщения - одной строкой с количеством, разные - построчно"""
+    lines = []
+    for text in texts:
+        if lines and lines[-1][0] == text:
+            lines[-1][1] += 1
+        else:
+            lines.append([text, 1])
+    return "\n".join(text if count == 1 else f"{text} (×{count})" for text, count in lines)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated: Optional[float] = None
+
+    def _refill(self, now: float):
+        if self.updated is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Через сколько секунд будет токен (0 - уже есть)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+class OutboundSender:
+    def __init__(self, global_rate: float = 25, chat_rate: float = 1, chat_burst: float = 3,
+                 window: float = 0.3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.window = window
+        self._chats: Dict[int, Dict[str, Any]] = {}
+        self._paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set()
+        self.stats = {'queued': 0, 'sent': 0, 'merged': 0, 'retry_after': 0, 'failed': 0}
+
+    async def send(self, bot: Bot, chat_id: int, text: str, priority: int = LOW,
+                   group: Optional[str] = None, merge: Callable[[List[str]], str] = merge_lines):
+        """Ставит сообщение в очередь и ждёт отправки. Ошибку отправки пробрасывает"""
+        await self.post(bot, chat_id, text, priority, group, merge)
+
+    def post(self, bot: Bot, chat_id: int, text: str, priority: int = LOW,
+             group: Optional[str] = None, merge: Callable[[List[str]], str] = merge_lines) -> asyncio.Future:
+        """Ставит сообщение в очередь не дожидаясь отправки. Future завершится после неё"""
+        loop = asyncio.get_running_loop()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = {
+                'lanes': (deque(), deque()), 'busy': False,
+                'bucket': TokenBucket(self.chat_rate, self.chat_burst),
+            }
+        future = loop.create_future()
+        chat['lanes'][priority].append({
+            'bot': bot, 'text': text, 'group': group, 'merge': merge,
+            'queued': loop.time(), 'future': future,
+        })
+        self.stats['queued'] += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+        return future
+
+    async def drain(self):
+        """Дожидается отправки всего, что уже в очереди"""
+        while self._task and not self._task.done():
+            await asyncio.wait({self._task})
+
+    def _forget_idle(self, now: float):
+        """Убирает чаты без сообщений в очереди, у которых ведро уже наполнилось.
+
+        Новая запись для такого чата ничем не отличается от старой, а с
+        неполным ведром чат после повторного создания получил бы лишний burst.
+        """
+        idle = [chat_id for chat_id, chat in self._chats.items()
+                if not chat['busy'] and not chat['lanes'][HIGH] and not chat['lanes'][LOW]
+                and chat['bucket'].full(now)]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+    def _pick(self, now: float):
+        """(чат, полоса), которую можно отправить сейчас, или (None, сколько ждать)"""
+        wait = None
+        for priority in (HIGH, LOW):
+            for chat_id, chat in self._chats.items():
+                lane = chat['lanes'][priority]
+                if chat['busy'] or not lane:
+                    continue
+                ready_in = max(chat['bucket'].wait_time(now), lane[0]['queued'] + self.window - now)
+                if ready_in <= 0:
+                    return chat_id, priority
+                wait = ready_in if wait is None else min(wait, ready_in)
+        return None, wait
+
+    def _take_batch(self, lane: Deque[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        batch = [lane.popleft()]
+        group = batch[0]['group']
+        length = len(batch[0]['text'])
+        while group is not None and lane and lane[0]['group'] == group \
+                and length + len(lane[0]['text']) + 1 <= MAX_TEXT:
+            length += len(lane[0]['text']) + 1
+            batch.append(lane.popleft())
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            now = loop.time()
+            self._forget_idle(now)
+            if not any(chat['busy'] or chat['lanes'][HIGH] or chat['lanes'][LOW] for chat in self._chats.values()):
+                return
+            wait = max(0.0, self._paused_until - now, self.global_bucket.wait_time(now))
+            chat_id = None
+            if wait <= 0:
+                chat_id, priority = self._pick(now)
+                if chat_id is None:
+                    wait = priority
+            if chat_id is None:
+                # Ждём токен, паузу после 429 или новое сообщение/завершение отправки
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                continue
+
+            chat = self._chats[chat_id]
+            lane = chat['lanes'][priority]
+            batch = self._take_batch(lane)
+            self.global_bucket.take(now)
+            chat['bucket'].take(now)
+            chat['busy'] = True
+            task = asyncio.create_task(self._deliver(chat_id, chat, lane, batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _deliver(self, chat_id: int, chat: Dict[str, Any], lane: Deque, batch: List[Dict[str, Any]]):
+        text = batch[0]['merge']([item['text'] for item in batch])
+        try:
+            for attempt in range(SEND_RETRIES + 1):
+                try:
+                    await batch[0]['bot'].send_message(chat_id, text)
+                    break
+                except TelegramRetryAfter as e:
+                    # Flood Control: ждём сколько сказано, сообщения вернутся в начало очереди
+                    self.stats['retry_after'] += 1
+                    logger.warning(f"Telegram просит подождать {e.retry_after} с перед отправкой")
+                    loop = asyncio.get_running_loop()
+                    self._paused_until = max(self._paused_until, loop.time() + e.retry_after)
+                    lane.extendleft(reversed(batch))
+                    return
+                except (TelegramNetworkError, TelegramServerError) as e:
+                    if attempt == SEND_RETRIES:
+                        raise
+                    logger.warning(f"Не удалось отправить сообщение ({str(e)}), повтор через {2 ** attempt} с")
+                    await asyncio.sleep(2 ** attempt)
+        except Exception as e:
+            self.stats['failed'] += len(batch)
+            logger.error(f"Ошибка отправки сообщения в чат {chat_id}: {str(e)}")
+            for item in batch:
+                if not item['future'].done():
+                    item['future'].set_exception(e)
+        else:
+            self.stats['sent'] += 1
+            self.stats['merged'] += len(batch) - 1
+            for item in batch:
+                if not item['future'].done():
+                    item['future'].set_result(None)
+        finally:
+            chat['busy'] = False
+            self._wakeup.set()
+
+
+# Все сообщения бота, кроме ответов на команды, идут через эту очередь
+outbound = OutboundSender(
+    global_rate=config.OUTBOUND_GLOBAL_RATE,
+    chat_rate=config.OUTBOUND_CHAT_RATE,
+    window=config.OUTBOUND_WINDOW,
+)
+REGISTRY.counter('bot_outbound_total', 'Исходящие сообщения: queued, sent, merged, retry_after, failed',
+                 ['result'], func=lambda: {(key,): value for key, value in outbound.stats.items()})
+REGISTRY.gauge('bot_outbound_pending', 'Сообщений ждут отправки',
+               func=lambda: {(): sum(len(lane) for chat in outbound._chats.values() for lane in chat['lanes'])})
@@ -0,0 +1,114 @@
+"""Журнал отправленных напоминаний, переживающий перезапуск бота.
+
+Напоминание хранится как 8-байтовый хэш идентификатора (файл, время, текст)
+и время срабатывания. Записи живут retention секунд после срабатывания и
+удаляются из кучи по порядку времени - очистка не перебирает весь журнал.
+
+На диске - журнал записей по 16 байт, новые дописываются пачкой в flush().
+Когда мёртвых записей становится больше живых, файл переписывается заново.
+"""
+import hashlib
+import heapq
+import logging
+import os
+import struct
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'OTSENT1\n'
+RECORD = struct.Struct('<dQ')
+COMPACT_MIN = 1024
+
+
+class SentLedger:
+    def __init__(self, path: Optional[Path], retention: float = 24 * 3600):
+        self.path = path
+        self.retention = retention
+        self._fire: Dict[int, float] = {}
+        self._expiry: List[Tuple[float, int]] = []
+        self._pending: List[Tuple[float, int]] = []
+        self._records = 0
+        if path is not None:
+            self._load()
+
+    @staticmethod
+    def key(identifier: str) -> int:
+        digest = hashlib.blake2b(identifier.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little')
+
+    def __contains__(self, identifier: str) -> bool:
+        return self.key(identifier) in self._fire
+
+    def __len__(self) -> int:
+        return len(self._fire)
+
+    def add(self, identifier: str, fire_time: float):
+        key = self.key(identifier)
+        if key in self._fire:
+            return
+        self._fire[key] = fire_time
+        heapq.heappush(self._expiry, (fire_time, key))
+        self._pending.append((fire_time, key))
+
+    def expire(self, now: Optional[float] = None):
+        threshold = (now or time.time()) - self.retention
+        while self._expiry and self._expiry[0][0] < threshold:
+            fire_time, key = heapq.heappop(self._expiry)
+            if self._fire.get(key) == fire_time:
+                del self._fire[key]
+
+    def flush(self):
+        """Сохраняет на диск всё, добавленное с прошлого flush"""
+        self.expire()
+        if self.path is None or not self._pending:
+            return
+        try:
+            if not self.path.exists() or \
+                    self._records + len(self._pending) > max(COMPACT_MIN, 2 * len(self._fire)):
+                self._compact()
+            else:
+                with open(self.path, 'ab') as f:
+                    f.write(b''.join(RECORD.pack(*record) for record in self._pending))
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._records += len(self._pending)
+            self._pending.clear()
+        except OSError as e:
+            # Не сохранили - попробуем со следующей пачкой
+            logger.error(f"Не удалось сохранить журнал напоминаний: {str(e)}")
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        if data[:len(MAGIC)] != MAGIC:
+            logger.warning(f"{self.path.name}: неизвестный формат, журнал начат заново")
+            self._compact()
+            return
+        body = data[len(MAGIC):]
+        whole = len(body) - len(body) % RECORD.size
+        for fire_time, key in RECORD.iter_unpack(body[:whole]):
+            if key not in self._fire:
+                self._fire[key] = fire_time
+                heapq.heappush(self._expiry, (fire_time, key))
+        self._records = whole // RECORD.size
+        self.expire()
+        if whole != len(body):
+            # Хвост от прерванной записи: без перезаписи новые записи съедут
+            self._compact()
+
+    def _compact(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        records = sorted((fire_time, key) for key, fire_time in self._fire.items())
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC + b''.join(RECORD.pack(*record) for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._records = len(records)
@@ -0,0 +1,122 @@
+"""Планировщик напоминаний: спит ровно до ближайшего срабатывания.
+
+Ближайшие срабатывания лежат в куче. Планировщик просыпается к первому из
+них, при изменении файлов напоминаний (notify_changed или плановая проверка
+раз в rescan секунд). После отправки расписание пересобирается, чтобы в
+него встало следующее срабатывание повторяющихся напоминаний. Пропущенное за время простоя или
+из-за ошибки отправки досылается, если опоздание не больше grace.
+"""
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Set, Tuple
+
+from utils.reminder_utils import ReminderParser
+
+logger = logging.getLogger(__name__)
+
+RETRY_DELAY = 30
+
+
+class ReminderScheduler:
+    def __init__(self, parser: ReminderParser, send: Callable[[str], Awaitable[None]],
+                 grace: float, rescan: float):
+        self.parser = parser
+        self.send = send
+        # Отправленные помнятся журналом retention секунд, дольше досылать нельзя
+        self.grace = timedelta(seconds=min(grace, parser.sent.retention))
+        self.rescan = rescan
+        # (когда отправлять, время напоминания, идентификатор, текст)
+        self._heap: List[Tuple[float, float, str, str]] = []
+        # Идентификаторы, которые уже были в расписании. Напоминание, впервые
+        # увиденное с временем в прошлом, дописано задним числом - его не досылаем
+        self._known: Set[str] = set()
+        # Не отправленные из-за ошибки: идентификатор -> (время напоминания, когда повторить).
+        # Пересборка расписания ставит их на время повтора, а не сразу
+        self._retry_at: Dict[str, Tuple[float, float]] = {}
+        self._started = False
+        self._changed = asyncio.Event()
+
+    def notify_changed(self):
+        """Файлы напоминаний изменились - пересобрать расписание сейчас"""
+        self._changed.set()
+
+    def _rebuild(self, now: datetime):
+        heap = []
+        late = True
+        while late:
+            heap.clear()
+            late = False
+            for reminder_time, identifier, text in self.parser.upcoming(now - self.grace):
+                if self._started and reminder_time < now and identifier not in self._known:
+                    # Считаем прошедшим, чтобы в расписание попало следующее срабатывание
+                    self.parser.mark_sent(identifier, reminder_time)
+                    late = True
+                    continue
+                fire_ts = reminder_time.timestamp()
+                retry = self._retry_at.get(identifier)
+                at = retry[1] if retry and retry[0] == fire_ts else fire_ts
+                heap.append((at, fire_ts, identifier, text))
+        heapq.heapify(heap)
+        self._heap = heap
+        self._known = {identifier for _, _, identifier, _ in heap}
+        # Напоминание удалили или изменили его время - повтор больше не нужен
+        self._retry_at = {identifier: retry for identifier, retry in self._retry_at.items()
+                          if identifier in self._known}
+        self._started = True
+        if heap:
+            logger.debug(f"Напоминаний в расписании: {len(heap)}, ближайшее "
+                         f"{datetime.fromtimestamp(heap[0][0]).strftime('%d.%m.%Y %H:%M')}")
+
+    async def _fire_due(self, now: datetime) -> bool:
+        """Отправляет наступившие напоминания. True - расписание надо пересобрать.
+
+        Наступившие отправляются разом: очередь отправки может склеить их в одно сообщение.
+        """
+        due = []
+        while self._heap and self._heap[0][0] <= now.timestamp():
+            due.append(heapq.heappop(self._heap))
+        if not due:
+            return False
+        results = await asyncio.gather(*(self.send(text) for _, _, _, text in due), return_exceptions=True)
+        fired = False
+        for (_, fire_ts, identifier, text), result in zip(due, results):
+            if isinstance(result, Exception):
+                logger.error(f"Reminder error: {str(result)}")
+                # Повторим позже, пока не вышло окно досылки
+                if datetime.fromtimestamp(fire_ts) + self.grace > now:
+                    retry_ts = now.timestamp() + RETRY_DELAY
+                    self._retry_at[identifier] = (fire_ts, retry_ts)
+                    heapq.heappush(self._heap, (retry_ts, fire_ts, identifier, text))
+                    continue
+                logger.warning(f"Напоминание не отправлено:{text}")
+            self._retry_at.pop(identifier, None)
+            self.parser.mark_sent(identifier, datetime.fromtimestamp(fire_ts))
+            fired = True
+        return fired
+
+    async def run(self):
+        changed = True
+        while True:
+            try:
+                if await asyncio.to_thread(self.parser.refresh) or changed:
+                    self._rebuild(datetime.now())
+                # После отправки в расписание встаёт следующее срабатывание повторяющихся
+                changed = await self._fire_due(datetime.now())
+                if changed:
+                    self._rebuild(datetime.now())
+                    changed = False
+                # Отправленное за этот проход сохраняется одной записью на диск
+                await asyncio.to_thread(self.parser.sent.flush)
+            except Exception as e:
+                logger.error(f"Reminder error: {str(e)}")
+
+            timeout = self.rescan
+            if self._heap:
+                timeout = min(timeout, max(0.0, self._heap[0][0] - datetime.now().timestamp()))
+            try:
+                await asyncio.wait_for(self._changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._changed.clear()
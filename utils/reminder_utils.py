@@ -1,46 +1,126 @@
+import os
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
 import logging
-from typing import List, Tuple, Optional
+from typing import Dict, Iterable, List, Tuple, Optional
 import config
+from utils.backup_filter import BackupFilter, Rule
+from utils.reminder_ledger import SentLedger
+from utils.metrics import REMINDER_FILES, REMINDER_LINES, REMINDER_SCAN_SECONDS
 logger = logging.getLogger(__name__)
 
+GLOB_CHARS = set('*?[')
+# Скрытые папки (.obsidian, .trash, .git) при поиске напоминаний не обходим
+SKIP_DIRS = ['.*/']
+REMINDER_MARK = '|-'
+SCAN_BATCH = 256
+
+# Шаблоны компилируются один раз при импорте, а не для каждой строки
+PATTERNS = [
+    # Формат: [описание задачи] |- дд.мм[.гггг] чч:мм
+    (re.compile(r'^(.+?)\s*\|-\s*(\d{1,2}\.\d{1,2}(?:\.\d{4})?)\s+(\d{1,2}:\d{2})\s*$'), '_parse_date_time'),
+
+    # Формат: [описание задачи] |- пн-вс чч:мм
+    (re.compile(r'^(.+?)\s*\|-\s*(пн|вт|ср|чт|пт|сб|вс)\s+(\d{1,2}:\d{2})\s*$'), '_parse_week_day'),
+
+    # Формат: [описание задачи] |- чч:мм
+    (re.compile(r'^(.+?)\s*\|-\s*(\d{1,2}:\d{2})\s*$'), '_parse_time_only'),
+]
+
+
+class ReminderSources:
+    """Где искать напоминания: файлы, папки ("Дневник/") и маски ("Проекты/**/*.md").
+
+    Маски записываются как в .gitignore: без "/" ищутся на любой глубине.
+    В папках берутся только .md файлы. Вальт обходится, только если среди
+    источников есть папки или маски
+    """
+
+    def __init__(self, vault: Path, patterns: Iterable[str]):
+        self.vault = vault
+        self.files: List[str] = []
+        self.folders: List[str] = []
+        self.rules: List[Rule] = []
+        for pattern in patterns:
+            pattern = pattern.strip().replace('\\', '/')
+            if not pattern:
+                continue
+            if GLOB_CHARS & set(pattern):
+                self.rules.append(Rule(pattern))
+            elif pattern.endswith('/') or (vault / pattern).is_dir():
+                self.folders.append(pattern.strip('/') + '/')
+            else:
+                self.files.append(pattern.lstrip('/'))
+        self._walker = BackupFilter(SKIP_DIRS)
+
+    def covers(self, rel: str) -> bool:
+        """Может ли в файле rel быть напоминание"""
+        return rel in self.files or self.matches(rel)
+
+    def matches(self, rel: str) -> bool:
+        if rel.endswith('.md') and any(rel.startswith(folder) for folder in self.folders):
+            return True
+        return any(rule.match(rel) for rule in self.rules)
+
+    def discover(self) -> Dict[str, Optional[os.DirEntry]]:
+        """{относительный путь: DirEntry или None}. DirEntry есть у найденных обходом"""
+        found: Dict[str, Optional[os.DirEntry]] = {rel: None for rel in self.files}
+        if self.folders or self.rules:
+            for rel, entry in self._walker.walk(self.vault):
+                if self.matches(rel):
+                    found[rel] = entry
+        return found
+
+
 class ReminderParser:
-    def __init__(self, obsidian_path: Path):
+    def __init__(self, obsidian_path: Path, sources: Optional[Iterable[str]] = None,
+                 workers: Optional[int] = None, ledger_path: Optional[Path] = None):
         self.obsidian_path = obsidian_path
-        self.sent_reminders = set()
+        self.sources = ReminderSources(
+            obsidian_path, config.REMINDER_FILES if sources is None else sources)
+        # Чтение и разбор файлов - в потоках: stat и чтение отпускают GIL
+        self.workers = workers or config.REMINDER_WORKERS or min(32, (os.cpu_count() or 1) * 4)
+        self._pool: Optional[ThreadPoolExecutor] = None
+        # Отправленные напоминания; без ledger_path журнал живёт только в памяти
+        self.sent = SentLedger(ledger_path)
         self.day_map = {
             'пн': 0, 'вт': 1, 'ср': 2, 
             'чт': 3, 'пт': 4, 'сб': 5, 'вс': 6
         }
+        # Кэш разобранных файлов: относительный путь -> {'key': (mtime_ns, size), 'items': [...]}
+        # items - найденные строки с напоминаниями: (номер, строка, обработчик, группы).
+        # Даты считаются заново на каждой проверке, т.к. "чч:мм" и "пн" зависят от текущего времени
+        self._cache: Dict[str, Dict] = {}
+        self._missing = set()
+        self.stats = {'scans': 0, 'files': 0, 'hits': 0, 'lines_parsed': 0}
 
-    def parse_line(self, line: str) -> List[Tuple[datetime, str]]:
-        patterns = [
-            # Формат: [описание задачи] |- дд.мм[.гггг] чч:мм
-            (r'^(.+?)\s*\|-\s*(\d{1,2}\.\d{1,2}(?:\.\d{4})?)\s+(\d{1,2}:\d{2})\s*$', self._parse_date_time),
-            
-            # Формат: [описание задачи] |- пн-вс чч:мм
-            (r'^(.+?)\s*\|-\s*(пн|вт|ср|чт|пт|сб|вс)\s+(\d{1,2}:\d{2})\s*$', self._parse_week_day),
-            
-            # Формат: [описание задачи] |- чч:мм
-            (r'^(.+?)\s*\|-\s*(\d{1,2}:\d{2})\s*$', self._parse_time_only)
-        ]
+    @staticmethod
+    def match_line(line: str) -> Optional[Tuple[str, tuple]]:
+        """Имя обработчика и группы регулярки для строки-напоминания"""
+        for pattern, handler in PATTERNS:
+            match = pattern.match(line)
+            if match:
+                return handler, match.groups()
+        return None
 
+    def parse_line(self, line: str) -> List[Tuple[datetime, str]]:
         line = line.strip()
         if not line:
             return []
 
-        for pattern, handler in patterns:
-            match = re.match(pattern, line)
-            if match:
-                return handler(match.groups())
+        matched = self.match_line(line)
+        if matched:
+            handler, groups = matched
+            return getattr(self, handler)(groups)
                 
         return []
 
-    def _parse_date_time(self, groups: tuple) -> List[Tuple[datetime, str]]:
+    def _parse_date_time(self, groups: tuple, now: Optional[datetime] = None) -> List[Tuple[datetime, str]]:
         task, date_str, time_str = groups
-        now = datetime.now()
+        now = now or datetime.now()
         
         try:
             # Парсим дату
@@ -65,9 +145,9 @@ class ReminderParser:
             logger.warning(f"Ошибка парсинга даты: {str(e)}")
             return []
 
-    def _parse_week_day(self, groups: tuple) -> List[Tuple[datetime, str]]:
+    def _parse_week_day(self, groups: tuple, now: Optional[datetime] = None) -> List[Tuple[datetime, str]]:
         task, day_str, time_str = groups
-        now = datetime.now()
+        now = now or datetime.now()
         
         try:
             # Парсим день недели и время
@@ -94,9 +174,9 @@ class ReminderParser:
             
         return []
 
-    def _parse_time_only(self, groups: tuple) -> List[Tuple[datetime, str]]:
+    def _parse_time_only(self, groups: tuple, now: Optional[datetime] = None) -> List[Tuple[datetime, str]]:
         task, time_str = groups
-        now = datetime.now()
+        now = now or datetime.now()
         
         try:
             # Парсим время
@@ -113,63 +193,127 @@ class ReminderParser:
             logger.warning(f"Ошибка парсинга времени: {str(e)}")
             return []
 
-    def check_reminders(self) -> List[str]:
-        events = []
-        current_time = datetime.now()
-        
-        for file_name in config.REMINDER_FILES:
-            
-            file_path = self.obsidian_path / file_name.strip()
-            print (file_path)
-            if not self._process_file(file_path, current_time, events):
+    def refresh(self) -> bool:
+        """Перечитывает изменившиеся файлы напоминаний.
+
+        Возвращает True, если набор напоминаний мог измениться (файл
+        изменён, появился или пропал)
+        """
+        started = time.perf_counter()
+        before = {rel: cached['key'] for rel, cached in self._cache.items()}
+        found = self.sources.discover()
+
+        # Файлы раздаются потокам пачками: отдельная задача на каждый файл
+        # стоит дороже, чем stat неизменившегося файла
+        items = list(found.items())
+        batches = [items[i:i + SCAN_BATCH] for i in range(0, len(items), SCAN_BATCH)]
+        if len(batches) > 1:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='reminders')
+            scanned = self._pool.map(self._scan_batch, batches)
+        else:
+            scanned = map(self._scan_batch, batches)
+        results = [result for batch in scanned for result in batch]
+
+        cache = {}
+        hits = 0
+        for rel, (cached, hit) in zip(found, results):
+            if cached is None:
+                if rel in self._cache or rel not in self._missing:
+                    logger.warning(f"Файл {rel} не найден")
+                self._missing.add(rel)
                 continue
-                
-        self._cleanup_old_reminders(current_time)
-        return events
+            self._missing.discard(rel)
+            hits += hit
+            if not hit:
+                self.stats['lines_parsed'] += cached['lines']
+                REMINDER_LINES.inc(cached['lines'])
+            cache[rel] = cached
+        self._cache = cache
 
-    def _process_file(self, file_path: Path, current_time: datetime, events: list) -> bool:
-        if not file_path.exists():
-            logger.warning(f"Файл {file_path.name} не найден")
-            return False
-            
+        files = len(found)
+        elapsed = (time.perf_counter() - started) * 1000
+        REMINDER_SCAN_SECONDS.observe(elapsed / 1000)
+        REMINDER_FILES.inc(hits, source='cache')
+        REMINDER_FILES.inc(len(cache) - hits, source='read')
+        self.stats['scans'] += 1
+        self.stats['files'] += files
+        self.stats['hits'] += hits
+        logger.debug(f"Проверка напоминаний: {elapsed:.1f} мс, файлов {files}, "
+                     f"из кэша {hits}/{files}, всего попаданий "
+                     f"{self.stats['hits']}/{self.stats['files']}")
+        return before != {rel: cached['key'] for rel, cached in self._cache.items()}
+
+    def upcoming(self, since: datetime) -> List[Tuple[datetime, str, str]]:
+        """Ближайшие срабатывания не раньше since: (время, идентификатор, текст).
+
+        Повторяющиеся напоминания ("чч:мм", "пн чч:мм") считаются от since,
+        поэтому пропущенное после since срабатывание тоже попадает в список.
+        Вместо уже отправленного срабатывания берётся следующее
+        """
+        result = []
+        for rel, cached in self._cache.items():
+            for line_num, line, handler, groups in cached['items']:
+                try:
+                    reminders = getattr(self, handler)(groups, since)
+                except Exception as e:
+                    logger.error(f"Ошибка в строке {line_num}: '{line}'\n{str(e)}")
+                    continue
+                for reminder_time, task in reminders:
+                    identifier = f"{rel}:{reminder_time.timestamp()}:{task}"
+                    # Повторяющееся напоминание уже отправлено - берём следующее срабатывание
+                    while identifier in self.sent:
+                        following = getattr(self, handler)(groups, reminder_time + timedelta(minutes=1))
+                        if not following or following[0][0] <= reminder_time:
+                            break
+                        reminder_time = following[0][0]
+                        identifier = f"{rel}:{reminder_time.timestamp()}:{task}"
+                    if reminder_time < since or identifier in self.sent:
+                        continue
+                    text = f" {task.replace('- [ ] ','')} ({reminder_time.strftime('%d.%m.%Y %H:%M')})"
+                    result.append((reminder_time, identifier, text))
+        return result
+
+    def mark_sent(self, identifier: str, reminder_time: datetime):
+        """Запоминает срабатывание. На диск попадает при следующем sent.flush()"""
+        self.sent.add(identifier, reminder_time.timestamp())
+
+    def _scan_batch(self, batch: List[Tuple[str, Optional[os.DirEntry]]]) -> list:
+        return [self._scan_file(rel, entry) for rel, entry in batch]
+
+    def _scan_file(self, rel: str, entry: Optional[os.DirEntry]) -> Tuple[Optional[Dict], bool]:
+        """(запись кэша, взята ли из кэша). Запись None - файла нет.
+
+        Неизменившийся файл (те же mtime и размер) стоит один stat. Изменившийся
+        читается целиком, и по строкам разбирается, только если в нём есть "|-"
+        """
+        cached = self._cache.get(rel)
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                for line_num, line in enumerate(f, 1):
-                    self._process_line(line, line_num, current_time, events, file_path) 
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка чтения файла {file_path.name}: {str(e)}")
-            return False
+            st = entry.stat() if entry is not None else (self.obsidian_path / rel).stat()
+        except FileNotFoundError:
+            return None, False
+        key = (st.st_mtime_ns, st.st_size)
+        if cached and cached['key'] == key:
+            return cached, True
 
-    def _process_line(self, line: str, line_num: int, current_time: datetime, events: list, file_path: Path):
-        line = line.strip()
-        if not line or '|-' not in line:
-            return
-            
+        items = []
+        lines = 0
         try:
-            for reminder_time, task in self.parse_line(line):
-                time_diff = (reminder_time - current_time).total_seconds()
-                identifier = f"{file_path.name}:{reminder_time.timestamp()}:{task}"
-                
-                if 0 <= time_diff <= 60 and identifier not in self.sent_reminders:
-                    events.append(f" {task.replace('- [ ] ','')} ({reminder_time.strftime('%d.%m.%Y %H:%M')})")
-                    self.sent_reminders.add(identifier)
-                    
+            with open(self.obsidian_path / rel, 'rb') as f:
+                data = f.read()
+            if REMINDER_MARK.encode() in data:
+                for line_num, line in enumerate(data.decode('utf-8').splitlines(), 1):
+                    line = line.strip()
+                    if not line or REMINDER_MARK not in line:
+                        continue
+                    lines += 1
+                    matched = self.match_line(line)
+                    if matched:
+                        items.append((line_num, line, matched[0], matched[1]))
+        except FileNotFoundError:
+            return None, False
         except Exception as e:
-            logger.error(f"Ошибка в строке {line_num}: '{line}'\n{str(e)}")
-
-    def _cleanup_old_reminders(self, current_time: datetime):
-        threshold = current_time - timedelta(hours=24)
-        new_sent_reminders = set()
-        
-        for ident in self.sent_reminders:
-            try:
-                parts = ident.split(':', 2)  # Разделяем только первые два двоеточия
-                timestamp_str = parts[1]
-                reminder_time = datetime.fromtimestamp(float(timestamp_str))
-                if reminder_time > threshold:
-                    new_sent_reminders.add(ident)
-            except Exception as e:
-                logger.warning(f"Ошибка очистки напоминания {ident}: {str(e)}")
-        
-        self.sent_reminders = new_sent_reminders
+            logger.error(f"Ошибка чтения файла {rel}: {str(e)}")
+            # Без ключа файл перечитается на следующей проверке
+            return {'key': None, 'items': cached['items'] if cached else [], 'lines': 0}, False
+        return {'key': key, 'items': items, 'lines': lines}, False
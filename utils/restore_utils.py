@@ -0,0 +1,212 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import pyzipper
+
+from utils.backup_index import read_index
+from utils.backup_utils import DELTA_MEMBER, load_chains
+from utils.chunk_store import SNAPSHOT_SUFFIX, STORE_DIR_NAME, ChunkStore, restore_from_store
+from utils.tar_stream import ARCHIVE_SUFFIX as TAR_SUFFIX, iter_tar_zst
+from utils.zip_writer import extract_member
+
+logger = logging.getLogger(__name__)
+
+COPY_CHUNK = 1024 * 1024
+
+
+def _wanted(name: str, paths: Optional[List[str]]) -> bool:
+    return not paths or any(name == p or name.startswith(p.rstrip('/') + '/') for p in paths)
+
+
+def _safe_dest(target: Path, name: str) -> Optional[Path]:
+    dest = (target / name).resolve()
+    if not dest.is_relative_to(target):
+        logger.warning(f"Пропускаю подозрительный путь: {name}")
+        return None
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    return dest
+
+
+def _write_member(target: Path, name: str, src, mtime: Optional[float] = None) -> bool:
+    """Пишет файл из архива в target, не выпуская его за пределы target"""
+    dest = _safe_dest(target, name)
+    if dest is None:
+        return False
+    tmp_path = dest.with_name(dest.name + '.restore-tmp')
+    with open(tmp_path, 'wb') as f:
+        while chunk := src.read(COPY_CHUNK):
+            f.write(chunk)
+    os.replace(tmp_path, dest)
+    if mtime is not None:
+        os.utime(dest, (mtime, mtime))
+    return True
+
+
+def _apply_deletions(target: Path, delta: dict, paths: Optional[List[str]]):
+    for name in delta.get('deleted', []):
+        if _wanted(name, paths):
+            (target / name).unlink(missing_ok=True)
+
+
+def restore_archive(archive: Path, password: str, target: Path,
+                    paths: Optional[List[str]] = None) -> int:
+    """Распаковывает один архив любого формата (zip, tar.zst.enc, снимок хранилища).
+
+    paths - файлы или папки внутри вальта (None - всё). Для дельта-архива
+    удаляет из target файлы, удалённые в этой дельте.
+    Возвращает количество восстановленных файлов.
+    """
+    target = target.resolve()
+    target.mkdir(parents=True, exist_ok=True)
+    restored = 0
+    delta = None
+
+    if archive.name.endswith(SNAPSHOT_SUFFIX):
+        store = ChunkStore(archive.parent.parent, password)
+        return restore_from_store(store, archive, target, paths)
+
+    if archive.name.endswith(TAR_SUFFIX):
+        for member, src in iter_tar_zst(archive, password):
+            if src is None:
+                continue
+            if member.name == DELTA_MEMBER:
+                delta = json.loads(src.read())
+            elif _wanted(member.name, paths):
+                restored += _write_member(target, member.name, src, member.mtime)
+    else:
+        with pyzipper.AESZipFile(archive) as zipf:
+            zipf.setpassword(password.encode('utf-8'))
+            for info in zipf.infolist():
+                if info.is_dir():
+                    continue
+                if info.filename == DELTA_MEMBER:
+                    delta = json.loads(zipf.read(info))
+                elif _wanted(info.filename, paths):
+                    with zipf.open(info) as src:
+                        restored += _write_member(target, info.filename, src)
+
+    if delta:
+        _apply_deletions(target, delta, paths)
+    return restored
+
+
+def resolve_chain(backup_dir: Path, name: str) -> List[Path]:
+    """Цепочка архивов от полного бэкапа до указанного (включительно)"""
+    chains = load_chains(backup_dir)
+    chain = []
+    current = name
+    while current:
+        chain.append(backup_dir / current)
+        current = chains.get(current, {}).get('parent')
+    chain.reverse()
+    missing = [path.name for path in chain if not path.exists()]
+    if missing:
+        raise FileNotFoundError(f"Не хватает архивов цепочки: {', '.join(missing)}")
+    return chain
+
+
+def plan_restore(backup_dir: Path, name: str, password: str,
+                 paths: Optional[List[str]] = None) -> Optional[Dict[str, Tuple[Path, dict]]]:
+    """По индексам цепочки определяет, из какого архива брать каждый файл.
+
+    Возвращает {путь: (архив, запись индекса)} - состояние вальта на момент
+    бэкапа name с учётом удалений в дельтах. None - у какого-то архива цепочки
+    нет индекса (созданного до появления индексов).
+    """
+    chain = resolve_chain(backup_dir, name)
+    try:
+        indexes = [(archive, read_index(archive, password)) for archive in chain]
+    except FileNotFoundError:
+        return None
+    chosen = {}
+    gone = set()
+    # От новых к старым: берём самую свежую версию файла, удалённые в более
+    # поздних дельтах файлы из старых архивов не восстанавливаем
+    for archive, index in reversed(indexes):
+        for entry in index['entries']:
+            path = entry['path']
+            if path in chosen or path in gone or not _wanted(path, paths):
+                continue
+            chosen[path] = (archive, entry)
+        gone.update(index['meta'].get('deleted', []))
+    return chosen
+
+
+def _extract_planned(archive: Path, entries: List[dict], password: str, target: Path) -> int:
+    restored = 0
+    if archive.name.endswith(TAR_SUFFIX):
+        # tar читается только потоком, но останавливаемся сразу после последнего нужного файла
+        wanted = {entry['path']: entry for entry in entries}
+        for member, src in iter_tar_zst(archive, password):
+            entry = wanted.pop(member.name, None)
+            if entry and src is not None:
+                restored += _write_member(target, member.name, src, entry['mtime'])
+            if not wanted:
+                break
+        return restored
+
+    with open(archive, 'rb') as fp:
+        for entry in sorted(entries, key=lambda item: item['offset']):
+            dest = _safe_dest(target, entry['path'])
+            if dest is None:
+                continue
+            tmp_path = dest.with_name(dest.name + '.restore-tmp')
+            try:
+                with open(tmp_path, 'wb') as out:
+                    extract_member(fp, entry['offset'], password, out)
+            except BaseException:
+                tmp_path.unlink(missing_ok=True)
+                raise
+            os.replace(tmp_path, dest)
+            os.utime(dest, (entry['mtime'], entry['mtime']))
+            restored += 1
+    return restored
+
+
+def restore_backup(backup_dir: Path, name: str, password: str, target: Path,
+                   paths: Optional[List[str]] = None) -> int:
+    """Восстанавливает состояние вальта (или только paths) на момент бэкапа name.
+
+    Если у архивов есть индексы, каждый файл читается один раз прямо по
+    смещению из нужного архива цепочки - время зависит от объёма запрошенного,
+    а не от размера архивов. Иначе цепочка распаковывается целиком по порядку.
+    name может быть и снимком хранилища с дедупликацией.
+    """
+    if name.endswith(SNAPSHOT_SUFFIX):
+        return restore_archive(backup_dir / STORE_DIR_NAME / "snapshots" / name,
+                               password, target, paths)
+
+    plan = plan_restore(backup_dir, name, password, paths)
+    if plan is None:
+        restored = 0
+        for archive in resolve_chain(backup_dir, name):
+            logger.info(f"Распаковка {archive.name}")
+            restored += restore_archive(archive, password, target, paths)
+        return restored
+
+    target = target.resolve()
+    by_archive: Dict[Path, List[dict]] = {}
+    for archive, entry in plan.values():
+        by_archive.setdefault(archive, []).append(entry)
+    restored = 0
+    for archive, entries in by_archive.items():
+        logger.info(f"{archive.name}: восстанавливаю файлов {len(entries)}")
+        restored += _extract_planned(archive, entries, password, target)
+    return restored
+
+
+def list_backup_files(backup_dir: Path, name: str, password: str,
+                      paths: Optional[List[str]] = None) -> List[dict]:
+    """Содержимое бэкапа по индексам, без открытия архивов"""
+    if name.endswith(SNAPSHOT_SUFFIX):
+        store = ChunkStore(backup_dir / STORE_DIR_NAME, password)
+        files = store.load_snapshot(backup_dir / STORE_DIR_NAME / "snapshots" / name)['files']
+        return [{'path': path, 'size': size, 'mtime': mtime_ns / 1e9}
+                for path, (size, mtime_ns, _) in sorted(files.items()) if _wanted(path, paths)]
+    plan = plan_restore(backup_dir, name, password, paths)
+    if plan is None:
+        raise FileNotFoundError("У архива нет индекса (создан старой версией бота)")
+    return [entry for _, entry in sorted(plan.values(), key=lambda item: item[1]['path'])]
@@ -0,0 +1,245 @@
+"""Потоковый формат бэкапа: tar -> zstd (многопоточный) -> AES-256-GCM по кускам.
+
+Архив пишется и читается одним проходом, без центрального каталога, поэтому
+память не зависит от размера вальта, а сжатие zstd использует все ядра.
+
+Формат файла:
+    magic (6 байт) | соль scrypt (16) | префикс nonce (4)
+    далее записи: длина (4 байта, старший бит - последняя запись) | шифротекст + тег
+Номер записи и признак последней входят в nonce и AAD, поэтому переставить,
+выкинуть или обрезать записи незаметно нельзя.
+"""
+import hashlib
+import io
+import logging
+import os
+import struct
+import tarfile
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+import zstandard
+from Cryptodome.Cipher import AES
+
+from utils.crypto_utils import SALT_SIZE, TAG_SIZE, DecryptionError, derive_key
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'OTZST\x01'
+RECORD_SIZE = 1024 * 1024
+FINAL_FLAG = 0x80000000
+READ_CHUNK = 1024 * 1024
+ARCHIVE_SUFFIX = ".tar.zst.enc"
+
+
+def _nonce(prefix: bytes, index: int) -> bytes:
+    return prefix + struct.pack('>Q', index)
+
+
+def _aad(index: int, final: bool) -> bytes:
+    return struct.pack('>Q?', index, final)
+
+
+class _EncryptingWriter:
+    """Копит сжатый поток и шифрует его записями по RECORD_SIZE"""
+
+    def __init__(self, fp, password: str):
+        self.fp = fp
+        salt = os.urandom(SALT_SIZE)
+        self.prefix = os.urandom(4)
+        self.key = derive_key(password, salt)
+        self.index = 0
+        self.buffer = bytearray()
+        fp.write(MAGIC + salt + self.prefix)
+
+    def write(self, data) -> int:
+        self.buffer += data
+        while len(self.buffer) > RECORD_SIZE:
+            self._emit(bytes(self.buffer[:RECORD_SIZE]), final=False)
+            del self.buffer[:RECORD_SIZE]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        self._emit(bytes(self.buffer), final=True)
+        self.buffer.clear()
+
+    def _emit(self, data: bytes, final: bool):
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=_nonce(self.prefix, self.index))
+        cipher.update(_aad(self.index, final))
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        length = len(ciphertext) + TAG_SIZE
+        self.fp.write(struct.pack('>I', length | (FINAL_FLAG if final else 0)))
+        self.fp.write(ciphertext)
+        self.fp.write(tag)
+        self.index += 1
+
+
+class _DecryptingReader(io.RawIOBase):
+    """Обратная сторона _EncryptingWriter: отдаёт расшифрованный zstd-поток"""
+
+    def __init__(self, fp, password: str):
+        self.fp = fp
+        header = fp.read(len(MAGIC) + SALT_SIZE + 4)
+        if header[:len(MAGIC)] != MAGIC:
+            raise DecryptionError("Это не архив tar.zst.enc")
+        salt = header[len(MAGIC):len(MAGIC) + SALT_SIZE]
+        self.prefix = header[len(MAGIC) + SALT_SIZE:]
+        self.key = derive_key(password, salt)
+        self.index = 0
+        self.buffer = b''
+        self.finished = False
+
+    def readable(self) -> bool:
+        return True
+
+    def _next_record(self):
+        raw = self.fp.read(4)
+        if len(raw) < 4:
+            raise DecryptionError("Архив обрезан")
+        (length,) = struct.unpack('>I', raw)
+        final = bool(length & FINAL_FLAG)
+        length &= ~FINAL_FLAG
+        blob = self.fp.read(length)
+        if len(blob) < length or length < TAG_SIZE:
+            raise DecryptionError("Архив обрезан")
+        cipher = AES.new(self.key, AES.MODE_GCM, nonce=_nonce(self.prefix, self.index))
+        cipher.update(_aad(self.index, final))
+        try:
+            self.buffer = cipher.decrypt_and_verify(blob[:-TAG_SIZE], blob[-TAG_SIZE:])
+        except ValueError:
+            raise DecryptionError("Неверный пароль или архив повреждён")
+        self.index += 1
+        self.finished = final
+
+    def readinto(self, b) -> int:
+        while not self.buffer and not self.finished:
+            self._next_record()
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+class _ProgressReader:
+    """Обёртка над файлом: считает sha256 и сообщает о прочитанных байтах
+    (и может прервать работу).
+
+    Отдаёт ровно size байт - столько записано в заголовке tar до чтения.
+    Файл, который во время бэкапа укоротили или который перестал читаться,
+    дополняется нулями (damaged - что случилось), выросший - обрезается:
+    иначе tarfile прервал бы весь архив.
+    """
+
+    def __init__(self, fp, on_read: Callable[[int], None], size: int):
+        self.fp = fp
+        self.on_read = on_read
+        self.left = size
+        self.digest = hashlib.sha256()
+        self.damaged: Optional[str] = None
+
+    def read(self, size: int = -1) -> bytes:
+        if size < 0 or size > self.left:
+            size = self.left
+        data = b''
+        while len(data) < size and self.damaged is None:
+            try:
+                chunk = self.fp.read(size - len(data))
+            except OSError as e:
+                self.damaged = f"ошибка чтения: {str(e)}"
+                break
+            if not chunk:
+                self.damaged = "файл стал короче"
+                break
+            data += chunk
+        if len(data) < size:
+            data += bytes(size - len(data))
+        self.left -= len(data)
+        if data:
+            self.digest.update(data)
+            self.on_read(len(data))
+        return data
+
+    def check_end(self):
+        """После записи: не дописали ли в файл, пока он читался"""
+        if self.damaged is None:
+            try:
+                if self.fp.read(1):
+                    self.damaged = "файл вырос"
+            except OSError as e:
+                self.damaged = f"ошибка чтения: {str(e)}"
+
+
+def write_tar_zst(input_dir: Path, output: Path, password: str, files: List[str],
+                  extra: Optional[Dict[str, bytes]] = None, level: int = 3,
+                  progress: Optional[Callable[[int, int], None]] = None):
+    """Пишет зашифрованный tar.zst. progress(файлов, байт) может прервать работу исключением.
+
+    При ошибке или отмене недописанный архив удаляется. Возвращает описание
+    записанных файлов для индекса (смещений нет - архив читается только потоком).
+    Файлы, изменившиеся во время чтения, помечены 'damaged': их копия в архиве неполная.
+    """
+    entries = []
+    files_done = 0
+    bytes_done = 0
+
+    def on_read(n: int):
+        nonlocal bytes_done
+        bytes_done += n
+        if progress:
+            progress(files_done, bytes_done)
+
+    compressor = zstandard.ZstdCompressor(level=level, threads=-1)
+    try:
+        with open(output, 'wb') as fp:
+            encryptor = _EncryptingWriter(fp, password)
+            with compressor.stream_writer(encryptor, closefd=False) as zst:
+                with tarfile.open(fileobj=zst, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                    for arcname in files:
+                        path = input_dir / arcname
+                        try:
+                            src = open(path, 'rb')
+                        except OSError as e:
+                            # Удалён после сканирования или нет доступа - в архив не попадает
+                            logger.warning(f"Пропускаю {arcname}: {str(e)}")
+                            files_done += 1
+                            continue
+                        with src:
+                            # Размер - по открытому файлу, дальше он в заголовке не меняется
+                            info = tar.gettarinfo(arcname=arcname, fileobj=src)
+                            reader = _ProgressReader(src, on_read, info.size)
+                            tar.addfile(info, reader)
+                            reader.check_end()
+                        entry = {
+                            'path': arcname, 'size': info.size, 'mtime': info.mtime,
+                            'hash': reader.digest.hexdigest(), 'offset': None,
+                        }
+                        if reader.damaged:
+                            logger.warning(f"{arcname} в архиве неполный ({reader.damaged}), "
+                                           f"попадёт в следующий бэкап")
+                            entry['damaged'] = True
+                        entries.append(entry)
+                        files_done += 1
+                        if progress:
+                            progress(files_done, bytes_done)
+                    for arcname, data in (extra or {}).items():
+                        info = tarfile.TarInfo(arcname)
+                        info.size = len(data)
+                        tar.addfile(info, io.BytesIO(data))
+            encryptor.finish()
+    except BaseException:
+        output.unlink(missing_ok=True)
+        raise
+    return entries
+
+
+def iter_tar_zst(archive: Path, password: str) -> Iterator:
+    """Последовательно отдаёт (TarInfo, файловый объект или None) из архива"""
+    with open(archive, 'rb') as fp:
+        reader = io.BufferedReader(_DecryptingReader(fp, password), READ_CHUNK)
+        with zstandard.ZstdDecompressor().stream_reader(reader) as zst:
+            with tarfile.open(fileobj=zst, mode='r|') as tar:
+                for member in tar:
+                    yield member, tar.extractfile(member) if member.isfile() else None
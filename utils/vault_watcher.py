@@ -0,0 +1,354 @@
+"""Слежение за изменениями в вальте.
+
+На Linux используется inotify (через ctypes, без сторонних библиотек), на
+сетевых дисках и других системах - сравнение снимков stat раз в poll секунд.
+События копятся debounce секунд после последнего изменения (но не дольше
+max_delay) и рассылаются подписчикам одной пачкой относительных путей.
+Временные файлы Syncthing и прочее из правил исключения не попадают в пачку,
+а переименование временного файла в заметку даёт одно изменение заметки.
+
+    watcher = VaultWatcher(vault, vault_filter)
+    changes = watcher.subscribe()
+    asyncio.create_task(watcher.run())
+    paths = await changes.get()   # ANY в paths - изменилось неизвестно что
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import sys
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from utils.backup_filter import BackupFilter
+
+logger = logging.getLogger(__name__)
+
+# Путь-маркер: события потеряны (переполнение очереди, перенос папки) -
+# подписчик должен считать, что изменилось всё
+ANY = ''
+
+NETWORK_FS = {'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', '9p', 'afs', 'ceph', 'glusterfs'}
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+
+class Subscription:
+    """Очередь одного подписчика. Пачки, которые он не успел забрать,
+    сливаются в одну - память не растёт, сколько бы событий ни пришло"""
+
+    def __init__(self):
+        self._pending: Set[str] = set()
+        self._event = asyncio.Event()
+
+    def put(self, paths: Iterable[str]):
+        self._pending.update(paths)
+        if self._pending:
+            self._event.set()
+
+    def take(self) -> Set[str]:
+        """Изменения с прошлого вызова, не дожидаясь новых (пустое множество - ничего)"""
+        paths, self._pending = self._pending, set()
+        self._event.clear()
+        return paths
+
+    async def get(self) -> Set[str]:
+        await self._event.wait()
+        return self.take()
+
+
+def is_network_mount(path: Path) -> bool:
+    """Лежит ли path на сетевой ФС, где inotify не видит чужие изменения"""
+    try:
+        with open('/proc/mounts', 'r', encoding='utf-8') as f:
+            mounts = [line.split()[1:3] for line in f if len(line.split()) > 2]
+    except OSError:
+        return False
+    path = str(path.resolve())
+    best, fstype = '', ''
+    for point, kind in mounts:
+        point = point.replace('\\040', ' ')
+        if (path == point or path.startswith(point.rstrip('/') + '/')) and len(point) >= len(best):
+            best, fstype = point, kind
+    return fstype in NETWORK_FS or fstype.startswith('fuse.')
+
+
+class _Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+
+    def add_watch(self, path: Path) -> int:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(path))
+        return wd
+
+    def rm_watch(self, wd: int):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self) -> List[Tuple[int, int, str]]:
+        """(wd, mask, имя) для всех накопившихся событий"""
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class VaultWatcher:
+    def __init__(self, root: Path, flt: BackupFilter, mode: str = 'auto',
+                 debounce: float = 2.0, max_delay: float = 30.0, poll: float = 60.0):
+        self.root = root
+        self.filter = flt
+        self.mode = mode
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll = poll
+        self.backend: Optional[str] = None
+        self.stats = {'events': 0, 'batches': 0, 'paths': 0}
+        self._subscribers: List[Subscription] = []
+        self._pending: Set[str] = set()
+        self._first_event = 0.0
+        self._last_event = 0.0
+        self._dirty: Optional[asyncio.Event] = None
+        self._inotify: Optional[_Inotify] = None
+        self._watches: Dict[int, str] = {}
+        # Папки, которые надо обойти и поставить на наблюдение (None - весь вальт заново).
+        # Обход идёт в потоке: на большом вальте он занял бы цикл событий надолго
+        self._walks: Optional[asyncio.Queue] = None
+        self._snapshot: Dict[str, Tuple[int, int]] = {}
+
+    @property
+    def running(self) -> bool:
+        return self.backend is not None
+
+    def subscribe(self) -> Subscription:
+        subscription = Subscription()
+        self._subscribers.append(subscription)
+        return subscription
+
+    def _changed(self, paths: Iterable[str]):
+        self._pending.update(paths)
+        now = asyncio.get_running_loop().time()
+        if not self._dirty.is_set():
+            self._first_event = now
+            self._dirty.set()
+        self._last_event = now
+
+    async def _publish_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._dirty.wait()
+            # Ждём паузы в изменениях: Syncthing и редакторы пишут сериями
+            while True:
+                deadline = min(self._last_event + self.debounce, self._first_event + self.max_delay)
+                delay = deadline - loop.time()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+            paths, self._pending = self._pending, set()
+            self._dirty.clear()
+            self.stats['batches'] += 1
+            self.stats['paths'] += len(paths)
+            logger.debug(f"Изменения в вальте: {len(paths)} путей")
+            for subscription in self._subscribers:
+                subscription.put(paths)
+
+    async def run(self):
+        self._dirty = asyncio.Event()
+        publisher = asyncio.create_task(self._publish_loop())
+        try:
+            use_inotify = self.mode == 'inotify' or (
+                self.mode == 'auto' and sys.platform.startswith('linux') and not is_network_mount(self.root))
+            if use_inotify:
+                try:
+                    await self._run_inotify()
+                    return
+                except OSError as e:
+                    logger.warning(f"inotify недоступен ({str(e)}), проверяю вальт раз в {self.poll:.0f} c")
+            await self._run_polling()
+        finally:
+            self.backend = None
+            publisher.cancel()
+
+    # --- inotify ---
+
+    def _watch_tree(self, rel_dir: str) -> List[str]:
+        """Ставит наблюдение на папку и все вложенные. Возвращает найденные файлы"""
+        files = []
+        stack = [rel_dir]
+        while stack:
+            current = stack.pop()
+            try:
+                wd = self._inotify.add_watch(self.root / current if current else self.root)
+            except OSError as e:
+                # Папку успели удалить или к ней нет доступа - не повод отказываться от inotify
+                if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EACCES) and current:
+                    continue
+                raise
+            self._watches[wd] = current
+            try:
+                entries = list(os.scandir(self.root / current if current else self.root))
+            except OSError:
+                continue
+            for entry in entries:
+                rel = f"{current}/{entry.name}" if current else entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if self.filter.excluded_by(rel, is_dir):
+                    continue
+                if is_dir:
+                    stack.append(rel)
+                else:
+                    files.append(rel)
+        return files
+
+    def _rewatch(self):
+        for wd in list(self._watches):
+            self._inotify.rm_watch(wd)
+        self._watches.clear()
+        self._watch_tree('')
+
+    async def _walk_loop(self):
+        """Обходит папки из _walks по одной, в потоке"""
+        while True:
+            rel_dir = await self._walks.get()
+            if rel_dir is None:
+                # Полный обход заменяет и все ждущие обходы папок
+                while not self._walks.empty():
+                    self._walks.get_nowait()
+                try:
+                    await asyncio.to_thread(self._rewatch)
+                except OSError as e:
+                    logger.warning(f"Не удалось заново поставить наблюдение за вальтом: {str(e)}")
+                # Что изменилось, пока наблюдения не было, неизвестно
+                self._changed([ANY])
+                continue
+            try:
+                self._changed(await asyncio.to_thread(self._watch_tree, rel_dir))
+            except OSError as e:
+                logger.warning(f"Не удалось следить за {rel_dir}: {str(e)}")
+                self._changed([ANY])
+
+    def _on_inotify(self):
+        changed = set()
+        for wd, mask, name in self._inotify.read():
+            self.stats['events'] += 1
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("Переполнение очереди inotify, перечитываю вальт")
+                self._walks.put_nowait(None)
+                continue
+            rel_dir = self._watches.get(wd)
+            if rel_dir is None:
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                continue
+            rel = f"{rel_dir}/{name}" if rel_dir else name
+            is_dir = bool(mask & IN_ISDIR)
+            if self.filter.excluded_by(rel, is_dir):
+                continue
+            if is_dir:
+                if mask & IN_MOVED_FROM:
+                    # Наблюдения внутри перенесённой папки указывают на старые пути
+                    self._walks.put_nowait(None)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    # Файлы новой папки попадут в изменения после обхода
+                    self._walks.put_nowait(rel)
+                continue
+            if mask & IN_CREATE:
+                # Сам файл ещё пишется - дождёмся IN_CLOSE_WRITE
+                continue
+            changed.add(rel)
+        if changed:
+            self._changed(changed)
+
+    async def _run_inotify(self):
+        self._inotify = _Inotify()
+        loop = asyncio.get_running_loop()
+        try:
+            try:
+                await asyncio.to_thread(self._watch_tree, '')
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise OSError(e.errno, "мало fs.inotify.max_user_watches")
+                raise
+            self.backend = 'inotify'
+            logger.info(f"Слежу за вальтом через inotify, папок: {len(self._watches)}")
+            self._walks = asyncio.Queue()
+            walker = asyncio.create_task(self._walk_loop())
+            loop.add_reader(self._inotify.fd, self._on_inotify)
+            try:
+                await asyncio.Event().wait()
+            finally:
+                loop.remove_reader(self._inotify.fd)
+                walker.cancel()
+        finally:
+            self._inotify.close()
+            self._inotify = None
+            self._watches.clear()
+
+    # --- опрос ---
+
+    def _take_snapshot(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        for rel, entry in self.filter.walk(self.root):
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            snapshot[rel] = (st.st_mtime_ns, st.st_size)
+        return snapshot
+
+    async def _run_polling(self):
+        self._snapshot = await asyncio.to_thread(self._take_snapshot)
+        self.backend = 'poll'
+        logger.info(f"Слежу за вальтом опросом раз в {self.poll:.0f} c, файлов: {len(self._snapshot)}")
+        while True:
+            await asyncio.sleep(self.poll)
+            snapshot = await asyncio.to_thread(self._take_snapshot)
+            old = self._snapshot
+            changed = {rel for rel, key in snapshot.items() if old.get(rel) != key}
+            changed.update(rel for rel in old if rel not in snapshot)
+            self._snapshot = snapshot
+            if changed:
+                self.stats['events'] += len(changed)
+                self._changed(changed)
@@ -0,0 +1,107 @@
+"""Приём обновлений от Telegram через webhook вместо опроса getUpdates.
+
+Сервер aiohttp работает в том же цикле событий, что и бот. Запрос с верным
+секретом (заголовок X-Telegram-Bot-Api-Secret-Token) подтверждается сразу,
+а обновление обрабатывается диспетчером в фоне.
+
+Остановка (SIGINT/SIGTERM или событие stop): сервер перестаёт принимать
+запросы, ждёт начатые обработчики (не дольше drain_timeout секунд),
+затем вызывает shutdown диспетчера и закрывает сессию бота. Webhook
+у Telegram не удаляется: пока бот выключен, обновления копятся на стороне
+Telegram и придут после запуска.
+"""
+import asyncio
+import logging
+import signal
+from contextlib import suppress
+from typing import Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class DrainingRequestHandler(SimpleRequestHandler):
+    """SimpleRequestHandler, который при остановке дожидается фоновых обработчиков"""
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: Optional[str] = None, **data):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self.stats = {'updates': 0, 'rejected': 0}
+
+    def verify_secret(self, telegram_secret_token: str, bot: Bot) -> bool:
+        if super().verify_secret(telegram_secret_token, bot):
+            self.stats['updates'] += 1
+            return True
+        self.stats['rejected'] += 1
+        logger.warning("Запрос к webhook с неверным секретом отклонён")
+        return False
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._background_feed_update_tasks)
+
+    async def drain(self, timeout: float) -> int:
+        """Ждёт начатые обработчики. Возвращает, сколько не успело завершиться"""
+        pending = set(self._background_feed_update_tasks)
+        if not pending:
+            return 0
+        logger.info(f"Жду завершения обработчиков: {len(pending)}")
+        _, not_done = await asyncio.wait(pending, timeout=timeout)
+        for task in not_done:
+            task.cancel()
+        return len(not_done)
+
+    async def close(self):
+        # Сессию закрывает run_webhook - после остановки диспетчера, которому она ещё нужна
+        pass
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, host: str, port: int, path: str, secret: str,
+                      url: Optional[str] = None, drain_timeout: float = 30,
+                      stop: Optional[asyncio.Event] = None) -> DrainingRequestHandler:
+    """Принимает обновления, пока не придёт сигнал остановки или не сработает stop.
+
+    url - публичный адрес webhook: если задан, он регистрируется в Telegram при запуске.
+    """
+    loop = asyncio.get_running_loop()
+    if stop is None:
+        stop = asyncio.Event()
+        with suppress(NotImplementedError):
+            # На Windows сигналы так не обрабатываются - остаётся KeyboardInterrupt
+            loop.add_signal_handler(signal.SIGTERM, stop.set)
+            loop.add_signal_handler(signal.SIGINT, stop.set)
+
+    handler = DrainingRequestHandler(dp, bot, secret_token=secret)
+    app = web.Application()
+    # Не handler.register(): он закрыл бы сессию бота раньше, чем остановится диспетчер
+    app.router.add_post(path, handler.handle)
+    runner = web.AppRunner(app, handle_signals=False)
+    await runner.setup()
+
+    workflow_data = {'dispatcher': dp, 'bots': [bot], **dp.workflow_data}
+    workflow_data.pop('bot', None)
+    await dp.emit_startup(bot=bot, **workflow_data)
+    try:
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        if url:
+            await bot.set_webhook(url, secret_token=secret,
+                                  allowed_updates=dp.resolve_used_update_types())
+        logger.info(f"Webhook слушает {host}:{port}{path}")
+        await stop.wait()
+    finally:
+        logger.info("Останавливаю webhook")
+        # Новые запросы больше не принимаются, начатые HTTP-ответы отдаются
+        await runner.cleanup()
+        left = await handler.drain(drain_timeout)
+        if left:
+            logger.warning(f"Не дождался обработчиков: {left}")
+        try:
+            await dp.emit_shutdown(bot=bot, **workflow_data)
+        finally:
+            await bot.session.close()
+    return handler
@@ -0,0 +1,405 @@
+"""Параллельная запись ZIP-архива с шифрованием WinZip AES-256.
+
+Каждый файл сжимается и шифруется независимо (у WinZip AES своя соль на файл),
+поэтому эту работу можно раздать по ядрам, а в главном потоке только склеить
+готовые куски в архив: локальные заголовки, данные и центральный каталог.
+Архив читается pyzipper, 7-Zip и WinZip как обычный AES-ZIP (AE-2).
+"""
+import hashlib
+import hmac
+import logging
+import os
+import struct
+import tempfile
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from Cryptodome.Cipher import AES
+from Cryptodome.Util import Counter
+
+logger = logging.getLogger(__name__)
+
+READ_CHUNK = 1024 * 1024
+SPOOL_THRESHOLD = 4 * 1024 * 1024  # крупнее - результат воркера пишется во временный файл
+SAMPLE_SIZE = 64 * 1024
+STORE_RATIO = 0.95  # если пробный кусок сжимается хуже - файл не сжимаем
+
+# Форматы, которые уже сжаты: deflate их не уменьшит
+COMPRESSED_EXTENSIONS = {
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.avif',
+    '.mp4', '.mov', '.mkv', '.webm', '.avi', '.m4v',
+    '.ogg', '.oga', '.opus', '.mp3', '.m4a', '.aac', '.flac',
+    '.zip', '.7z', '.rar', '.gz', '.bz2', '.xz', '.zst',
+}
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP_AES = 99
+AES_STRENGTH_256 = 3
+AES_KEY_SIZE = 32
+AES_SALT_SIZE = 16
+AES_AUTH_SIZE = 10
+AES_VENDOR_VERSION = 2  # AE-2: CRC не записывается, целостность проверяет HMAC
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP_FILECOUNT_LIMIT = 0xFFFF
+FLAG_ENCRYPTED = 0x1
+FLAG_UTF8 = 0x800
+
+
+def choose_compression(path: Path, level: int) -> int:
+    """STORED для уже сжатых форматов и файлов с высокой энтропией"""
+    if level <= 0 or path.suffix.lower() in COMPRESSED_EXTENSIONS:
+        return ZIP_STORED
+    with open(path, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE)
+    if len(sample) < 512:
+        return ZIP_DEFLATED
+    if len(zlib.compress(sample, 1)) > len(sample) * STORE_RATIO:
+        return ZIP_STORED
+    return ZIP_DEFLATED
+
+
+class _AesStream:
+    """Шифрование WinZip AES: AES-CTR (little-endian счётчик с 1) + HMAC-SHA1"""
+
+    def __init__(self, password: bytes):
+        self.salt = os.urandom(AES_SALT_SIZE)
+        keys = hashlib.pbkdf2_hmac('sha1', password, self.salt, 1000,
+                                   2 * AES_KEY_SIZE + 2)
+        self.verifier = keys[2 * AES_KEY_SIZE:]
+        self._cipher = AES.new(
+            keys[:AES_KEY_SIZE], AES.MODE_CTR,
+            counter=Counter.new(128, initial_value=1, little_endian=True))
+        self._mac = hmac.new(keys[AES_KEY_SIZE:2 * AES_KEY_SIZE], digestmod=hashlib.sha1)
+
+    def header(self) -> bytes:
+        return self.salt + self.verifier
+
+    def encrypt(self, data: bytes) -> bytes:
+        data = self._cipher.encrypt(data)
+        self._mac.update(data)
+        return data
+
+    def auth_code(self) -> bytes:
+        return self._mac.digest()[:AES_AUTH_SIZE]
+
+
+def pack_data(data: bytes, password: bytes, level: int, compress_type: int) -> bytes:
+    """Сжимает и шифрует данные из памяти (служебные файлы архива)"""
+    stream = _AesStream(password)
+    if compress_type == ZIP_DEFLATED:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -15)
+        data = comp.compress(data) + comp.flush()
+    return stream.header() + stream.encrypt(data) + stream.auth_code()
+
+
+def pack_member(src: str, password: bytes, level: int, spool_dir: str) -> Optional[Dict]:
+    """Готовит один файл архива: сжатие, шифрование, HMAC. Выполняется в воркере.
+
+    Маленькие результаты возвращаются в памяти, крупные пишутся во временный
+    файл в spool_dir, чтобы память не зависела от размера видео.
+    Возвращает None, если файл пропал, и {'error': текст}, если его не удалось
+    прочитать (нет прав, ошибка ввода-вывода) - такой файл пропускается.
+    """
+    path = Path(src)
+    spool = None
+    try:
+        st = path.stat()
+        compress_type = choose_compression(path, level)
+        stream = _AesStream(password)
+        comp = zlib.compressobj(level, zlib.DEFLATED, -15) if compress_type == ZIP_DEFLATED else None
+
+        parts = [stream.header()]
+        size = len(parts[0])
+        file_size = 0
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(READ_CHUNK)
+                eof = not chunk
+                file_size += len(chunk)
+                digest.update(chunk)
+                if comp:
+                    chunk = comp.flush() if eof else comp.compress(chunk)
+                if chunk:
+                    chunk = stream.encrypt(chunk)
+                    parts.append(chunk)
+                    size += len(chunk)
+                    if spool is None and size > SPOOL_THRESHOLD:
+                        spool = tempfile.NamedTemporaryFile(dir=spool_dir, delete=False)
+                    if spool is not None:
+                        spool.writelines(parts)
+                        parts = []
+                if eof:
+                    break
+        tail = stream.auth_code()
+        size += len(tail)
+        if spool is not None:
+            spool.write(tail)
+            spool.close()
+            payload = None
+        else:
+            parts.append(tail)
+            payload = b''.join(parts)
+        return {
+            'mtime': st.st_mtime,
+            'mode': st.st_mode,
+            'hash': digest.hexdigest(),
+            'file_size': file_size,
+            'compress_size': size,
+            'compress_type': compress_type,
+            'payload': payload,
+            'spool': spool.name if spool is not None else None,
+        }
+    except FileNotFoundError:
+        _drop_spool(spool)
+        return None
+    except OSError as e:
+        # В живом вальте (Syncthing, Obsidian) это обычное дело - бэкап остальных файлов продолжается
+        _drop_spool(spool)
+        return {'error': f"{type(e).__name__}: {str(e)}"}
+
+
+def _drop_spool(spool):
+    if spool is not None:
+        spool.close()
+        os.unlink(spool.name)
+
+
+def _dos_datetime(mtime: float) -> Tuple[int, int]:
+    t = time.localtime(mtime)
+    year = max(t.tm_year, 1980)
+    date = (year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dos_time = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+    return date, dos_time
+
+
+class _ZipAssembler:
+    """Склеивает готовые зашифрованные файлы в ZIP (с поддержкой ZIP64)"""
+
+    def __init__(self, fileobj):
+        self.fp = fileobj
+        self.entries = []
+
+    def add(self, arcname: str, member: Dict) -> int:
+        """Дописывает файл в архив, возвращает смещение его локального заголовка"""
+        name = arcname.encode('utf-8')
+        flags = FLAG_ENCRYPTED | FLAG_UTF8
+        date, dos_time = _dos_datetime(member['mtime'])
+        offset = self.fp.tell()
+        file_size = member['file_size']
+        compress_size = member['compress_size']
+        aes_extra = struct.pack('<HHH2sBH', 0x9901, 7, AES_VENDOR_VERSION, b'AE',
+                                AES_STRENGTH_256, member['compress_type'])
+
+        zip64 = file_size >= ZIP64_LIMIT or compress_size >= ZIP64_LIMIT
+        local_extra = aes_extra
+        if zip64:
+            local_extra = struct.pack('<HHQQ', 0x0001, 16, file_size, compress_size) + aes_extra
+        version = 51
+        header = struct.pack(
+            '<4sHHHHHIIIHH', b'PK\x03\x04', version, flags, ZIP_AES, dos_time, date, 0,
+            ZIP64_LIMIT if zip64 else compress_size,
+            ZIP64_LIMIT if zip64 else file_size,
+            len(name), len(local_extra))
+        self.fp.write(header + name + local_extra)
+
+        if member['payload'] is not None:
+            self.fp.write(member['payload'])
+        else:
+            with open(member['spool'], 'rb') as src:
+                while chunk := src.read(READ_CHUNK):
+                    self.fp.write(chunk)
+            os.unlink(member['spool'])
+
+        self.entries.append((name, flags, dos_time, date, file_size, compress_size,
+                             offset, member['mode'], aes_extra))
+        return offset
+
+    def add_bytes(self, arcname: str, data: bytes, password: bytes, level: int):
+        compress_type = ZIP_DEFLATED if level > 0 else ZIP_STORED
+        payload = pack_data(data, password, level, compress_type)
+        self.add(arcname, {
+            'mtime': time.time(), 'mode': 0o100644, 'file_size': len(data),
+            'compress_size': len(payload), 'compress_type': compress_type,
+            'payload': payload, 'spool': None,
+        })
+
+    def finish(self):
+        cd_offset = self.fp.tell()
+        for (name, flags, dos_time, date, file_size, compress_size,
+             offset, mode, aes_extra) in self.entries:
+            zip64_fields = []
+            if file_size >= ZIP64_LIMIT:
+                zip64_fields.append(file_size)
+            if compress_size >= ZIP64_LIMIT:
+                zip64_fields.append(compress_size)
+            if offset >= ZIP64_LIMIT:
+                zip64_fields.append(offset)
+            extra = aes_extra
+            if zip64_fields:
+                extra = struct.pack('<HH', 0x0001, 8 * len(zip64_fields)) + \
+                    struct.pack(f'<{len(zip64_fields)}Q', *zip64_fields) + aes_extra
+            self.fp.write(struct.pack(
+                '<4sHHHHHHIIIHHHHHII', b'PK\x01\x02', 3 << 8 | 63, 51, flags, ZIP_AES,
+                dos_time, date, 0,
+                min(compress_size, ZIP64_LIMIT), min(file_size, ZIP64_LIMIT),
+                len(name), len(extra), 0, 0, 0, (mode & 0xFFFF) << 16,
+                min(offset, ZIP64_LIMIT)) + name + extra)
+
+        cd_size = self.fp.tell() - cd_offset
+        count = len(self.entries)
+        if count >= ZIP_FILECOUNT_LIMIT or cd_offset >= ZIP64_LIMIT or cd_size >= ZIP64_LIMIT:
+            zip64_end = self.fp.tell()
+            self.fp.write(struct.pack('<4sQHHIIQQQQ', b'PK\x06\x06', 44, 45, 45, 0, 0,
+                                      count, count, cd_size, cd_offset))
+            self.fp.write(struct.pack('<4sIQI', b'PK\x06\x07', 0, zip64_end, 1))
+        self.fp.write(struct.pack(
+            '<4sHHHHIIH', b'PK\x05\x06', 0, 0,
+            min(count, ZIP_FILECOUNT_LIMIT), min(count, ZIP_FILECOUNT_LIMIT),
+            min(cd_size, ZIP64_LIMIT), min(cd_offset, ZIP64_LIMIT), 0))
+
+
+def write_aes_zip(input_dir: Path, output_zip: Path, password: str, files: List[str],
+                  extra: Optional[Dict[str, bytes]] = None, workers: int = 0, level: int = 9,
+                  progress: Optional[Callable[[int, int], None]] = None):
+    """Пишет зашифрованный архив, сжимая файлы параллельно в workers процессах.
+
+    workers=0 - по числу ядер, workers=1 - всё в текущем процессе.
+    Порядок файлов в архиве совпадает с files. progress(файлов, байт) вызывается
+    после каждого записанного файла и может прервать работу исключением.
+    Возвращает описание записанных файлов для индекса: путь, размер, mtime,
+    sha256 и смещение в архиве. Пропавших и нечитаемых файлов в нём нет.
+    """
+    workers = workers or os.cpu_count() or 1
+    pwd = password.encode('utf-8')
+    spool_dir = tempfile.mkdtemp(prefix='.spool_', dir=output_zip.parent)
+    files_done = 0
+    bytes_done = 0
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    pending = []
+    entries = []
+    try:
+        with open(output_zip, 'wb') as fp:
+            zipf = _ZipAssembler(fp)
+            # Держим ограниченное окно задач, чтобы готовые, но ещё не записанные
+            # результаты не копились в памяти
+            window = workers * 4
+            queue = iter(files)
+
+            def submit_next():
+                arcname = next(queue, None)
+                if arcname is None:
+                    return False
+                src = str(input_dir / arcname)
+                if executor:
+                    pending.append((arcname, executor.submit(pack_member, src, pwd, level, spool_dir)))
+                else:
+                    pending.append((arcname, pack_member(src, pwd, level, spool_dir)))
+                return True
+
+            while len(pending) < window and submit_next():
+                pass
+            while pending:
+                arcname, result = pending.pop(0)
+                member = result.result() if executor else result
+                submit_next()
+                if member is None:
+                    # Файл удалили между сканированием и архивацией
+                    logger.warning(f"Файл пропал во время бэкапа: {arcname}")
+                elif 'error' in member:
+                    logger.warning(f"Пропускаю {arcname}: {member['error']}")
+                else:
+                    offset = zipf.add(arcname, member)
+                    bytes_done += member['file_size']
+                    entries.append({
+                        'path': arcname, 'size': member['file_size'], 'mtime': member['mtime'],
+                        'hash': member['hash'], 'offset': offset,
+                    })
+                files_done += 1
+                if progress:
+                    progress(files_done, bytes_done)
+
+            for arcname, data in (extra or {}).items():
+                zipf.add_bytes(arcname, data, pwd, level)
+            zipf.finish()
+    except BaseException:
+        output_zip.unlink(missing_ok=True)
+        raise
+    else:
+        return entries
+    finally:
+        if executor:
+            executor.shutdown(wait=True, cancel_futures=True)
+        for name in os.listdir(spool_dir):
+            os.unlink(os.path.join(spool_dir, name))
+        os.rmdir(spool_dir)
+
+
+def extract_member(fp, offset: int, password: str, out) -> int:
+    """Читает один файл архива по смещению локального заголовка и пишет в out.
+
+    Не требует центрального каталога - используется выборочным восстановлением
+    по индексу. Проверяет пароль и HMAC. Возвращает размер файла.
+    """
+    fp.seek(offset)
+    header = fp.read(30)
+    (sig, _, flags, method, _, _, _, compress_size, file_size,
+     name_len, extra_len) = struct.unpack('<4sHHHHHIIIHH', header)
+    if sig != b'PK\x03\x04' or method != ZIP_AES:
+        raise ValueError("По этому смещению нет файла, зашифрованного AES")
+    fp.read(name_len)
+    extra = fp.read(extra_len)
+    compress_type = ZIP_STORED
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, size = struct.unpack('<HH', extra[pos:pos + 4])
+        body = extra[pos + 4:pos + 4 + size]
+        if tag == 0x0001:
+            file_size, compress_size = struct.unpack('<QQ', body[:16])
+        elif tag == 0x9901:
+            compress_type = struct.unpack('<H', body[5:7])[0]
+        pos += 4 + size
+
+    salt = fp.read(AES_SALT_SIZE)
+    verifier = fp.read(2)
+    keys = hashlib.pbkdf2_hmac('sha1', password.encode('utf-8'), salt, 1000,
+                               2 * AES_KEY_SIZE + 2)
+    if keys[2 * AES_KEY_SIZE:] != verifier:
+        raise RuntimeError("Неверный пароль")
+    cipher = AES.new(keys[:AES_KEY_SIZE], AES.MODE_CTR,
+                     counter=Counter.new(128, initial_value=1, little_endian=True))
+    mac = hmac.new(keys[AES_KEY_SIZE:2 * AES_KEY_SIZE], digestmod=hashlib.sha1)
+    decomp = zlib.decompressobj(-15) if compress_type == ZIP_DEFLATED else None
+
+    remaining = compress_size - AES_SALT_SIZE - 2 - AES_AUTH_SIZE
+    written = 0
+    while remaining > 0:
+        chunk = fp.read(min(READ_CHUNK, remaining))
+        if not chunk:
+            raise ValueError("Архив обрезан")
+        remaining -= len(chunk)
+        mac.update(chunk)
+        data = cipher.decrypt(chunk)
+        if decomp:
+            try:
+                data = decomp.decompress(data)
+            except zlib.error as e:
+                # Испорченный шифротекст ломает поток раньше, чем дойдём до HMAC
+                raise ValueError(f"Файл в архиве повреждён: {e}") from e
+        out.write(data)
+        written += len(data)
+    if decomp:
+        try:
+            data = decomp.flush()
+        except zlib.error as e:
+            raise ValueError(f"Файл в архиве повреждён: {e}") from e
+        out.write(data)
+        written += len(data)
+    if not hmac.compare_digest(mac.digest()[:AES_AUTH_SIZE], fp.read(AES_AUTH_SIZE)):
+        raise ValueError("Файл в архиве повреждён (HMAC не совпал)")
+    return written